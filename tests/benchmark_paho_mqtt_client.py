@@ -0,0 +1,101 @@
+# Copyright (c) 2003-2016, Xively. All rights reserved.
+# This is part of Xively Python library, it is under the BSD 3-Clause license.
+
+# throughput of the mqtt client, run from the repository root with
+# PYTHONPATH=. python tests/benchmark_paho_mqtt_client.py
+
+import os
+import socket
+import threading
+import time
+
+from xiPy.paho_mqtt_client import Client, HAVE_NUMPY, _websocket_mask
+
+
+def benchmark_publish_contention(message_count=64000, thread_counts=(1, 2, 4, 8, 16, 32)):
+    """Publish QoS 0 messages from a growing number of producer threads to a
+    local sink while one thread runs loop(), the way XivelyClient drives the
+    client. Prints the publish rate for each producer count."""
+    listensock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listensock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listensock.bind(("127.0.0.1", 0))
+    listensock.listen(1)
+
+    def sink():
+        conn, address = listensock.accept()
+        while conn.recv(65536):
+            pass
+        conn.close()
+
+    sink_thread = threading.Thread(target=sink)
+    sink_thread.daemon = True
+    sink_thread.start()
+
+    client = Client("benchmark")
+    client.connect("127.0.0.1", listensock.getsockname()[1])
+
+    running = [True]
+
+    def network():
+        while running[0]:
+            client.loop(0.1)
+
+    network_thread = threading.Thread(target=network)
+    network_thread.daemon = True
+    network_thread.start()
+
+    payload = bytearray(64)
+    for thread_count in thread_counts:
+        per_thread = message_count // thread_count
+
+        def producer():
+            for i in range(per_thread):
+                client.publish("benchmark/topic", payload, 0)
+
+        producers = [threading.Thread(target=producer) for i in range(thread_count)]
+        start = time.time()
+        for producer_thread in producers:
+            producer_thread.start()
+        for producer_thread in producers:
+            producer_thread.join()
+        while client.want_write():
+            time.sleep(0.001)
+        elapsed = time.time() - start
+
+        print("%2d producer threads: %8.0f messages/s" % (thread_count, per_thread * thread_count / elapsed))
+
+    running[0] = False
+    network_thread.join()
+    client.disconnect()
+
+
+def benchmark_websocket_masking(sizes=(128, 4096, 65536, 1048576), total=8 * 1048576):
+    """Mask payloads of growing size, about total bytes for each size, with
+    the byte loop the wrapper used before and with _websocket_mask(), and
+    print the throughput of both."""
+    mask_key = bytearray([0x12, 0x34, 0x56, 0x78])
+
+    def byte_loop(data, mask_key):
+        data = bytearray(data)
+        for index in range(len(data)):
+            data[index] ^= mask_key[index % 4]
+        return data
+
+    print("websocket masking, NumPy %s" % ("used" if HAVE_NUMPY else "not installed"))
+    for size in sizes:
+        data = bytearray(os.urandom(size))
+        rounds = max(total // size, 1)
+        results = []
+        for mask in (byte_loop, _websocket_mask):
+            # the byte loop gets a tenth of the data, it is that slow
+            mask_rounds = max(rounds // 10, 1) if mask is byte_loop else rounds
+            start = time.time()
+            for i in range(mask_rounds):
+                mask(data, mask_key)
+            results.append(size * mask_rounds / (time.time() - start) / 1048576)
+        print("%8d byte payloads: byte loop %8.1f MB/s, _websocket_mask %8.1f MB/s" % (size, results[0], results[1]))
+
+
+if __name__ == '__main__':
+    benchmark_publish_contention()
+    benchmark_websocket_masking()
@@ -0,0 +1,319 @@
+# Copyright (c) 2003-2016, Xively. All rights reserved.
+# This is part of Xively Python library, it is under the BSD 3-Clause license.
+
+# checks of the mqtt client against local broker stand-ins, run with python -m pytest
+
+import base64
+import hashlib
+import socket
+import ssl
+import struct
+import subprocess
+import threading
+import time
+
+import pytest
+
+from xiPy.paho_mqtt_client import Client, WebsocketWrapper, _socketpair_compat, _websocket_mask
+
+
+def test_duplex_callbacks(messages=1000):
+    """Publish QoS 0 messages and disconnect with the duplex writer, and
+    check that on_publish and on_disconnect run on the thread calling
+    loop(), not on the writer thread."""
+    listensock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listensock.bind(("127.0.0.1", 0))
+    listensock.listen(1)
+
+    def sink():
+        conn, address = listensock.accept()
+        conn.recv(65536)
+        conn.sendall(b"\x20\x02\x00\x00")
+        while conn.recv(65536):
+            pass
+        conn.close()
+
+    sink_thread = threading.Thread(target=sink)
+    sink_thread.daemon = True
+    sink_thread.start()
+
+    threads = set()
+    published = []
+    disconnected = []
+
+    def on_publish(client, userdata, mid):
+        threads.add(threading.current_thread())
+        published.append(mid)
+
+    def on_disconnect(client, userdata, rc):
+        threads.add(threading.current_thread())
+        disconnected.append(rc)
+
+    client = Client("duplex-callbacks")
+    client.duplex_set(True)
+    client.on_publish = on_publish
+    client.on_disconnect = on_disconnect
+    client.connect("127.0.0.1", listensock.getsockname()[1])
+
+    for i in range(messages):
+        client.publish("t", "x", 0)
+    start = time.time()
+    while len(published) < messages and time.time() - start < 5:
+        client.loop(0.1)
+    client.disconnect()
+    while not disconnected and time.time() - start < 5:
+        client.loop(0.1)
+
+    print("duplex writer: %d on_publish and %d on_disconnect calls on %d thread(s)" %
+          (len(published), len(disconnected), len(threads)))
+    assert len(published) == messages and disconnected == [0]
+    assert threads == set([threading.current_thread()])
+    listensock.close()
+
+
+def test_tls_resumption(tmp_path, connects=5):
+    """Connect several times to a local TLS broker stand-in that only
+    answers CONNECT, using a self-signed certificate as its own CA. Every
+    connect after the first should resume the TLS session."""
+    certfile = str(tmp_path / "cert.pem")
+    keyfile = str(tmp_path / "key.pem")
+    try:
+        subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                               "-subj", "/CN=localhost", "-keyout", keyfile, "-out", certfile],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except (OSError, subprocess.CalledProcessError):
+        pytest.skip("openssl can't create a certificate")
+
+    server_context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+    server_context.load_cert_chain(certfile, keyfile)
+
+    listensock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listensock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listensock.bind(("127.0.0.1", 0))
+    listensock.listen(1)
+
+    def broker():
+        while True:
+            conn, address = listensock.accept()
+            try:
+                conn = server_context.wrap_socket(conn, server_side=True)
+                conn.recv(65536)
+                conn.sendall(b"\x20\x02\x00\x00")
+                while conn.recv(65536):
+                    pass
+            except (socket.error, ssl.SSLError):
+                pass
+            conn.close()
+
+    broker_thread = threading.Thread(target=broker)
+    broker_thread.daemon = True
+    broker_thread.start()
+
+    before = Client("resumption").statistics()
+    for i in range(connects):
+        connected = []
+        client = Client("resumption")
+        client.on_connect = lambda client, userdata, flags, rc: connected.append(rc)
+        client.tls_set(certfile, tls_version=ssl.PROTOCOL_TLSv1_2)
+        client.tls_insecure_set(True)
+        start = time.time()
+        client.connect("127.0.0.1", listensock.getsockname()[1])
+        while not connected:
+            client.loop(0.1)
+        print("connect %d: %.1f ms" % (i, (time.time() - start) * 1000))
+        client.disconnect()
+        client.loop(0.1)
+
+    after = client.statistics()
+    handshakes = after['tls_handshakes'] - before['tls_handshakes']
+    resumed = after['tls_resumed'] - before['tls_resumed']
+    print("%d handshakes, %d resumed" % (handshakes, resumed))
+    assert resumed == connects - 1, "sessions were not resumed"
+
+
+def test_websocket_handshake(header_count=40):
+    """Upgrade a websocket against a stand-in that answers with a long header
+    block and the first frame in the same write, and count the reads the
+    upgrade takes."""
+    client_sock, server_sock = _socketpair_compat()
+    client_sock.setblocking(1)
+    server_sock.setblocking(1)
+
+    class CountingSocket:
+        def __init__(self, sock):
+            self.sock = sock
+            self.reads = 0
+
+        def send(self, data):
+            return self.sock.send(data)
+
+        def recv(self, length):
+            self.reads += 1
+            return self.sock.recv(length)
+
+    def server():
+        request = b""
+        while b"\r\n\r\n" not in request:
+            request += server_sock.recv(4096)
+        key = [line.split(b": ", 1)[1] for line in request.split(b"\r\n")
+               if line.lower().startswith(b"sec-websocket-key")][0]
+        accept = base64.b64encode(hashlib.sha1(key + b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11").digest())
+        response = b"HTTP/1.1 101 Switching Protocols\r\nUPGRADE: websocket\r\nconnection: Upgrade\r\n"
+        for index in range(header_count):
+            response += ("X-Padding-%d: %s\r\n" % (index, "p" * 40)).encode('utf-8')
+        response += b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n"
+        # CONNACK in a binary frame right behind the headers
+        server_sock.sendall(response + b"\x82\x04\x20\x02\x00\x00")
+
+    server_thread = threading.Thread(target=server)
+    server_thread.daemon = True
+    server_thread.start()
+
+    counting = CountingSocket(client_sock)
+    start = time.time()
+    websocket = WebsocketWrapper(counting, "localhost", 80, False)
+    elapsed = time.time() - start
+    reads = counting.reads
+
+    pending = websocket.pending()
+    connack = websocket.recv(4)
+    print("websocket upgrade with %d headers in %d reads, %.2f ms, %d bytes buffered, first frame %r" %
+          (len(websocket._handshake_headers), reads, elapsed * 1000, pending, bytes(connack)))
+    assert bytes(connack) == b"\x20\x02\x00\x00"
+    assert pending == 4
+
+    client_sock.close()
+    server_sock.close()
+
+
+@pytest.mark.parametrize("messages, with_upgrade", [(5, False), (2, True)])
+def test_websocket_loop(messages, with_upgrade):
+    """Connect over a plain websocket to a stand-in broker that answers
+    CONNECT with the CONNACK and messages PUBLISH frames in one write, and
+    run loop() until all of them arrived. The packets after the first are
+    decoded ahead and have to be read without the socket becoming readable
+    again, with and without the duplex writer. With with_upgrade the broker
+    sends them in the same write as the upgrade response, before CONNECT."""
+    listensock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listensock.bind(("127.0.0.1", 0))
+    listensock.listen(2)
+
+    def frame(payload):
+        return b"\x82" + struct.pack("!B", len(payload)) + payload
+
+    def broker():
+        while True:
+            try:
+                conn, address = listensock.accept()
+            except socket.error:
+                # closed at the end of the check
+                return
+            request = b""
+            while b"\r\n\r\n" not in request:
+                request += conn.recv(4096)
+            key = [line.split(b": ", 1)[1] for line in request.split(b"\r\n")
+                   if line.lower().startswith(b"sec-websocket-key")][0]
+            accept = base64.b64encode(hashlib.sha1(key + b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11").digest())
+            response = b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n" \
+                       b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n"
+            data = frame(b"\x20\x02\x00\x00")
+            for i in range(messages):
+                data += frame(b"\x30\x04\x00\x01t" + str(i % 10).encode('utf-8'))
+            if with_upgrade:
+                conn.sendall(response + data)
+            else:
+                conn.sendall(response)
+                conn.recv(4096)
+                conn.sendall(data)
+            try:
+                while conn.recv(4096):
+                    pass
+            except socket.error:
+                pass
+            conn.close()
+
+    broker_thread = threading.Thread(target=broker)
+    broker_thread.daemon = True
+    broker_thread.start()
+
+    for duplex in (False, True):
+        received = []
+        client = Client("websocket-loop", use_websocket=True)
+        client.duplex_set(duplex)
+        client.on_connect = lambda client, userdata, flags, rc: received.append(("connack", rc))
+        client.on_message = lambda client, userdata, message: received.append(message.payload)
+        client.connect("127.0.0.1", listensock.getsockname()[1])
+
+        start = time.time()
+        while len(received) < messages + 1 and time.time() - start < 3:
+            client.loop(0.5)
+
+        print("websocket loop%s%s: %d of %d packets in %.1f ms" % (
+              " with duplex writer" if duplex else "", ", packets sent with the upgrade" if with_upgrade else "",
+              len(received), messages + 1, (time.time() - start) * 1000))
+        assert len(received) == messages + 1, received
+        client.disconnect()
+        client.loop(0)
+
+    listensock.close()
+
+
+def test_websocket_frames(packets=50):
+    """Feed an upgraded websocket MQTT packets in binary frames, one message
+    fragmented with a ping between its fragments, plus a text frame, all in
+    one write. Prints how many socket reads the stream takes and checks the
+    pong the stand-in receives."""
+    client_sock, server_sock = _socketpair_compat()
+    client_sock.setblocking(1)
+    server_sock.setblocking(1)
+
+    class CountingSocket:
+        def __init__(self, sock):
+            self.sock = sock
+            self.reads = 0
+
+        def send(self, data):
+            return self.sock.send(data)
+
+        def recv(self, length):
+            self.reads += 1
+            return self.sock.recv(length)
+
+    def frame(opcode, payload, final=True):
+        header = bytearray([(0x80 if final else 0) | opcode])
+        if len(payload) < 126:
+            header.append(len(payload))
+        else:
+            header.append(126)
+            header += struct.pack("!H", len(payload))
+        return bytes(header) + payload
+
+    # PUBLISH QoS 0 packets on topic "t"
+    stream = b"".join(b"\x30" + struct.pack("!B", 5 + len(str(i))) + b"\x00\x01t" + ("hi%d" % i).encode('utf-8')
+                      for i in range(packets))
+    half = len(stream) // 2
+    data = frame(WebsocketWrapper.OPCODE_BINARY, stream[:10])
+    data += frame(WebsocketWrapper.OPCODE_BINARY, stream[10:half], False)
+    data += frame(WebsocketWrapper.OPCODE_PING, b"ping")
+    data += frame(WebsocketWrapper.OPCODE_CONTINUATION, stream[half:])
+    data += frame(WebsocketWrapper.OPCODE_TEXT, b"ignored")
+
+    counting = CountingSocket(client_sock)
+    websocket = WebsocketWrapper(counting, "localhost", 80, False, False)
+    websocket.connected = True
+    server_sock.sendall(data)
+
+    # read like the MQTT client does, a byte or a packet at a time
+    received = bytearray(websocket.recv(1))
+    while websocket.pending() > 0:
+        received += websocket.recv(7)
+
+    reply = bytearray(server_sock.recv(4096))
+    assert reply[0] == 0x80 | WebsocketWrapper.OPCODE_PONG and reply[1] == 0x80 | 4
+    assert _websocket_mask(reply[6:10], reply[2:6]) == bytearray(b"ping")
+    assert bytes(received) == stream
+    print("websocket stream of %d MQTT packets in 4 frames decoded from %d socket reads, ping answered" %
+          (packets, counting.reads))
+
+    client_sock.close()
+    server_sock.close()
@@ -0,0 +1,115 @@
+# Copyright (c) 2003-2016, Xively. All rights reserved.
+# This is part of Xively Python library, it is under the BSD 3-Clause license.
+
+# client teardown paths, run with python -m pytest
+
+import socket
+import tempfile
+import threading
+
+from xiPy.paho_mqtt_client import Client
+from xiPy.xively_client import XivelyClient
+from xiPy.xively_config import XivelyConfig
+from xiPy.xively_connection_parameters import XivelyConnectionParameters
+from xiPy.xively_dispatcher import XivelyDispatcher
+from xiPy.xively_error_codes import XivelyErrorCodes as xec
+from xiPy.xively_journal import XivelyJournal
+from xiPy.xively_message import XivelyMessage
+from xiPy.xively_publish_future import XivelyPublishFuture
+
+
+def test_disconnect_with_callback_waiting_for_future():
+    """A message callback on a worker waits for a publish that is never
+    acknowledged. The disconnect fails the future instead of waiting for the
+    worker forever."""
+    client = XivelyClient()
+    client._mqtt = Client("teardown")
+    client._alive = True
+
+    future = XivelyPublishFuture(client._futures_cond, 1)
+    client._futures[1] = future
+    waiting = threading.Event()
+
+    def handler(message):
+        waiting.set()
+        future.wait()
+
+    client._dispatcher = XivelyDispatcher(handler, 1)
+    client._dispatcher.start()
+    message = XivelyMessage()
+    message.topic = "t"
+    client._dispatcher.dispatch(message)
+    assert waiting.wait(5)
+
+    teardown = threading.Thread(target=client._routine_disconnected)
+    teardown.daemon = True
+    teardown.start()
+    teardown.join(5)
+
+    assert not teardown.is_alive()
+    assert future.error() == xec.XI_MESSAGE_NOT_DELIVERED
+
+
+def test_publish_racing_journal_close():
+    """The network thread closes the journal on disconnect while a publish
+    of another thread is between its journal check and the append. The
+    publish fails instead of raising."""
+    client = XivelyClient()
+    client._mqtt = Client("journal")
+    client._alive = True
+    client._journal = XivelyJournal(tempfile.mkdtemp())
+
+    reserve_mid = client._mqtt.reserve_mid
+
+    def reserve_mid_during_disconnect():
+        client._close_journal()
+        return reserve_mid()
+
+    client._mqtt.reserve_mid = reserve_mid_during_disconnect
+
+    assert client._publish_now("t", "x", 1, False, None) == (False, None)
+    assert client._journal is None and client._journal_keys == {}
+
+
+def test_host_index_of_hosts_sharing_a_name(monkeypatch):
+    """Two configured hosts share a name, only the second one has a broker
+    stand-in behind its port. The connect timing reports the index of the
+    second one."""
+    closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    closed.bind(("127.0.0.1", 0))
+    listensock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listensock.bind(("127.0.0.1", 0))
+    listensock.listen(1)
+
+    def broker():
+        conn, address = listensock.accept()
+        conn.recv(65536)
+        conn.sendall(b"\x20\x02\x00\x00")
+        while conn.recv(65536):
+            pass
+        conn.close()
+
+    broker_thread = threading.Thread(target=broker)
+    broker_thread.daemon = True
+    broker_thread.start()
+
+    monkeypatch.setattr(XivelyConfig, "XI_MQTT_HOSTS", [("127.0.0.1", closed.getsockname()[1], False),
+                                                        ("127.0.0.1", listensock.getsockname()[1], False)])
+
+    timings = []
+    connected = threading.Event()
+    client = XivelyClient()
+    client.on_connect_timing = lambda client, timing: timings.append(timing)
+    client.on_connect_finished = lambda client, result: connected.set()
+
+    options = XivelyConnectionParameters()
+    options.username = "device"
+    options.password = "password"
+    client.connect(options)
+    assert connected.wait(5)
+    client.disconnect()
+    client.join()
+
+    assert [timing["host_index"] for timing in timings if timing["connack"] is not None] == [1]
+    closed.close()
+    listensock.close()
@@ -0,0 +1,56 @@
+# Copyright (c) 2003-2016, Xively. All rights reserved.
+# This is part of Xively Python library, it is under the BSD 3-Clause license.
+
+# timeseries encoding and the batch publishes built on it, run with python -m pytest
+
+import socket
+
+import pytest
+
+from xiPy.paho_mqtt_client import Client
+from xiPy.xively_client import XivelyClient
+from xiPy.xively_timeseries import encode_csv_rows
+
+
+@pytest.fixture
+def client():
+    """A XivelyClient whose mqtt client is connected to a listener that
+    never answers, with the CONNECT packet already written. Anything
+    published afterwards shows up in want_write()."""
+    listensock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listensock.bind(("127.0.0.1", 0))
+    listensock.listen(1)
+
+    xively_client = XivelyClient()
+    xively_client._mqtt = Client("timeseries")
+    xively_client._mqtt.connect("127.0.0.1", listensock.getsockname()[1])
+    xively_client._alive = True
+    while xively_client._mqtt.want_write():
+        xively_client._mqtt.loop(0.01)
+
+    yield xively_client
+
+    xively_client._mqtt.disconnect()
+    listensock.close()
+
+
+@pytest.mark.parametrize("columns", [(None, None, None, None), ([], None, [], None)])
+def test_encode_csv_rows_without_rows(columns):
+    assert encode_csv_rows(*columns) == []
+
+
+def test_encode_csv_rows():
+    # time, category, numeric value, string value
+    rows = encode_csv_rows([1, None], [u"a", None], [None, u"s"], [None, 2.5])
+    assert rows == [bytearray(b"1,a,,"), bytearray(b",,2.5,s")]
+
+
+def test_formatted_timeseries_batch_without_rows(client):
+    assert client.publish_formatted_timeseries_batch("t", None, None, None, None, 0) == (True, [])
+    assert not client._mqtt.want_write()
+
+
+@pytest.mark.parametrize("packed, result", [(False, (True, [])), (True, (True, None))])
+def test_timeseries_batch_without_values(client, packed, result):
+    assert client.publish_timeseries_batch("t", [], 0, packed) == result
+    assert not client._mqtt.want_write()
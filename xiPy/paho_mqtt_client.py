@@ -17,6 +17,7 @@ This is an MQTT v3.1 client module. MQTT is a lightweight pub/sub messaging
 protocol that is easy to implement and suitable for low powered devices.
 """
 import errno
+import os
 import platform
 import random
 import select
@@ -30,12 +31,16 @@ except:
     HAVE_SSL = False
     cert_reqs = None
     tls_version = None
+import collections
+import heapq
+import itertools
 import struct
 import sys
 import threading
 import time
 import uuid
 import base64
+import binascii
 import hashlib
 
 HAVE_DNS = True
@@ -44,6 +49,12 @@ try:
 except ImportError:
     HAVE_DNS = False
 
+HAVE_NUMPY = True
+try:
+    import numpy
+except ImportError:
+    HAVE_NUMPY = False
+
 if platform.system() == 'Windows':
     EAGAIN = errno.WSAEWOULDBLOCK
 else:
@@ -103,6 +114,9 @@ mqtt_cs_connected = 1
 mqtt_cs_disconnecting = 2
 mqtt_cs_connect_async = 3
 
+# Phase of a connect advanced by loop(), see connect_socket()
+connect_phase_websocket = 1
+
 # Message state
 mqtt_ms_invalid = 0
 mqtt_ms_publish= 1
@@ -132,12 +146,26 @@ MQTT_ERR_AUTH = 11
 MQTT_ERR_ACL_DENIED = 12
 MQTT_ERR_UNKNOWN = 13
 MQTT_ERR_ERRNO = 14
+MQTT_ERR_QUEUE_SIZE = 15
+
+# Outbox policies, see outbox_limits_set()
+MQTT_OUTBOX_BLOCK = 0
+MQTT_OUTBOX_FAIL = 1
+MQTT_OUTBOX_DROP_OLDEST_QOS0 = 2
 
 if sys.version_info[0] < 3:
     sockpair_data = "0"
 else:
     sockpair_data = b"0"
 
+# Largest single write in duplex mode, see duplex_set()
+DUPLEX_WRITE_CHUNK = 16384
+
+# Messages are resent after CONNACK in packets of about this many bytes and
+# at most this many messages, see _replay_step()
+REPLAY_CHUNK_BYTES = 65536
+REPLAY_CHUNK_MESSAGES = 4096
+
 def error_string(mqtt_errno):
     """Return the error string associated with an mqtt error number."""
     if mqtt_errno == MQTT_ERR_SUCCESS:
@@ -170,6 +198,8 @@ def error_string(mqtt_errno):
         return "Unknown error."
     elif mqtt_errno == MQTT_ERR_ERRNO:
         return "Error defined by errno."
+    elif mqtt_errno == MQTT_ERR_QUEUE_SIZE:
+        return "Message queue full."
     else:
         return "Unknown error."
 
@@ -192,6 +222,90 @@ def connack_string(connack_code):
         return "Connection Refused: unknown reason."
 
 
+# monotonic clock if available (py3), wall clock on py2.7
+_monotonic = getattr(time, "monotonic", time.time)
+
+# SSL contexts shared by all clients of the process, see _ssl_context(),
+# and the TLS session of the last accepted connection to each host, see
+# _ssl_session(). Both are guarded by _ssl_contexts_mutex.
+_ssl_contexts = {}
+_ssl_contexts_mutex = threading.Lock()
+_ssl_sessions = {}
+_ssl_handshakes = 0
+_ssl_resumed = 0
+
+
+def _ssl_context_files_state(paths):
+    # (mtime, size) of each file, a changed file gets a new context
+    state = []
+    for path in paths:
+        if path is None:
+            state.append(None)
+        else:
+            st = os.stat(path)
+            state.append((st.st_mtime, st.st_size))
+    return tuple(state)
+
+
+def _ssl_context(ca_certs, certfile, keyfile, cert_reqs, tls_version, ciphers):
+    """Return an SSLContext for the TLS settings, parsing the certificate
+    files only the first time or after one of them changed. ca_certs is a
+    tuple of files, all of them are loaded into the trust store."""
+    key = (ca_certs, certfile, keyfile, cert_reqs, tls_version, ciphers)
+    state = _ssl_context_files_state(ca_certs + (certfile, keyfile))
+
+    _ssl_contexts_mutex.acquire()
+    try:
+        cached = _ssl_contexts.get(key)
+        if cached is not None and cached[1] == state:
+            return cached[0]
+
+        context = ssl.SSLContext(tls_version)
+        context.verify_mode = cert_reqs
+        for path in ca_certs:
+            context.load_verify_locations(path)
+        if certfile is not None:
+            context.load_cert_chain(certfile, keyfile)
+        if ciphers is not None:
+            context.set_ciphers(ciphers)
+
+        _ssl_contexts[key] = (context, state)
+        return context
+    finally:
+        _ssl_contexts_mutex.release()
+
+
+def _ssl_session(context, host, port):
+    """Return the session to offer for a connection to host and port, or
+    None. A session is only valid with the context that made it."""
+    if not hasattr(ssl, 'SSLSession'):
+        return None
+
+    _ssl_contexts_mutex.acquire()
+    try:
+        cached = _ssl_sessions.get((host, port))
+        if cached is not None and cached[0] is context:
+            return cached[1]
+        return None
+    finally:
+        _ssl_contexts_mutex.release()
+
+
+def _ssl_session_save(context, host, port, session):
+    _ssl_contexts_mutex.acquire()
+    _ssl_sessions[(host, port)] = (context, session)
+    _ssl_contexts_mutex.release()
+
+
+def _ssl_handshake_count(resumed):
+    global _ssl_handshakes, _ssl_resumed
+    _ssl_contexts_mutex.acquire()
+    _ssl_handshakes += 1
+    if resumed:
+        _ssl_resumed += 1
+    _ssl_contexts_mutex.release()
+
+
 def topic_matches_sub(sub, topic):
     """Check whether a topic matches a subscription.
 
@@ -278,7 +392,7 @@ def _socketpair_compat():
     return (sock1, sock2)
 
 
-class MQTTMessage:
+class MQTTMessage(object):
     """ This is a class that describes an incoming message. It is passed to the
     on_message callback as the message parameter.
 
@@ -289,7 +403,13 @@ class MQTTMessage:
     qos : Integer. The message Quality of Service 0, 1 or 2.
     retain : Boolean. If true, the message is a retained message and not fresh.
     mid : Integer. The message id.
+    expiry : time.time() value after which an outgoing message is dropped, or
+      None.
     """
+    # Outgoing QoS>0 messages stay queued until acknowledged, slots keep a
+    # long queue small.
+    __slots__ = ('timestamp', 'state', 'dup', 'mid', 'topic', 'payload', 'qos', 'retain', 'expiry')
+
     def __init__(self):
         self.timestamp = 0
         self.state = mqtt_ms_invalid
@@ -299,6 +419,26 @@ class MQTTMessage:
         self.payload = None
         self.qos = 0
         self.retain = False
+        self.expiry = None
+
+
+class _OutPacket(object):
+    """An outgoing packet and how much of it is written. The outbox members
+    are used for QoS 0 publishes counted by outbox_limits_set() only."""
+    __slots__ = ('command', 'mid', 'qos', 'pos', 'to_process', 'packet', 'outbox_size', 'claimed', 'dropped',
+                 'expiry')
+
+    def __init__(self, command, mid, qos, packet, outbox_size=0, expiry=None):
+        self.command = command
+        self.mid = mid
+        self.qos = qos
+        self.pos = 0
+        self.to_process = len(packet)
+        self.packet = packet
+        self.outbox_size = outbox_size
+        self.claimed = False
+        self.dropped = False
+        self.expiry = expiry
 
 
 class Client(object):
@@ -375,6 +515,14 @@ class Client(object):
       This callback is important because even if the publish() call returns
       success, it does not always mean that the message has been sent.
 
+    on_expire(client, userdata, mid): called when a message published with an
+      expiry is dropped because the expiry passed before it was written (QoS 0)
+      or acknowledged (QoS 1 and 2). on_publish() is not called for it.
+
+    on_drop(client, userdata, mid): called when a QoS 0 message is dropped
+      from the outbox to make room for a newer one, see outbox_limits_set().
+      on_publish() is not called for it.
+
     on_subscribe(client, userdata, mid, granted_qos): called when the broker responds to a
       subscribe request. The mid variable matches the mid variable returned
       from the corresponding subscribe() call. The granted_qos variable is a
@@ -385,6 +533,14 @@ class Client(object):
       request. The mid variable matches the mid variable returned from the
       corresponding unsubscribe() call.
 
+    on_connect_timing(client, userdata, timing): called once per connect
+      attempt, on CONNACK before on_connect() or when a phase of the connect
+      fails. timing is a dict with the host and port, the monotonic clock
+      value of the start and of the end of each phase that ran, 'dns', 'tcp',
+      'tls', 'websocket' and 'connack' (None for phases that didn't run or
+      weren't reached), the CONNACK 'result' and the 'error' raised by a
+      failed phase (both None otherwise).
+
     on_log(client, userdata, level, buf): called when the client has log information. Define
       to allow debugging. The level variable gives the severity of the message
       and will be one of MQTT_LOG_INFO, MQTT_LOG_NOTICE, MQTT_LOG_WARNING,
@@ -448,17 +604,44 @@ class Client(object):
             "packet": b"",
             "to_process": 0,
             "pos": 0}
-        self._out_packet = []
+        self._out_packet = collections.deque()
         self._current_out_packet = None
+        # Packets and messages queued by threads other than the network
+        # thread. Only the network thread consumes it, see _handoff_drain().
+        self._out_handoff = collections.deque()
+        self._wakeup_pending = False
+        self._loop_thread = None
         self._last_msg_in = time.time()
         self._last_msg_out = time.time()
         self._ping_t = 0
-        self._last_mid = 0
+        self._mid_counter = itertools.count(1)
         self._state = mqtt_cs_new
         self._out_messages = []
+        self._replay_index = 0
+        self._replay_active = False
+        # Last chunk queued by _replay_step(), the next one waits until it is
+        # written
+        self._replay_packet = None
         self._in_messages = []
         self._max_inflight_messages = 20
         self._inflight_messages = 0
+        # Outbox accounting, only done while a limit is set. Counts QoS 0
+        # publishes until they are written and QoS>0 publishes until they are
+        # acknowledged.
+        self._outbox_cond = threading.Condition()
+        self._outbox_max_messages = 0
+        self._outbox_max_bytes = 0
+        self._outbox_policy = MQTT_OUTBOX_BLOCK
+        self._outbox_timeout = 0.0
+        self._outbox_messages = 0
+        self._outbox_bytes = 0
+        self._outbox_qos0 = collections.deque()
+        self._outbox_dropped = 0
+        # QoS>0 messages with an expiry by expiry time, owned by the network
+        # thread. _expired_messages is guarded by _outbox_cond.
+        self._expiry_heap = []
+        self._expiry_sequence = itertools.count()
+        self._expired_messages = 0
         self._will = False
         self._will_topic = ""
         self._will_payload = None
@@ -467,6 +650,9 @@ class Client(object):
         self.on_disconnect = None
         self.on_connect = None
         self.on_publish = None
+        self.on_expire = None
+        self.on_drop = None
+        self.on_connect_timing = None
         self.on_message = None
         self.on_message_filtered = []
         self.on_subscribe = None
@@ -477,13 +663,21 @@ class Client(object):
         self._bind_address = ""
         self._in_callback = False
         self._strict_protocol = False
+        # The network thread owns the packet and message queues, other
+        # threads only append to _out_handoff. _state_mutex is kept for the
+        # rare connection state changes.
         self._callback_mutex = threading.Lock()
         self._state_mutex = threading.Lock()
-        self._out_packet_mutex = threading.Lock()
-        self._current_out_packet_mutex = threading.Lock()
-        self._msgtime_mutex = threading.Lock()
-        self._out_message_mutex = threading.Lock()
-        self._in_message_mutex = threading.Lock()
+        self._duplex = False
+        self._sock_serialize = False
+        self._sock_mutex = threading.Lock()
+        self._writer_thread = None
+        self._writer_cond = threading.Condition()
+        self._writer_terminate = False
+        self._writer_rc = MQTT_ERR_SUCCESS
+        # (method, packet) of the packet callbacks the writer thread left to
+        # the network thread, see _packet_callback()
+        self._writer_done = collections.deque()
         self._thread = None
         self._thread_terminate = False
         self._ssl = None
@@ -494,18 +688,21 @@ class Client(object):
         self._tls_ciphers = None
         self._tls_version = tls_version
         self._tls_insecure = False
+        # State of the websocket upgrade of a connect, the socket is in
+        # _connect_sock until it completes.
+        self._connect_phase = None
+        self._connect_sock = None
+        self._connect_websocket = None
+        self._connect_want_write = False
+        self._connect_timing = None
 
     def __del__(self):
         pass
 
     def reinitialise(self, client_id="", clean_session=True, userdata=None):
-        if self._ssl:
-            self._ssl.close()
-            self._ssl = None
-            self._sock = None
-        elif self._sock:
-            self._sock.close()
-            self._sock = None
+        self._writer_stop()
+        self._sock_close()
+        self._outbox_reset()
         if self._sockpairR:
             self._sockpairR.close()
             self._sockpairR = None
@@ -519,7 +716,10 @@ class Client(object):
         """Configure network encryption and authentication options. Enables SSL/TLS support.
 
         ca_certs : a string path to the Certificate Authority certificate files
-        that are to be treated as trusted by this client. If this is the only
+        that are to be treated as trusted by this client, or a list of paths.
+        All the certificates of a list are loaded into a single trust store,
+        so the broker chain is validated against any of them in one
+        handshake. A list needs ssl.SSLContext. If this is the only
         option given then the client will operate in a similar manner to a web
         browser. That is to say it will require the broker to have a
         certificate signed by the Certificate Authorities in ca_certs and will
@@ -559,12 +759,22 @@ class Client(object):
         if ca_certs is None:
             raise ValueError('ca_certs must not be None.')
 
-        try:
-            f = open(ca_certs, "r")
-        except IOError as err:
-            raise IOError(ca_certs+": "+err.strerror)
+        if isinstance(ca_certs, (list, tuple)):
+            if len(ca_certs) == 0:
+                raise ValueError('ca_certs must not be empty.')
+            if len(ca_certs) > 1 and not hasattr(ssl, 'SSLContext'):
+                raise ValueError('Several ca_certs need ssl.SSLContext.')
+            ca_certs = tuple(ca_certs)
         else:
-            f.close()
+            ca_certs = (ca_certs,)
+
+        for path in ca_certs:
+            try:
+                f = open(path, "r")
+            except IOError as err:
+                raise IOError(path+": "+err.strerror)
+            else:
+                f.close()
         if certfile is not None:
             try:
                 f = open(certfile, "r")
@@ -605,6 +815,104 @@ class Client(object):
 
         self._tls_insecure = value
 
+    def duplex_set(self, value):
+        """Configure full-duplex operation.
+
+        If value is True, a dedicated writer thread sends outgoing packets
+        while the thread calling loop() only reads and handles incoming
+        packets, so a large outgoing message doesn't delay incoming traffic.
+        The socket stays non-blocking and every read or write call on it is
+        serialized, which keeps TLS and websocket state consistent. Writes are
+        split into chunks of at most DUPLEX_WRITE_CHUNK bytes so reads get the
+        socket in between.
+
+        Must be called before connect()."""
+        self._duplex = value
+
+    def outbox_limits_set(self, max_messages=0, max_bytes=0, policy=MQTT_OUTBOX_BLOCK, timeout=0.0):
+        """Limit the memory used by messages waiting to be sent or acknowledged.
+
+        The limits cover QoS 0 messages until they are written to the socket
+        and QoS 1 and 2 messages until the broker acknowledges them. Bytes are
+        counted as topic plus payload length. A limit of 0 means unlimited,
+        both 0 turns accounting off.
+
+        policy decides what publish() does when a limit is reached:
+
+        MQTT_OUTBOX_BLOCK: wait up to timeout seconds for space. Called from
+          the network thread, for example from a callback, it can't wait and
+          fails right away.
+        MQTT_OUTBOX_FAIL: fail right away.
+        MQTT_OUTBOX_DROP_OLDEST_QOS0: discard the oldest QoS 0 messages not
+          yet being written until the new message fits, fail if there are none
+          left to discard.
+
+        A failed publish() returns MQTT_ERR_QUEUE_SIZE. A single message larger
+        than max_bytes is accepted when the outbox is empty.
+
+        Must be called before connect()."""
+        if max_messages < 0 or max_bytes < 0:
+            raise ValueError('Invalid outbox limit.')
+        if policy not in (MQTT_OUTBOX_BLOCK, MQTT_OUTBOX_FAIL, MQTT_OUTBOX_DROP_OLDEST_QOS0):
+            raise ValueError('Invalid outbox policy.')
+
+        self._outbox_max_messages = max_messages
+        self._outbox_max_bytes = max_bytes
+        self._outbox_policy = policy
+        self._outbox_timeout = timeout
+
+    def wait_writable(self, timeout=None):
+        """Wait until the outbox has room for another message.
+
+        Lets producers pace themselves instead of running into the limits set
+        with outbox_limits_set(). Returns True if there is room, False if
+        timeout seconds passed first. timeout=None waits forever."""
+        self._outbox_cond.acquire()
+        try:
+            # Room for at least one more byte
+            if timeout is None:
+                while self._outbox_full(1):
+                    self._outbox_cond.wait()
+                return True
+
+            deadline = time.time() + timeout
+            while self._outbox_full(1):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._outbox_cond.wait(remaining)
+            return True
+        finally:
+            self._outbox_cond.release()
+
+    def statistics(self):
+        """Return a dict of runtime counters.
+
+        outbox_messages, outbox_bytes: size of the outbox, counted only while
+          limits are set with outbox_limits_set().
+        outbox_dropped: QoS 0 messages discarded by
+          MQTT_OUTBOX_DROP_OLDEST_QOS0.
+        expired: messages dropped because their expiry passed, see
+          publish().
+        tls_handshakes, tls_resumed: TLS handshakes of all clients of the
+          process, and how many of them resumed the session of an earlier
+          connection."""
+        self._outbox_cond.acquire()
+        try:
+            statistics = {
+                'outbox_messages': self._outbox_messages,
+                'outbox_bytes': self._outbox_bytes,
+                'outbox_dropped': self._outbox_dropped,
+                'expired': self._expired_messages}
+        finally:
+            self._outbox_cond.release()
+
+        _ssl_contexts_mutex.acquire()
+        statistics['tls_handshakes'] = _ssl_handshakes
+        statistics['tls_resumed'] = _ssl_resumed
+        _ssl_contexts_mutex.release()
+        return statistics
+
     def connect(self, host, port=1883, keepalive=60, bind_address=""):
         """Connect to a remote broker.
 
@@ -689,9 +997,85 @@ class Client(object):
         self._state = mqtt_cs_connect_async
         self._state_mutex.release()
 
+    def connect_socket(self, sock, host, port=1883, keepalive=60, blocking=True):
+        """Connect to a remote broker over a socket that is already connected,
+        for example the winner of a race between several broker addresses.
+
+        sock is a connected socket. With TLS it is the socket returned by
+        tls_wrap(), a plain socket is used as it is.
+        host and port are what sock is connected to, they name the broker for
+        websockets, TLS sessions and a later reconnect().
+        keepalive is as for connect().
+        blocking: False leaves the websocket upgrade to loop(), which
+        advances it whenever the socket is ready and then sends CONNECT. A
+        failed upgrade raises from loop() the exception connect() would have
+        raised.
+        """
+        self.connect_async(host, port, keepalive)
+        return self._reconnect(sock, blocking)
+
+    def tls_wrap(self, sock, host, port):
+        """Run the TLS handshake with the tls_set() settings on a connected
+        socket, offering the session of the last connection to host and port,
+        and check the broker certificate against host unless
+        tls_insecure_set() disabled it. Raises ssl.SSLError or
+        ssl.CertificateError on failure.
+
+        Returns the SSL socket for connect_socket(). This can be called from
+        any thread, it doesn't touch the connection of the client."""
+        if self._tls_ca_certs is None:
+            raise ValueError('tls_set() must be called before tls_wrap().')
+
+        if hasattr(ssl, 'SSLContext'):
+            context = _ssl_context(
+                self._tls_ca_certs,
+                self._tls_certfile,
+                self._tls_keyfile,
+                self._tls_cert_reqs,
+                self._tls_version,
+                self._tls_ciphers)
+            # An abbreviated handshake if the broker still knows the
+            # session of the last connection.
+            session = _ssl_session(context, host, port)
+            if session is not None:
+                sslsock = context.wrap_socket(sock, server_hostname=host, session=session)
+            else:
+                sslsock = context.wrap_socket(sock, server_hostname=host)
+        else:
+            sslsock = ssl.wrap_socket(
+                sock,
+                certfile=self._tls_certfile,
+                keyfile=self._tls_keyfile,
+                ca_certs=self._tls_ca_certs[0],
+                cert_reqs=self._tls_cert_reqs,
+                ssl_version=self._tls_version,
+                ciphers=self._tls_ciphers)
+
+        try:
+            self._tls_check(sslsock, host)
+        except:
+            # Wrapping detaches the plain socket on Python 3, the SSL socket
+            # is the one to close.
+            sslsock.close()
+            raise
+
+        return sslsock
+
+    def _tls_check(self, sslsock, host):
+        # After the handshake, count it and check the broker certificate.
+        _ssl_handshake_count(getattr(sslsock, 'session_reused', False))
+        if self._tls_insecure is False:
+            if not hasattr(ssl, 'match_hostname') or sys.version_info[0] < 3 or (sys.version_info[0] == 3 and sys.version_info[1] < 2):
+                self._tls_match_hostname(sslsock, host)
+            else:
+                ssl.match_hostname(sslsock.getpeercert(), host)
+
     def reconnect(self):
         """Reconnect the client after a disconnect. Can only be called after
         connect()/connect_async()."""
+        return self._reconnect(None, True)
+
+    def _reconnect(self, sock, blocking):
         if len(self._host) == 0:
             raise ValueError('Invalid host.')
         if self._port <= 0:
@@ -707,70 +1091,235 @@ class Client(object):
             "to_process": 0,
             "pos": 0}
 
-        self._out_packet_mutex.acquire()
-        self._out_packet = []
-        self._out_packet_mutex.release()
-
-        self._current_out_packet_mutex.acquire()
+        # The thread that connects is the network thread until loop() is
+        # called from somewhere else.
+        self._writer_stop()
+        # A DISCONNECT the writer finished belongs to the old socket
+        self._writer_done = collections.deque(done for done in self._writer_done
+                                              if done[0] != self._packet_disconnected)
+        self._loop_thread = threading.current_thread()
+        self._handoff_drain()
+        self._outbox_discard_packets()
+        self._out_packet = collections.deque()
         self._current_out_packet = None
-        self._current_out_packet_mutex.release()
 
-        self._msgtime_mutex.acquire()
         self._last_msg_in = time.time()
         self._last_msg_out = time.time()
-        self._msgtime_mutex.release()
 
         self._ping_t = 0
         self._state_mutex.acquire()
         self._state = mqtt_cs_new
         self._state_mutex.release()
-        if self._ssl:
-            self._ssl.close()
-            self._ssl = None
-            self._sock = None
-        elif self._sock:
-            self._sock.close()
-            self._sock = None
+        self._sock_close()
 
         # Put messages in progress in a valid state.
+        self._replay_active = False
         self._messages_reconnect_reset()
 
-        try:
-            if (sys.version_info[0] == 2 and sys.version_info[1] < 7) or (sys.version_info[0] == 3 and sys.version_info[1] < 2):
-                sock = socket.create_connection((self._host, self._port))
-            else:
-                sock = socket.create_connection((self._host, self._port), source_address=(self._bind_address, 0))
-        except socket.error as err:
-            if err.errno != errno.EINPROGRESS and err.errno != errno.EWOULDBLOCK and err.errno != EAGAIN:
+        self._connect_timing = {
+            'host': self._host,
+            'port': self._port,
+            'start': _monotonic(),
+            'dns': None,
+            'tcp': None,
+            'tls': None,
+            'websocket': None,
+            'connack': None,
+            'result': None,
+            'error': None}
+
+        if sock is None:
+            try:
+                sock = self._connect_open()
+            except:
+                self._connect_timing_done(None, sys.exc_info()[1])
                 raise
 
-        if self._tls_ca_certs is not None:
-            self._ssl = ssl.wrap_socket(
-                sock,
-                certfile=self._tls_certfile,
-                keyfile=self._tls_keyfile,
-                ca_certs=self._tls_ca_certs,
-                cert_reqs=self._tls_cert_reqs,
-                ssl_version=self._tls_version,
-                ciphers=self._tls_ciphers)
+        self._connect_begin(sock)
+        rc = self._connect_step()
 
-            if self._tls_insecure is False:
-                if sys.version_info[0] < 3 or (sys.version_info[0] == 3 and sys.version_info[1] < 2):
-                    self._tls_match_hostname()
+        # Blocking, the upgrade with a wait for the socket in between.
+        while blocking and self._connect_phase is not None:
+            sock = self._connect_sock
+            if not (HAVE_SSL and isinstance(sock, ssl.SSLSocket) and sock.pending() > 0):
+                if self._connect_want_write:
+                    select.select([], [sock], [])
                 else:
-                    ssl.match_hostname(self._ssl.getpeercert(), self._host)
+                    select.select([sock], [], [])
+            rc = self._connect_step()
+
+        return rc
+
+    def _pending_bytes(self):
+        # Bytes that can be read without waiting in select(), buffered by TLS
+        # or decoded by the websocket wrapper, with or without TLS below it.
+        if self._ssl:
+            return self._ssl.pending()
+        if isinstance(self._sock, WebsocketWrapper):
+            return self._sock.pending()
+        return 0
+
+    def _connect_finish(self, sock, websocket):
+        # sock is connected and, with TLS, the handshake done. websocket is
+        # the upgraded WebsocketWrapper, or None to upgrade now if needed.
+
+        # Packets are written whole, Nagle would only hold back CONNECT behind
+        # the last handshake record, for a delayed ACK on resumed sessions.
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        if HAVE_SSL and isinstance(sock, ssl.SSLSocket):
+            self._ssl = sock
 
         if self._use_websocket:
-            if self._tls_ca_certs is not None:
-                self._ssl = WebsocketWrapper(self._ssl, self._host, self._port, True)
+            if websocket is None:
+                websocket = WebsocketWrapper(sock, self._host, self._port, self._ssl is not None)
+            if self._ssl is not None:
+                self._ssl = websocket
             else:
-                sock = WebsocketWrapper(sock, self._host, self._port, False)
+                sock = websocket
 
         self._sock = sock
         self._sock.setblocking(0)
 
+        if self._duplex:
+            # Plain sockets can be read and written from two threads, TLS and
+            # websocket state can't.
+            self._sock_serialize = self._ssl is not None or self._use_websocket
+            self._writer_start()
+
         return self._send_connect(self._keepalive, self._clean_session)
 
+    def _connect_open(self):
+        # The TCP connect and TLS handshake of connect() and reconnect(),
+        # trying each resolved address in turn.
+        addresses = socket.getaddrinfo(self._host, self._port, 0, socket.SOCK_STREAM)
+        self._connect_timing['dns'] = _monotonic()
+
+        sock = None
+        error = socket.error('No address to connect to.')
+        for (family, socktype, proto, canonname, address) in addresses:
+            sock = socket.socket(family, socktype, proto)
+            try:
+                if self._bind_address != "" and self._bind_address is not None:
+                    sock.bind((self._bind_address, 0))
+                sock.connect(address)
+                break
+            except socket.error as err:
+                error = err
+                sock.close()
+                sock = None
+        if sock is None:
+            raise error
+        self._connect_timing['tcp'] = _monotonic()
+
+        if self._tls_ca_certs is not None:
+            sock = self.tls_wrap(sock, self._host, self._port)
+            self._connect_timing['tls'] = _monotonic()
+
+        return sock
+
+    def _connect_begin(self, sock):
+        # Start the websocket upgrade on a connected socket, if there is one.
+        self._connect_websocket = None
+        self._connect_want_write = False
+        sock.setblocking(0)
+        self._connect_sock = sock
+        self._connect_phase = connect_phase_websocket if self._use_websocket else None
+
+    def _connect_step(self):
+        # Advance the websocket upgrade until the socket would block,
+        # _connect_want_write tells which readiness to wait for. Sends CONNECT
+        # once it is done.
+        try:
+            if self._connect_phase is not None:
+                if self._connect_websocket is None:
+                    is_ssl = HAVE_SSL and isinstance(self._connect_sock, ssl.SSLSocket)
+                    self._connect_websocket = WebsocketWrapper(self._connect_sock, self._host, self._port, is_ssl, False)
+                try:
+                    self._connect_websocket.handshake_step()
+                except ssl.SSLError as err:
+                    if err.args[0] == ssl.SSL_ERROR_WANT_READ or err.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                        self._connect_want_write = err.args[0] == ssl.SSL_ERROR_WANT_WRITE
+                        return MQTT_ERR_SUCCESS
+                    raise
+                except socket.error as err:
+                    if err.errno == EAGAIN or err.errno == errno.EWOULDBLOCK:
+                        self._connect_want_write = self._connect_websocket.handshake_want_write()
+                        return MQTT_ERR_SUCCESS
+                    raise
+
+                self._connect_timing['websocket'] = _monotonic()
+                self._connect_phase = None
+        except:
+            err = sys.exc_info()[1]
+            self._connect_abort()
+            self._connect_timing_done(None, err)
+            raise
+
+        sock = self._connect_sock
+        websocket = self._connect_websocket
+        self._connect_sock = None
+        self._connect_websocket = None
+        return self._connect_finish(sock, websocket)
+
+    def _connect_timing_done(self, result, error):
+        timing = self._connect_timing
+        if timing is None:
+            return
+        self._connect_timing = None
+        timing['result'] = result
+        timing['error'] = error
+        if result is not None:
+            timing['connack'] = _monotonic()
+
+        if self._in_callback:
+            # reconnect() called from a callback, which holds the mutex
+            if self.on_connect_timing:
+                self.on_connect_timing(self, self._userdata, timing)
+            return
+
+        self._callback_mutex.acquire()
+        if self.on_connect_timing:
+            self._in_callback = True
+            self.on_connect_timing(self, self._userdata, timing)
+            self._in_callback = False
+        self._callback_mutex.release()
+
+    def _connect_abort(self):
+        self._connect_phase = None
+        self._connect_websocket = None
+        if self._connect_sock:
+            self._connect_sock.close()
+            self._connect_sock = None
+
+    def _loop_connect(self, timeout):
+        # loop() during the websocket upgrade, the socket is only waited on
+        # for the readiness the upgrade needs.
+        self._loop_thread = threading.current_thread()
+        sock = self._connect_sock
+
+        pending_bytes = 0
+        if HAVE_SSL and isinstance(sock, ssl.SSLSocket):
+            pending_bytes = sock.pending()
+        if pending_bytes > 0:
+            timeout = 0.0
+
+        if self._connect_want_write:
+            rlist, wlist = [], [sock]
+        else:
+            rlist, wlist = [sock], []
+
+        try:
+            socklist = select.select(rlist, wlist, [], timeout)
+        except (TypeError, ValueError):
+            return MQTT_ERR_CONN_LOST
+        except:
+            return MQTT_ERR_UNKNOWN
+
+        if len(socklist[0]) > 0 or len(socklist[1]) > 0 or pending_bytes > 0:
+            return self._connect_step()
+        return MQTT_ERR_SUCCESS
+
     def loop(self, timeout=1.0, max_packets=1):
         """Process network events.
 
@@ -794,22 +1343,30 @@ class Client(object):
         if timeout < 0.0:
             raise ValueError('Invalid timeout.')
 
-        self._current_out_packet_mutex.acquire()
-        self._out_packet_mutex.acquire()
-        if self._current_out_packet is None and len(self._out_packet) > 0:
-            self._current_out_packet = self._out_packet.pop(0)
+        if self._connect_phase is not None:
+            return self._loop_connect(timeout)
+
+        if self._duplex:
+            return self._loop_duplex(timeout, max_packets)
+
+        self._loop_thread = threading.current_thread()
+        self._handoff_drain()
+
+        if len(self._expiry_heap) > 0 and self._expiry_heap[0][0] <= time.time():
+            self._expire_messages()
+
+        if self._replay_active:
+            self._replay_step()
+
+        if self._current_out_packet is None:
+            self._current_out_packet = self._out_packet_next()
 
         if self._current_out_packet:
             wlist = [self.socket()]
         else:
             wlist = []
-        self._out_packet_mutex.release()
-        self._current_out_packet_mutex.release()
 
-        pending_bytes = 0
-
-        if self._ssl:
-            pending_bytes = self._ssl.pending()
+        pending_bytes = self._pending_bytes()
 
         if pending_bytes > 0:
             timeout = 0.0
@@ -838,12 +1395,14 @@ class Client(object):
             # Stimulate output write even though we didn't ask for it, because
             # at that point the publish or other command wasn't present.
             socklist[1].insert(0, self.socket())
-            # Clear sockpairR - only ever a single byte written.
+            # Clear sockpairR before the flag, so a producer that sees the
+            # flag still set has its packet picked up by loop_write().
             try:
-                self._sockpairR.recv(1)
+                self._sockpairR.recv(4096)
             except socket.error as err:
                 if err.errno != EAGAIN:
                     raise
+            self._wakeup_pending = False
 
         if self.socket() in socklist[1]:
             rc = self.loop_write(max_packets)
@@ -852,7 +1411,7 @@ class Client(object):
 
         return self.loop_misc()
 
-    def publish(self, topic, payload=None, qos=0, retain=False):
+    def publish(self, topic, payload=None, qos=0, retain=False, mid=None, expiry=None):
         """Publish a message on a topic.
 
         This causes a message to be sent to the broker and subsequently from
@@ -867,12 +1426,22 @@ class Client(object):
         qos: The quality of service level to use.
         retain: If set to true, the message will be set as the "last known
         good"/retained message for the topic.
+        mid: A message ID from reserve_mid() to use for this message. Lets the
+        caller prepare for the on_publish() callback, which may run before
+        publish() returns.
+        expiry: A time.time() value after which the message is worthless. A
+        QoS 0 message not written by then, or a QoS>0 message not acknowledged
+        by then, is dropped and on_expire() is called instead of
+        on_publish(). A QoS 2 message the broker already received (PUBREC) is
+        always completed. None keeps the message until it is delivered.
 
         Returns a tuple (result, mid), where result is MQTT_ERR_SUCCESS to
         indicate success or MQTT_ERR_NO_CONN if the client is not currently
         connected.  mid is the message ID for the publish request. The mid
         value can be used to track the publish request by checking against the
-        mid argument in the on_publish() callback if it is defined.
+        mid argument in the on_publish() callback if it is defined. If the
+        outbox limits set with outbox_limits_set() are reached, result is
+        MQTT_ERR_QUEUE_SIZE and mid is None.
 
         A ValueError will be raised if topic is None, has zero length or is
         invalid (contains a wildcard), if qos is not one of 0, 1 or 2, or if
@@ -898,10 +1467,19 @@ class Client(object):
         if self._topic_wildcard_len_check(topic) != MQTT_ERR_SUCCESS:
             raise ValueError('Publish topic cannot contain wildcards.')
 
-        local_mid = self._mid_generate()
+        outbox_size = 0
+        if self._outbox_active():
+            outbox_size = self._outbox_size(topic, local_payload)
+            if self._outbox_reserve(outbox_size) != MQTT_ERR_SUCCESS:
+                return (MQTT_ERR_QUEUE_SIZE, None)
+
+        if mid is None:
+            local_mid = self._mid_generate()
+        else:
+            local_mid = mid
 
         if qos == 0:
-            rc = self._send_publish(local_mid, topic, local_payload, qos, retain, False)
+            rc = self._send_publish(local_mid, topic, local_payload, qos, retain, False, outbox_size, expiry)
             return (rc, local_mid)
         else:
             message = MQTTMessage()
@@ -917,30 +1495,109 @@ class Client(object):
             message.qos = qos
             message.retain = retain
             message.dup = False
+            message.expiry = expiry
 
-            self._out_message_mutex.acquire()
-            self._out_messages.append(message)
-            if self._max_inflight_messages == 0 or self._inflight_messages < self._max_inflight_messages:
-                self._inflight_messages = self._inflight_messages+1
-                if qos == 1:
-                    message.state = mqtt_ms_wait_for_puback
-                elif qos == 2:
-                    message.state = mqtt_ms_wait_for_pubrec
-                self._out_message_mutex.release()
-
-                rc = self._send_publish(message.mid, message.topic, message.payload, message.qos, message.retain, message.dup)
-
-                # remove from inflight messages so it will be send after a connection is made
-                if rc is MQTT_ERR_NO_CONN:
-                    with self._out_message_mutex:
-                        self._inflight_messages -= 1
-                        message.state = mqtt_ms_publish
-
-                return (rc, local_mid)
-            else:
-                message.state = mqtt_ms_queued;
-                self._out_message_mutex.release()
-                return (MQTT_ERR_SUCCESS, local_mid)
+            if self._is_loop_thread():
+                return (self._out_message_add(message), local_mid)
+
+            # The network thread takes over the message in _handoff_drain()
+            self._out_handoff.append(message)
+            self._wakeup()
+
+            if self._sock is None and self._ssl is None:
+                return (MQTT_ERR_NO_CONN, local_mid)
+            return (MQTT_ERR_SUCCESS, local_mid)
+
+    def publish_batch(self, topic, payloads, qos=0, retain=False):
+        """Publish a sequence of messages on one topic.
+
+        The same as calling publish() for each payload, but the messages are
+        checked and encoded together. QoS>0 messages in the in-flight window
+        are sent in chunks of several messages per write, the others wait for
+        the window like single messages.
+
+        payloads: A sequence of bytearray or string payloads. They are not
+        converted, unlike in publish().
+
+        Returns a tuple (result, mids) with the result of publish() and the
+        list of message IDs, in the order of the payloads. With outbox limits
+        set, every message of the batch counts, and the whole batch is refused
+        if it doesn't fit."""
+        if topic is None or len(topic) == 0:
+            raise ValueError('Invalid topic.')
+        if qos<0 or qos>2:
+            raise ValueError('Invalid QoS level.')
+        if self._topic_wildcard_len_check(topic) != MQTT_ERR_SUCCESS:
+            raise ValueError('Publish topic cannot contain wildcards.')
+
+        payloads = list(payloads)
+        if len(payloads) == 0:
+            return (MQTT_ERR_SUCCESS, [])
+
+        # QoS 0 messages stay counted until written, QoS>0 until acknowledged
+        outbox_sizes = [0] * len(payloads)
+        if self._outbox_active():
+            outbox_sizes = [self._outbox_size(topic, payload) for payload in payloads]
+            if self._outbox_reserve(sum(outbox_sizes), len(payloads)) != MQTT_ERR_SUCCESS:
+                return (MQTT_ERR_QUEUE_SIZE, None)
+
+        mids = [self._mid_generate() for payload in payloads]
+
+        if qos == 0:
+            if self._sock is None and self._ssl is None:
+                for outbox_size in outbox_sizes:
+                    if outbox_size > 0:
+                        self._outbox_release(outbox_size)
+                return (MQTT_ERR_NO_CONN, mids)
+
+            # A packet per message, so the outbox can drop them one by one.
+            # The fixed header differs by the remaining length only.
+            utopic = topic.encode('utf-8')
+            command = struct.pack("!B", PUBLISH | retain)
+            topic_header = struct.pack("!H", len(utopic)) + utopic
+            self._easy_log(MQTT_LOG_DEBUG, "Sending "+str(len(mids))+" PUBLISH (q0, r"+str(int(retain))+", '"+topic+"', ...)")
+
+            result = MQTT_ERR_SUCCESS
+            for mid, payload, outbox_size in zip(mids, payloads, outbox_sizes):
+                if not isinstance(payload, bytearray):
+                    payload = payload.encode('utf-8')
+                packet = bytearray(command)
+                self._pack_remaining_length(packet, len(topic_header) + len(payload))
+                packet.extend(topic_header)
+                packet.extend(payload)
+
+                rc = self._packet_queue(PUBLISH, packet, mid, qos, outbox_size)
+                if result == MQTT_ERR_SUCCESS:
+                    result = rc
+            return (result, mids)
+
+        messages = []
+        now = time.time()
+        for mid, payload in zip(mids, payloads):
+            message = MQTTMessage()
+            message.timestamp = now
+            message.mid = mid
+            message.topic = topic
+            if len(payload) > 0:
+                message.payload = payload
+            message.qos = qos
+            message.retain = retain
+            messages.append(message)
+
+        if self._is_loop_thread():
+            return (self._out_messages_add_batch(messages), mids)
+
+        # The network thread takes over the messages in _handoff_drain()
+        self._out_handoff.append(messages)
+        self._wakeup()
+
+        if self._sock is None and self._ssl is None:
+            return (MQTT_ERR_NO_CONN, mids)
+        return (MQTT_ERR_SUCCESS, mids)
+
+    def reserve_mid(self):
+        """Return a new message ID to pass to publish()."""
+        return self._mid_generate()
 
     def username_pw_set(self, username, password=None):
         """Set a username and optionally a password for broker authentication.
@@ -1112,6 +1769,13 @@ class Client(object):
         if self._sock is None and self._ssl is None:
             return MQTT_ERR_NO_CONN
 
+        self._handoff_drain()
+
+        if self._duplex:
+            # The writer thread does the actual writing
+            self._writer_notify()
+            return MQTT_ERR_SUCCESS
+
         max_packets = len(self._out_packet) + 1
         if max_packets < 1:
             max_packets = 1
@@ -1128,7 +1792,9 @@ class Client(object):
         """Call to determine if there is network data waiting to be written.
         Useful if you are calling select() yourself rather than using loop().
         """
-        if self._current_out_packet or len(self._out_packet) > 0:
+        if self._connect_phase is not None:
+            return self._connect_want_write
+        if self._current_out_packet or len(self._out_packet) > 0 or len(self._out_handoff) > 0:
             return True
         else:
             return False
@@ -1151,12 +1817,7 @@ class Client(object):
         if self._ping_t > 0 and now - self._ping_t >= self._keepalive:
             # client->ping_t != 0 means we are waiting for a pingresp.
             # This hasn't happened in the keepalive time so we should disconnect.
-            if self._ssl:
-                self._ssl.close()
-                self._ssl = None
-            elif self._sock:
-                self._sock.close()
-                self._sock = None
+            self._sock_close()
 
             self._callback_mutex.acquire()
             if self._state == mqtt_cs_disconnecting:
@@ -1241,6 +1902,8 @@ class Client(object):
 
     def socket(self):
         """Return the socket or ssl object for this client."""
+        if self._connect_phase is not None:
+            return self._connect_sock
         if self._ssl:
             return self._ssl
         else:
@@ -1289,6 +1952,7 @@ class Client(object):
                 if (self._thread_terminate is True
                         and self._current_out_packet is None
                         and len(self._out_packet) == 0
+                        and len(self._out_handoff) == 0
                         and len(self._out_messages) == 0):
 
                     rc = 1
@@ -1387,12 +2051,7 @@ class Client(object):
 
     def _loop_rc_handle(self, rc):
         if rc:
-            if self._ssl:
-                self._ssl.close()
-                self._ssl = None
-            elif self._sock:
-                self._sock.close()
-                self._sock = None
+            self._sock_close()
 
             self._state_mutex.acquire()
             if self._state == mqtt_cs_disconnecting:
@@ -1423,10 +2082,7 @@ class Client(object):
         # Finally, free the memory and reset everything to starting conditions.
         if self._in_packet['command'] == 0:
             try:
-                if self._ssl:
-                    command = self._ssl.read(1)
-                else:
-                    command = self._sock.recv(1)
+                command = self._sock_recv(1)
             except socket.error as err:
                 if self._ssl and (err.errno == ssl.SSL_ERROR_WANT_READ or err.errno == ssl.SSL_ERROR_WANT_WRITE):
                     return MQTT_ERR_AGAIN
@@ -1446,10 +2102,7 @@ class Client(object):
             # http://publib.boulder.ibm.com/infocenter/wmbhelp/v6r0m0/topic/com.ibm.etools.mft.doc/ac10870_.htm
             while True:
                 try:
-                    if self._ssl:
-                        byte = self._ssl.read(1)
-                    else:
-                        byte = self._sock.recv(1)
+                    byte = self._sock_recv(1)
                 except socket.error as err:
                     if self._ssl and (err.errno == ssl.SSL_ERROR_WANT_READ or err.errno == ssl.SSL_ERROR_WANT_WRITE):
                         return MQTT_ERR_AGAIN
@@ -1477,10 +2130,7 @@ class Client(object):
 
         while self._in_packet['to_process'] > 0:
             try:
-                if self._ssl:
-                    data = self._ssl.read(self._in_packet['to_process'])
-                else:
-                    data = self._sock.recv(self._in_packet['to_process'])
+                data = self._sock_recv(self._in_packet['to_process'])
             except socket.error as err:
                 if self._ssl and (err.errno == ssl.SSL_ERROR_WANT_READ or err.errno == ssl.SSL_ERROR_WANT_WRITE):
                     return MQTT_ERR_AGAIN
@@ -1507,27 +2157,18 @@ class Client(object):
             to_process=0,
             pos=0)
 
-        self._msgtime_mutex.acquire()
         self._last_msg_in = time.time()
-        self._msgtime_mutex.release()
         return rc
 
     def _packet_write(self):
-        self._current_out_packet_mutex.acquire()
-
         while self._current_out_packet:
             packet = self._current_out_packet
 
             try:
-                if self._ssl:
-                    write_length = self._ssl.write(packet['packet'][packet['pos']:])
-                else:
-                    write_length = self._sock.send(packet['packet'][packet['pos']:])
+                write_length = self._sock_send(packet.packet, packet.pos)
             except AttributeError:
-                self._current_out_packet_mutex.release()
                 return MQTT_ERR_SUCCESS
             except socket.error as err:
-                self._current_out_packet_mutex.release()
                 if self._ssl and (err.errno == ssl.SSL_ERROR_WANT_READ or err.errno == ssl.SSL_ERROR_WANT_WRITE):
                     return MQTT_ERR_AGAIN
                 if err.errno == EAGAIN:
@@ -1536,82 +2177,254 @@ class Client(object):
                 return 1
 
             if write_length > 0:
-                packet['to_process'] = packet['to_process'] - write_length
-                packet['pos'] = packet['pos'] + write_length
+                packet.to_process = packet.to_process - write_length
+                packet.pos = packet.pos + write_length
 
-                if packet['to_process'] == 0:
-                    if (packet['command'] & 0xF0) == PUBLISH and packet['qos'] == 0:
-                        self._callback_mutex.acquire()
-                        if self.on_publish:
-                            self._in_callback = True
-                            self.on_publish(self, self._userdata, packet['mid'])
-                            self._in_callback = False
+                if packet.to_process == 0:
+                    if (packet.command & 0xF0) == PUBLISH and packet.qos == 0:
+                        if packet.outbox_size > 0:
+                            self._outbox_release(packet.outbox_size)
 
-                        self._callback_mutex.release()
+                        self._packet_callback(self._packet_published, packet)
 
-                    if (packet['command'] & 0xF0) == DISCONNECT:
-                        self._current_out_packet_mutex.release()
-
-                        self._msgtime_mutex.acquire()
+                    if (packet.command & 0xF0) == DISCONNECT:
                         self._last_msg_out = time.time()
-                        self._msgtime_mutex.release()
-
-                        self._callback_mutex.acquire()
-                        if self.on_disconnect:
-                            self._in_callback = True
-                            self.on_disconnect(self, self._userdata, 0)
-                            self._in_callback = False
-                        self._callback_mutex.release()
-
-                        if self._ssl:
-                            self._ssl.close()
-                            self._ssl = None
-                        if self._sock:
-                            self._sock.close()
-                            self._sock = None
+
+                        if self._writer_thread is threading.current_thread():
+                            # The network thread closes the socket, the writer
+                            # has nothing left to do.
+                            self._current_out_packet = None
+                            self._writer_terminate = True
+
+                        self._packet_callback(self._packet_disconnected, packet)
                         return MQTT_ERR_SUCCESS
 
-                    self._out_packet_mutex.acquire()
-                    if len(self._out_packet) > 0:
-                        self._current_out_packet = self._out_packet.pop(0)
-                    else:
-                        self._current_out_packet = None
-                    self._out_packet_mutex.release()
+                    self._current_out_packet = self._out_packet_next()
             else:
                 pass  # FIXME
 
-        self._current_out_packet_mutex.release()
-
-        self._msgtime_mutex.acquire()
         self._last_msg_out = time.time()
-        self._msgtime_mutex.release()
 
         return MQTT_ERR_SUCCESS
 
+    def _packet_callback(self, method, packet):
+        # Callbacks run on the network thread. The writer thread queues them
+        # for loop(), see _writer_done_deliver().
+        if self._writer_thread is not None and self._writer_thread is threading.current_thread():
+            self._writer_done.append((method, packet))
+            self._wakeup()
+        else:
+            method(packet)
+
+    def _packet_published(self, packet):
+        # A QoS 0 publish is written out
+        self._callback_mutex.acquire()
+        if self.on_publish:
+            self._in_callback = True
+            self.on_publish(self, self._userdata, packet.mid)
+            self._in_callback = False
+
+        self._callback_mutex.release()
+
+    def _packet_disconnected(self, packet):
+        # DISCONNECT is written out
+        self._callback_mutex.acquire()
+        if self.on_disconnect:
+            self._in_callback = True
+            self.on_disconnect(self, self._userdata, 0)
+            self._in_callback = False
+        self._callback_mutex.release()
+
+        self._sock_close()
+
+    def _writer_done_deliver(self):
+        # Called from the network thread only. Runs the callbacks of the
+        # packets the writer thread finished, returns True if one of them was
+        # DISCONNECT and the socket is closed.
+        while len(self._writer_done) > 0:
+            method, packet = self._writer_done.popleft()
+            method(packet)
+            if method == self._packet_disconnected:
+                return True
+        return False
+
+    def _sock_recv(self, bufsize):
+        # The socket is non-blocking, the lock is held for a single call only.
+        if self._sock_serialize:
+            self._sock_mutex.acquire()
+        try:
+            if self._ssl:
+                return self._ssl.read(bufsize)
+            else:
+                return self._sock.recv(bufsize)
+        finally:
+            if self._sock_serialize:
+                self._sock_mutex.release()
+
+    def _sock_send(self, data, pos):
+        if self._sock_serialize:
+            data = data[pos:pos + DUPLEX_WRITE_CHUNK]
+            self._sock_mutex.acquire()
+        else:
+            data = data[pos:]
+        try:
+            if self._ssl:
+                return self._ssl.write(data)
+            else:
+                return self._sock.send(data)
+        finally:
+            if self._sock_serialize:
+                self._sock_mutex.release()
+
+    def _sock_close(self):
+        if self._sock_serialize:
+            self._sock_mutex.acquire()
+        try:
+            self._connect_abort()
+            if self._ssl:
+                self._ssl.close()
+                self._ssl = None
+            if self._sock:
+                self._sock.close()
+                self._sock = None
+        finally:
+            if self._sock_serialize:
+                self._sock_mutex.release()
+
+    def _loop_duplex(self, timeout, max_packets):
+        # Read side of loop() in duplex mode, writing is left to the writer
+        # thread.
+        self._loop_thread = threading.current_thread()
+        self._handoff_drain()
+        if len(self._expiry_heap) > 0 and self._expiry_heap[0][0] <= time.time():
+            self._expire_messages()
+        if self._replay_active:
+            self._replay_step()
+        self._writer_notify()
+
+        if self._writer_done_deliver():
+            return MQTT_ERR_SUCCESS
+
+        if self._writer_rc:
+            rc = self._writer_rc
+            self._writer_rc = MQTT_ERR_SUCCESS
+            return self._loop_rc_handle(rc)
+
+        self._sock_mutex.acquire()
+        try:
+            pending_bytes = self._pending_bytes()
+        finally:
+            self._sock_mutex.release()
+
+        if pending_bytes > 0:
+            timeout = 0.0
+
+        rlist = [self.socket(), self._sockpairR]
+        try:
+            socklist = select.select(rlist, [], [], timeout)
+        except TypeError:
+            return MQTT_ERR_CONN_LOST
+        except ValueError:
+            return MQTT_ERR_CONN_LOST
+        except:
+            return MQTT_ERR_UNKNOWN
+
+        if self.socket() in socklist[0] or pending_bytes > 0:
+            rc = self.loop_read(max_packets)
+            if rc or (self._ssl is None and self._sock is None):
+                return rc
+
+        if self._sockpairR in socklist[0]:
+            try:
+                self._sockpairR.recv(4096)
+            except socket.error as err:
+                if err.errno != EAGAIN:
+                    raise
+            self._wakeup_pending = False
+            self._handoff_drain()
+            self._writer_notify()
+            if self._writer_done_deliver():
+                return MQTT_ERR_SUCCESS
+
+        return self.loop_misc()
+
+    def _writer_start(self):
+        self._writer_terminate = False
+        self._writer_rc = MQTT_ERR_SUCCESS
+        self._writer_thread = threading.Thread(target=self._writer_main)
+        self._writer_thread.daemon = True
+        self._writer_thread.start()
+
+    def _writer_stop(self):
+        thread = self._writer_thread
+        if thread is None:
+            return
+
+        self._writer_cond.acquire()
+        self._writer_terminate = True
+        self._writer_cond.notify()
+        self._writer_cond.release()
+
+        if thread is not threading.current_thread():
+            thread.join()
+        self._writer_thread = None
+
+    def _writer_notify(self):
+        if self._writer_thread is None:
+            return
+
+        self._writer_cond.acquire()
+        self._writer_cond.notify()
+        self._writer_cond.release()
+
+    def _writer_main(self):
+        # The writer owns _current_out_packet, the network thread appends to
+        # _out_packet and notifies.
+        while not self._writer_terminate:
+            self._writer_cond.acquire()
+            if (not self._writer_terminate
+                    and self._current_out_packet is None
+                    and len(self._out_packet) == 0):
+                self._writer_cond.wait(1.0)
+            self._writer_cond.release()
+
+            sock = self.socket()
+            if sock is None:
+                break
+
+            if self._current_out_packet is None:
+                self._current_out_packet = self._out_packet_next()
+                if self._current_out_packet is None:
+                    continue
+
+            rc = self._packet_write()
+            if rc == MQTT_ERR_AGAIN:
+                try:
+                    select.select([], [sock], [], 1.0)
+                except:
+                    pass
+            elif rc > 0:
+                # Let the network thread handle the connection loss
+                if not self._writer_terminate and self.socket() is sock:
+                    self._writer_rc = rc
+                    self._wakeup()
+                break
+
     def _easy_log(self, level, buf):
         if self.on_log:
             self.on_log(self, self._userdata, level, buf)
 
     def _check_keepalive(self):
         now = time.time()
-        self._msgtime_mutex.acquire()
         last_msg_out = self._last_msg_out
         last_msg_in = self._last_msg_in
-        self._msgtime_mutex.release()
         if (self._sock is not None or self._ssl is not None) and (now - last_msg_out >= self._keepalive or now - last_msg_in >= self._keepalive):
             if self._state == mqtt_cs_connected and self._ping_t == 0:
                 self._send_pingreq()
-                self._msgtime_mutex.acquire()
                 self._last_msg_out = now
                 self._last_msg_in = now
-                self._msgtime_mutex.release()
             else:
-                if self._ssl:
-                    self._ssl.close()
-                    self._ssl = None
-                elif self._sock:
-                    self._sock.close()
-                    self._sock = None
+                self._sock_close()
 
                 if self._state == mqtt_cs_disconnecting:
                     rc = MQTT_ERR_SUCCESS
@@ -1625,10 +2438,8 @@ class Client(object):
                 self._callback_mutex.release()
 
     def _mid_generate(self):
-        self._last_mid = self._last_mid + 1
-        if self._last_mid == 65536:
-            self._last_mid = 1
-        return self._last_mid
+        # next() on itertools.count is atomic, producers don't need a lock
+        return (next(self._mid_counter) - 1) % 65535 + 1
 
     def _topic_wildcard_len_check(self, topic):
         # Search for + or # in a topic. Return MQTT_ERR_INVAL if found.
@@ -1699,17 +2510,31 @@ class Client(object):
             else:
                 raise TypeError
 
-    def _send_publish(self, mid, topic, payload=None, qos=0, retain=False, dup=False):
+    def _send_publish(self, mid, topic, payload=None, qos=0, retain=False, dup=False, outbox_size=0, expiry=None):
         if self._sock is None and self._ssl is None:
+            if outbox_size > 0:
+                self._outbox_release(outbox_size)
             return MQTT_ERR_NO_CONN
 
+        packet = bytearray()
+        payloadlen = self._encode_publish(packet, mid, topic, payload, qos, retain, dup)
+
+        if payload is None:
+            self._easy_log(MQTT_LOG_DEBUG, "Sending PUBLISH (d"+str(dup)+", q"+str(qos)+", r"+str(int(retain))+", m"+str(mid)+", '"+topic+"' (NULL payload)")
+        else:
+            self._easy_log(MQTT_LOG_DEBUG, "Sending PUBLISH (d"+str(dup)+", q"+str(qos)+", r"+str(int(retain))+", m"+str(mid)+", '"+topic+"', ... ("+str(payloadlen)+" bytes)")
+
+        return self._packet_queue(PUBLISH, packet, mid, qos, outbox_size, expiry)
+
+    def _encode_publish(self, packet, mid, topic, payload, qos, retain, dup):
+        # Appends a PUBLISH packet to the packet bytearray, returns the
+        # payload length.
         utopic = topic.encode('utf-8')
         command = PUBLISH | ((dup&0x1)<<3) | (qos<<1) | retain
-        packet = bytearray()
         packet.extend(struct.pack("!B", command))
+        payloadlen = 0
         if payload is None:
             remaining_length = 2+len(utopic)
-            self._easy_log(MQTT_LOG_DEBUG, "Sending PUBLISH (d"+str(dup)+", q"+str(qos)+", r"+str(int(retain))+", m"+str(mid)+", '"+topic+"' (NULL payload)")
         else:
             if isinstance(payload, str):
                 upayload = payload.encode('utf-8')
@@ -1721,7 +2546,6 @@ class Client(object):
                 payloadlen = len(upayload)
 
             remaining_length = 2+len(utopic) + payloadlen
-            self._easy_log(MQTT_LOG_DEBUG, "Sending PUBLISH (d"+str(dup)+", q"+str(qos)+", r"+str(int(retain))+", m"+str(mid)+", '"+topic+"', ... ("+str(payloadlen)+" bytes)")
 
         if qos > 0:
             # For message id
@@ -1746,7 +2570,7 @@ class Client(object):
             else:
                 raise TypeError('payload must be a string, unicode or a bytearray.')
 
-        return self._packet_queue(PUBLISH, packet, mid, qos)
+        return payloadlen
 
     def _send_pubrec(self, mid):
         self._easy_log(MQTT_LOG_DEBUG, "Sending PUBREC (Mid: "+str(mid)+")")
@@ -1857,15 +2681,14 @@ class Client(object):
             self._pack_str16(packet, t)
         return (self._packet_queue(command, packet, local_mid, 1), local_mid)
 
-    def _message_retry_check_actual(self, messages, mutex):
-        mutex.acquire()
+    def _message_retry_check_actual(self, messages):
         now = time.time()
         for m in messages:
             if m.timestamp + self._message_retry < now:
                 if m.state == mqtt_ms_wait_for_puback or m.state == mqtt_ms_wait_for_pubrec:
                     m.timestamp = now
                     m.dup = True
-                    self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
+                    self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup, 0, m.expiry)
                 elif m.state == mqtt_ms_wait_for_pubrel:
                     m.timestamp = now
                     m.dup = True
@@ -1874,14 +2697,12 @@ class Client(object):
                     m.timestamp = now
                     m.dup = True
                     self._send_pubrel(m.mid, True)
-        mutex.release()
 
     def _message_retry_check(self):
-        self._message_retry_check_actual(self._out_messages, self._out_message_mutex)
-        self._message_retry_check_actual(self._in_messages, self._in_message_mutex)
+        self._message_retry_check_actual(self._out_messages)
+        self._message_retry_check_actual(self._in_messages)
 
     def _messages_reconnect_reset_out(self):
-        self._out_message_mutex.acquire()
         self._inflight_messages = 0
         for m in self._out_messages:
             m.timestamp = 0
@@ -1904,10 +2725,8 @@ class Client(object):
                         m.state = mqtt_ms_publish
             else:
                 m.state = mqtt_ms_queued
-        self._out_message_mutex.release()
 
     def _messages_reconnect_reset_in(self):
-        self._in_message_mutex.acquire()
         for m in self._in_messages:
             m.timestamp = 0
             if m.qos != 2:
@@ -1915,40 +2734,365 @@ class Client(object):
             else:
                 # Preserve current state
                 pass
-        self._in_message_mutex.release()
 
     def _messages_reconnect_reset(self):
         self._messages_reconnect_reset_out()
         self._messages_reconnect_reset_in()
 
-    def _packet_queue(self, command, packet, mid, qos):
-        mpkt = dict(
-            command = command,
-            mid = mid,
-            qos = qos,
-            pos = 0,
-            to_process = len(packet),
-            packet = packet)
+    def _packet_queue(self, command, packet, mid, qos, outbox_size=0, expiry=None):
+        return self._out_packet_queue(_OutPacket(command, mid, qos, packet, outbox_size, expiry))
+
+    def _out_packet_queue(self, mpkt):
+        if mpkt.outbox_size > 0:
+            # QoS 0 publish counted in the outbox, see _outbox_claim() and
+            # _outbox_drop_oldest().
+            if self._outbox_policy == MQTT_OUTBOX_DROP_OLDEST_QOS0:
+                self._outbox_cond.acquire()
+                self._outbox_qos0.append(mpkt)
+                self._outbox_cond.release()
+
+        if not self._is_loop_thread():
+            # The network thread moves the packet to _out_packet
+            self._out_handoff.append(mpkt)
+            self._wakeup()
+            return MQTT_ERR_SUCCESS
 
-        self._out_packet_mutex.acquire()
         self._out_packet.append(mpkt)
-        if self._current_out_packet_mutex.acquire(False):
-            if self._current_out_packet is None and len(self._out_packet) > 0:
-                self._current_out_packet = self._out_packet.pop(0)
-            self._current_out_packet_mutex.release()
-        self._out_packet_mutex.release()
+        if self._duplex:
+            self._writer_notify()
+            return MQTT_ERR_SUCCESS
+
+        if self._current_out_packet is None:
+            self._current_out_packet = self._out_packet_next()
 
+        if not self._in_callback and self._thread is None:
+            return self.loop_write()
+        else:
+            return MQTT_ERR_SUCCESS
+
+    def _out_packet_next(self):
+        # Next packet to write, skipping QoS 0 publishes dropped from the
+        # outbox and publishes past their expiry.
+        while len(self._out_packet) > 0:
+            packet = self._out_packet.popleft()
+            if packet.outbox_size > 0 and not self._outbox_claim(packet):
+                self._packet_callback(self._packet_dropped, packet)
+                continue
+            if packet.expiry is not None and packet.expiry <= time.time():
+                self._packet_callback(self._packet_expired, packet)
+                continue
+            return packet
+        return None
+
+    def _packet_dropped(self, packet):
+        # A QoS 0 publish dropped from the outbox by _outbox_drop_oldest(),
+        # already uncounted there.
+        self._callback_mutex.acquire()
+        if self.on_drop:
+            self._in_callback = True
+            self.on_drop(self, self._userdata, packet.mid)
+            self._in_callback = False
+        self._callback_mutex.release()
+
+    def _packet_expired(self, packet):
+        # A QoS>0 message is reported by _expire_messages(), only its packet
+        # is skipped here.
+        if packet.qos > 0:
+            return
+
+        self._outbox_cond.acquire()
+        self._expired_messages += 1
+        self._outbox_cond.release()
+        if packet.outbox_size > 0:
+            self._outbox_release(packet.outbox_size)
+
+        self._callback_mutex.acquire()
+        if self.on_expire:
+            self._in_callback = True
+            self.on_expire(self, self._userdata, packet.mid)
+            self._in_callback = False
+        self._callback_mutex.release()
+
+    def _expire_messages(self):
+        # Called from the network thread only. Drops the QoS>0 messages whose
+        # expiry passed before they were acknowledged.
+        heap = self._expiry_heap
+        now = time.time()
+        expired = []
+
+        while len(heap) > 0 and heap[0][0] <= now:
+            m = heapq.heappop(heap)[2]
+            # Acknowledged messages have no expiry any more, a QoS 2 message
+            # the broker received must complete.
+            if m.expiry is None or m.state == mqtt_ms_wait_for_pubcomp or m.state == mqtt_ms_resend_pubrel:
+                continue
+            m.expiry = None
+            expired.append(m)
+
+        if len(expired) == 0:
+            return MQTT_ERR_SUCCESS
+
+        removed = set(id(m) for m in expired)
+        if self._replay_active:
+            for m in self._out_messages[:self._replay_index]:
+                if id(m) in removed:
+                    self._replay_index -= 1
+        self._out_messages = [m for m in self._out_messages if id(m) not in removed]
+
+        self._outbox_cond.acquire()
+        self._expired_messages += len(expired)
+        self._outbox_cond.release()
+
+        for m in expired:
+            if m.state == mqtt_ms_wait_for_puback or m.state == mqtt_ms_wait_for_pubrec:
+                self._inflight_messages -= 1
+            if self._outbox_active():
+                self._outbox_release(self._outbox_size(m.topic, m.payload))
+
+            self._easy_log(MQTT_LOG_DEBUG, "Expired PUBLISH (Mid: "+str(m.mid)+")")
+            self._callback_mutex.acquire()
+            if self.on_expire:
+                self._in_callback = True
+                self.on_expire(self, self._userdata, m.mid)
+                self._in_callback = False
+            self._callback_mutex.release()
+
+        if self._max_inflight_messages > 0:
+            return self._update_inflight()
+        return MQTT_ERR_SUCCESS
+
+    def _expiry_acknowledged(self, m):
+        # Acknowledged messages stay in the heap until their expiry, drop them
+        # when they outnumber the pending ones.
+        m.expiry = None
+        if len(self._expiry_heap) > 2*len(self._out_messages) + 64:
+            self._expiry_heap = [entry for entry in self._expiry_heap if entry[2].expiry is not None]
+            heapq.heapify(self._expiry_heap)
+
+    def _outbox_active(self):
+        return self._outbox_max_messages > 0 or self._outbox_max_bytes > 0
+
+    def _outbox_size(self, topic, payload):
+        if payload is None:
+            return len(topic)
+        return len(topic) + len(payload)
+
+    def _outbox_full(self, size, count=1):
+        # Called with _outbox_cond held. An empty outbox always takes a
+        # message, however large.
+        if self._outbox_messages == 0:
+            return False
+        if self._outbox_max_messages > 0 and self._outbox_messages + count > self._outbox_max_messages:
+            return True
+        if self._outbox_max_bytes > 0 and self._outbox_bytes + size > self._outbox_max_bytes:
+            return True
+        return False
+
+    def _outbox_reserve(self, size, count=1):
+        self._outbox_cond.acquire()
+        try:
+            if self._outbox_full(size, count):
+                if self._outbox_policy == MQTT_OUTBOX_DROP_OLDEST_QOS0:
+                    while self._outbox_full(size, count) and self._outbox_drop_oldest():
+                        pass
+                elif self._outbox_policy == MQTT_OUTBOX_BLOCK and self._loop_thread is not threading.current_thread():
+                    # The network thread frees space, it must never wait here.
+                    deadline = time.time() + self._outbox_timeout
+                    while self._outbox_full(size, count):
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        self._outbox_cond.wait(remaining)
+
+                if self._outbox_full(size, count):
+                    return MQTT_ERR_QUEUE_SIZE
+
+            self._outbox_messages += count
+            self._outbox_bytes += size
+            return MQTT_ERR_SUCCESS
+        finally:
+            self._outbox_cond.release()
+
+    def _outbox_release(self, size):
+        self._outbox_cond.acquire()
+        self._outbox_messages = max(0, self._outbox_messages - 1)
+        self._outbox_bytes = max(0, self._outbox_bytes - size)
+        self._outbox_cond.notify_all()
+        self._outbox_cond.release()
+
+    def _outbox_claim(self, packet):
+        # A packet that is being written can't be dropped any more. Returns
+        # False if it was dropped before the network thread got to it.
+        self._outbox_cond.acquire()
+        try:
+            if packet.dropped:
+                return False
+            packet.claimed = True
+            qos0 = self._outbox_qos0
+            while len(qos0) > 0 and (qos0[0].claimed or qos0[0].dropped):
+                qos0.popleft()
+            return True
+        finally:
+            self._outbox_cond.release()
+
+    def _outbox_drop_oldest(self):
+        # Called with _outbox_cond held. The packet stays in its queue, the
+        # network thread skips it.
+        qos0 = self._outbox_qos0
+        while len(qos0) > 0:
+            packet = qos0.popleft()
+            if packet.claimed or packet.dropped:
+                continue
+            packet.dropped = True
+            packet.packet = None
+            self._outbox_messages -= 1
+            self._outbox_bytes -= packet.outbox_size
+            self._outbox_dropped += 1
+            return True
+        return False
+
+    def _outbox_discard_packets(self):
+        # Called from the network thread when the packet queue is thrown away
+        # on reconnect. QoS>0 messages stay in _out_messages and stay counted.
+        if not self._outbox_active():
+            return
+
+        packets = list(self._out_packet)
+        if self._current_out_packet is not None:
+            packets.append(self._current_out_packet)
+
+        self._outbox_cond.acquire()
+        for packet in packets:
+            if packet.outbox_size > 0 and not packet.dropped:
+                packet.dropped = True
+                self._outbox_messages = max(0, self._outbox_messages - 1)
+                self._outbox_bytes = max(0, self._outbox_bytes - packet.outbox_size)
+        self._outbox_qos0.clear()
+        self._outbox_cond.notify_all()
+        self._outbox_cond.release()
+
+    def _outbox_reset(self):
+        self._outbox_cond.acquire()
+        self._outbox_messages = 0
+        self._outbox_bytes = 0
+        self._outbox_qos0.clear()
+        self._outbox_cond.notify_all()
+        self._outbox_cond.release()
+
+    def _is_loop_thread(self):
+        return self._loop_thread is None or self._loop_thread is threading.current_thread()
+
+    def _wakeup(self):
         # Write a single byte to sockpairW (connected to sockpairR) to break
-        # out of select() if in threaded mode.
+        # out of select(). One pending byte is enough for any number of
+        # producers, loop() clears the flag when it reads the byte.
+        if self._wakeup_pending:
+            return
+        self._wakeup_pending = True
         try:
             self._sockpairW.send(sockpair_data)
         except socket.error as err:
             if err.errno != EAGAIN:
                 raise
 
-        if not self._in_callback and self._thread is None:
-            return self.loop_write()
+    def _handoff_drain(self):
+        # Called from the network thread only. Moves everything other threads
+        # queued into the packet and message queues, in order.
+        if len(self._out_handoff) == 0:
+            return
+
+        in_callback = self._in_callback
+        self._in_callback = True # Don't call loop_write after each packet
+        while len(self._out_handoff) > 0:
+            item = self._out_handoff.popleft()
+            if isinstance(item, MQTTMessage):
+                self._out_message_add(item)
+            elif isinstance(item, list):
+                self._out_messages_add_batch(item)
+            else:
+                self._out_packet.append(item)
+        self._in_callback = in_callback
+
+        if not self._duplex and self._current_out_packet is None:
+            self._current_out_packet = self._out_packet_next()
+
+    def _out_messages_add_batch(self, messages):
+        # Called from the network thread only. Like _out_message_add() for
+        # each message, but the messages in the in-flight window are encoded
+        # into packets of about REPLAY_CHUNK_BYTES. While a replay runs or
+        # while not connected they wait for _replay_step() after the older
+        # messages.
+        self._out_messages.extend(messages)
+
+        connected = self._state == mqtt_cs_connected and (self._sock is not None or self._ssl is not None)
+        if self._replay_active or not connected:
+            for message in messages:
+                message.state = mqtt_ms_publish
+            if not connected:
+                return MQTT_ERR_NO_CONN
+            return MQTT_ERR_SUCCESS
+
+        max_inflight = self._max_inflight_messages
+        now = time.time()
+        chunk = bytearray()
+        count = 0
+        rc = MQTT_ERR_SUCCESS
+
+        for message in messages:
+            message.timestamp = now
+            if max_inflight > 0 and self._inflight_messages >= max_inflight:
+                # Sent by _update_inflight() as acknowledgements come in
+                message.state = mqtt_ms_queued
+                continue
+
+            self._inflight_messages += 1
+            if message.qos == 1:
+                message.state = mqtt_ms_wait_for_puback
+            else:
+                message.state = mqtt_ms_wait_for_pubrec
+            self._encode_publish(chunk, message.mid, message.topic, message.payload, message.qos, message.retain,
+                                 message.dup)
+            count += 1
+
+            if len(chunk) >= REPLAY_CHUNK_BYTES:
+                self._easy_log(MQTT_LOG_DEBUG, "Sending "+str(count)+" PUBLISH ("+str(len(chunk))+" bytes)")
+                # PUBLISH with QoS 1 so no on_publish() is called when it is
+                # written.
+                rc = self._packet_queue(PUBLISH, chunk, 0, 1)
+                chunk = bytearray()
+                count = 0
+
+        if count > 0:
+            self._easy_log(MQTT_LOG_DEBUG, "Sending "+str(count)+" PUBLISH ("+str(len(chunk))+" bytes)")
+            rc = self._packet_queue(PUBLISH, chunk, 0, 1)
+        return rc
+
+    def _out_message_add(self, message):
+        # Called from the network thread only.
+        self._out_messages.append(message)
+        if message.expiry is not None:
+            heapq.heappush(self._expiry_heap, (message.expiry, next(self._expiry_sequence), message))
+        if self._replay_active:
+            # Sent by _replay_step() after the older messages
+            message.state = mqtt_ms_publish
+            return MQTT_ERR_SUCCESS
+        if self._max_inflight_messages == 0 or self._inflight_messages < self._max_inflight_messages:
+            self._inflight_messages = self._inflight_messages+1
+            if message.qos == 1:
+                message.state = mqtt_ms_wait_for_puback
+            elif message.qos == 2:
+                message.state = mqtt_ms_wait_for_pubrec
+
+            rc = self._send_publish(message.mid, message.topic, message.payload, message.qos, message.retain, message.dup, 0, message.expiry)
+
+            # remove from inflight messages so it will be send after a connection is made
+            if rc is MQTT_ERR_NO_CONN:
+                self._inflight_messages -= 1
+                message.state = mqtt_ms_publish
+
+            return rc
         else:
+            message.state = mqtt_ms_queued
             return MQTT_ERR_SUCCESS
 
     def _packet_handle(self):
@@ -2015,6 +3159,7 @@ class Client(object):
             self._state = mqtt_cs_connected
 
         self._easy_log(MQTT_LOG_DEBUG, "Received CONNACK ("+str(flags)+", "+str(result)+")")
+        self._connect_timing_done(result, None)
         self._callback_mutex.acquire()
         if self.on_connect:
             self._in_callback = True
@@ -2033,54 +3178,9 @@ class Client(object):
             self._in_callback = False
         self._callback_mutex.release()
         if result == 0:
-            rc = 0
-            self._out_message_mutex.acquire()
-            for m in self._out_messages:
-                m.timestamp = time.time()
-                if m.state == mqtt_ms_queued:
-                    self.loop_write() # Process outgoing messages that have just been queued up
-                    self._out_message_mutex.release()
-                    return MQTT_ERR_SUCCESS
-
-                if m.qos == 0:
-                    self._in_callback = True # Don't call loop_write after _send_publish()
-                    rc = self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
-                    self._in_callback = False
-                    if rc != 0:
-                        self._out_message_mutex.release()
-                        return rc
-                elif m.qos == 1:
-                    if m.state == mqtt_ms_publish:
-                        self._inflight_messages = self._inflight_messages + 1
-                        m.state = mqtt_ms_wait_for_puback
-                        self._in_callback = True # Don't call loop_write after _send_publish()
-                        rc = self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
-                        self._in_callback = False
-                        if rc != 0:
-                            self._out_message_mutex.release()
-                            return rc
-                elif m.qos == 2:
-                    if m.state == mqtt_ms_publish:
-                        self._inflight_messages = self._inflight_messages + 1
-                        m.state = mqtt_ms_wait_for_pubrec
-                        self._in_callback = True # Don't call loop_write after _send_publish()
-                        rc = self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
-                        self._in_callback = False
-                        if rc != 0:
-                            self._out_message_mutex.release()
-                            return rc
-                    elif m.state == mqtt_ms_resend_pubrel:
-                        self._inflight_messages = self._inflight_messages + 1
-                        m.state = mqtt_ms_wait_for_pubcomp
-                        self._in_callback = True # Don't call loop_write after _send_pubrel()
-                        rc = self._send_pubrel(m.mid, m.dup)
-                        self._in_callback = False
-                        if rc != 0:
-                            self._out_message_mutex.release()
-                            return rc
-                self.loop_write() # Process outgoing messages that have just been queued up
-            self._out_message_mutex.release()
-            return rc
+            self._tls_session_save()
+            self._replay_start()
+            return MQTT_ERR_SUCCESS
         elif result > 0 and result < 6:
             return MQTT_ERR_CONN_REFUSED
         else:
@@ -2146,9 +3246,7 @@ class Client(object):
         elif message.qos == 2:
             rc = self._send_pubrec(message.mid)
             message.state = mqtt_ms_wait_for_pubrel
-            self._in_message_mutex.acquire()
             self._in_messages.append(message)
-            self._in_message_mutex.release()
             return rc
         else:
             return MQTT_ERR_PROTOCOL
@@ -2165,7 +3263,6 @@ class Client(object):
         mid = mid[0]
         self._easy_log(MQTT_LOG_DEBUG, "Received PUBREL (Mid: "+str(mid)+")")
 
-        self._in_message_mutex.acquire()
         for i in range(len(self._in_messages)):
             if self._in_messages[i].mid == mid:
 
@@ -2175,21 +3272,87 @@ class Client(object):
                 self._in_messages.pop(i)
                 self._inflight_messages = self._inflight_messages - 1
                 if self._max_inflight_messages > 0:
-                    self._out_message_mutex.acquire()
                     rc = self._update_inflight()
-                    self._out_message_mutex.release()
                     if rc != MQTT_ERR_SUCCESS:
-                        self._in_message_mutex.release()
                         return rc
 
-                self._in_message_mutex.release()
                 return self._send_pubcomp(mid)
 
-        self._in_message_mutex.release()
         return MQTT_ERR_SUCCESS
 
+    def _tls_session_save(self):
+        # Called on CONNACK, _sock is the SSL socket even with websockets.
+        if self._ssl is None:
+            return
+        session = getattr(self._sock, 'session', None)
+        if session is not None:
+            _ssl_session_save(self._sock.context, self._host, self._port, session)
+
+    def _replay_start(self):
+        # Called on CONNACK. The messages to resend are encoded in chunks by
+        # _replay_step() from loop(), so incoming packets are handled in
+        # between and the session is usable right away.
+        self._replay_index = 0
+        self._replay_active = len(self._out_messages) > 0
+        self._replay_packet = None
+        self._replay_step()
+
+    def _replay_step(self):
+        # Encodes the next messages into one packet once the previous chunk is
+        # written. The chunk is queued behind the packets already waiting, so
+        # live traffic and replay take turns and neither starves the other.
+        # Messages that don't fit in the in-flight window are queued,
+        # _update_inflight() sends them as acknowledgements come in.
+        if self._replay_packet is not None and self._replay_packet.to_process > 0:
+            return
+
+        messages = self._out_messages
+        index = self._replay_index
+        end = min(len(messages), index + REPLAY_CHUNK_MESSAGES)
+        max_inflight = self._max_inflight_messages
+        now = time.time()
+        chunk = bytearray()
+        count = 0
+
+        while index < end and len(chunk) < REPLAY_CHUNK_BYTES:
+            m = messages[index]
+            index += 1
+
+            if m.state == mqtt_ms_resend_pubrel:
+                # Completes a flow the broker already has, sent regardless of
+                # the window.
+                self._inflight_messages += 1
+                m.state = mqtt_ms_wait_for_pubcomp
+                m.timestamp = now
+                chunk.extend(struct.pack('!BBH', PUBREL|2|((m.dup&0x1)<<3), 2, m.mid))
+                count += 1
+
+            elif m.state == mqtt_ms_publish and m.qos > 0:
+                m.timestamp = now
+                if max_inflight > 0 and self._inflight_messages >= max_inflight:
+                    m.state = mqtt_ms_queued
+                    continue
+
+                self._inflight_messages += 1
+                if m.qos == 1:
+                    m.state = mqtt_ms_wait_for_puback
+                else:
+                    m.state = mqtt_ms_wait_for_pubrec
+                self._encode_publish(chunk, m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
+                count += 1
+
+        self._replay_index = index
+        if index >= len(messages):
+            self._replay_active = False
+
+        if count > 0:
+            self._easy_log(MQTT_LOG_DEBUG, "Resending "+str(count)+" messages ("+str(len(chunk))+" bytes)")
+            # A single packet on the wire side, PUBLISH with QoS 1 so no
+            # on_publish() is called when it is written.
+            self._replay_packet = _OutPacket(PUBLISH, 0, 1, chunk)
+            self._out_packet_queue(self._replay_packet)
+
     def _update_inflight(self):
-        # Dont lock message_mutex here
         for m in self._out_messages:
             if self._inflight_messages < self._max_inflight_messages:
                 if m.qos > 0 and m.state == mqtt_ms_queued:
@@ -2198,7 +3361,8 @@ class Client(object):
                         m.state = mqtt_ms_wait_for_puback
                     elif m.qos == 2:
                         m.state = mqtt_ms_wait_for_pubrec
-                    rc = self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup)
+                    m.timestamp = time.time()
+                    rc = self._send_publish(m.mid, m.topic, m.payload, m.qos, m.retain, m.dup, 0, m.expiry)
                     if rc != 0:
                         return rc
             else:
@@ -2214,15 +3378,12 @@ class Client(object):
         mid = mid[0]
         self._easy_log(MQTT_LOG_DEBUG, "Received PUBREC (Mid: "+str(mid)+")")
 
-        self._out_message_mutex.acquire()
         for m in self._out_messages:
             if m.mid == mid:
                 m.state = mqtt_ms_wait_for_pubcomp
                 m.timestamp = time.time()
-                self._out_message_mutex.release()
                 return self._send_pubrel(mid, False)
 
-        self._out_message_mutex.release()
         return MQTT_ERR_SUCCESS
 
     def _handle_unsuback(self):
@@ -2250,35 +3411,32 @@ class Client(object):
         mid = mid[0]
         self._easy_log(MQTT_LOG_DEBUG, "Received "+cmd+" (Mid: "+str(mid)+")")
 
-        self._out_message_mutex.acquire()
         for i in range(len(self._out_messages)):
-            try:
-                if self._out_messages[i].mid == mid:
-                    # Only inform the client the message has been sent once.
-                    self._callback_mutex.acquire()
-                    if self.on_publish:
-                        self._out_message_mutex.release()
-                        self._in_callback = True
-                        self.on_publish(self, self._userdata, mid)
-                        self._in_callback = False
-                        self._out_message_mutex.acquire()
-
-                    self._callback_mutex.release()
-                    self._out_messages.pop(i)
-                    self._inflight_messages = self._inflight_messages - 1
-                    if self._max_inflight_messages > 0:
-                        rc = self._update_inflight()
-                        if rc != MQTT_ERR_SUCCESS:
-                            self._out_message_mutex.release()
-                            return rc
-                    self._out_message_mutex.release()
-                    return MQTT_ERR_SUCCESS
-            except IndexError:
-                # Have removed item so i>count.
-                # Not really an error.
-                pass
+            if self._out_messages[i].mid == mid:
+                # Remove the message first, so the client is informed only once
+                # even if the callback publishes.
+                m = self._out_messages.pop(i)
+                if m.expiry is not None:
+                    self._expiry_acknowledged(m)
+                self._inflight_messages = self._inflight_messages - 1
+                if i < self._replay_index:
+                    self._replay_index -= 1
+                if self._outbox_active():
+                    self._outbox_release(self._outbox_size(m.topic, m.payload))
+
+                self._callback_mutex.acquire()
+                if self.on_publish:
+                    self._in_callback = True
+                    self.on_publish(self, self._userdata, mid)
+                    self._in_callback = False
+                self._callback_mutex.release()
+
+                if self._max_inflight_messages > 0:
+                    rc = self._update_inflight()
+                    if rc != MQTT_ERR_SUCCESS:
+                        return rc
+                return MQTT_ERR_SUCCESS
 
-        self._out_message_mutex.release()
         return MQTT_ERR_SUCCESS
 
     def _handle_on_message(self, message):
@@ -2327,19 +3485,19 @@ class Client(object):
             else:
                 return False
 
-    def _tls_match_hostname(self):
-        cert = self._ssl.getpeercert()
+    def _tls_match_hostname(self, sslsock, host):
+        cert = sslsock.getpeercert()
         san = cert.get('subjectAltName')
         if san:
             have_san_dns = False
             for (key, value) in san:
                 if key == 'DNS':
                     have_san_dns = True
-                    if self._host_matches_cert(self._host.lower(), value.lower()) == True:
+                    if self._host_matches_cert(host.lower(), value.lower()) == True:
                         return
                 if key == 'IP Address':
                     have_san_dns = True
-                    if value.lower() == self._host.lower():
+                    if value.lower() == host.lower():
                         return
 
             if have_san_dns:
@@ -2349,7 +3507,7 @@ class Client(object):
         if subject:
             for ((key, value),) in subject:
                 if key == 'commonName':
-                    if self._host_matches_cert(self._host.lower(), value.lower()) == True:
+                    if self._host_matches_cert(host.lower(), value.lower()) == True:
                         return
 
         raise ssl.SSLError('Certificate subject does not match remote hostname.')
@@ -2360,8 +3518,62 @@ class Mosquitto(Client):
     def __init__(self, client_id="", clean_session=True, userdata=None):
         super(Mosquitto, self).__init__(client_id, clean_session, userdata)
 
+# payloads from this size on are masked with NumPy if it is installed, below
+# it the fixed cost of the arrays outweighs the XOR
+_MASK_NUMPY_MIN = 256
+
+if hasattr(int, "from_bytes"):
+    def _mask_bytes_to_int(data):
+        return int.from_bytes(bytes(data), 'big')
+
+    def _mask_int_to_bytes(value, length):
+        return value.to_bytes(length, 'big')
+else:
+    def _mask_bytes_to_int(data):
+        return int(binascii.hexlify(data), 16)
+
+    def _mask_int_to_bytes(value, length):
+        return binascii.unhexlify('%0*x' % (length * 2, value))
+
+
+def _websocket_mask(data, mask_key, offset=0):
+    """XOR data with the 4 byte websocket mask key, data[0] is masked with
+    mask_key[offset % 4]. Masking is its own inverse, so this also unmasks.
+
+    The whole buffer is XORed at once, as 32 bit words with NumPy or as one
+    big integer without it. Returns a new bytearray."""
+    length = len(data)
+    if length == 0:
+        return bytearray()
+
+    # rotate the key so that it starts at data[0]
+    shift = offset % 4
+    key = bytes(bytearray(mask_key[shift:]) + bytearray(mask_key[:shift]))
+
+    if HAVE_NUMPY and length >= _MASK_NUMPY_MIN:
+        words = length // 4
+        masked = bytearray(length)
+        view = numpy.frombuffer(masked, dtype=numpy.uint8)
+        numpy.bitwise_xor(numpy.frombuffer(bytes(data), dtype=numpy.uint32, count=words),
+                          numpy.frombuffer(key, dtype=numpy.uint32)[0],
+                          out=view[:words * 4].view(numpy.uint32))
+        tail_key = bytearray(key)
+        for index in range(words * 4, length):
+            masked[index] = data[index] ^ tail_key[index % 4]
+        return masked
+
+    repeated = (key * (length // 4 + 1))[:length]
+    return bytearray(_mask_int_to_bytes(_mask_bytes_to_int(data) ^ _mask_bytes_to_int(repeated), length))
+
+
 class WebsocketWrapper:
 
+    # bytes read per call while the upgrade response is parsed, and its limit
+    _HANDSHAKE_CHUNK = 4096
+    _HANDSHAKE_MAX = 65536
+    # bytes read per call from the frame stream
+    _RECV_CHUNK = 65536
+
     OPCODE_CONTINUATION = 0x0
     OPCODE_TEXT = 0x1
     OPCODE_BINARY = 0x2
@@ -2369,7 +3581,7 @@ class WebsocketWrapper:
     OPCODE_PING = 0x9
     OPCODE_PONG = 0xa
 
-    def __init__(self, socket, host, port, is_ssl):
+    def __init__(self, socket, host, port, is_ssl, handshake=True):
 
         self.connected = False
 
@@ -2380,88 +3592,135 @@ class WebsocketWrapper:
 
         self._sendbuffer = bytearray()
         self._readbuffer = bytearray()
-
         self._requested_size = 0
+
+        # control frame replies wait here until no data frame is half sent
+        self._controlbuffer = bytearray()
+
+        # payload of the binary frames decoded so far, the MQTT byte stream,
+        # read from _payload_head on
+        self._payloadbuffer = bytearray()
         self._payload_head = 0
-        self._readbuffer_head = 0
+        # opcode of the fragmented message in progress, None between messages
+        self._message_opcode = None
+        self._close_received = False
 
-        self._do_handshake()
+        self._handshake_out = bytearray()
+        self._handshake_in = bytearray()
+        # response headers of the upgrade, keyed by lower case name
+        self._handshake_headers = {}
+
+        self._handshake_request()
+
+        # Without handshake, the owner calls handshake_step() until it is done
+        if handshake:
+            self.handshake_step()
 
     def __del__(self):
 
         self._sendbuffer = None
         self._readbuffer = None
+        self._payloadbuffer = None
 
-    def _do_handshake(self):
+    def _handshake_request(self):
 
-        sec_websocket_key = uuid.uuid4().bytes
-        sec_websocket_key = base64.b64encode(sec_websocket_key)
+        self._sec_websocket_key = base64.b64encode(uuid.uuid4().bytes)
 
-        header = b"GET /mqtt HTTP/1.1\r\n" +\
-                 b"Upgrade: websocket\r\n" +\
-                 b"Connection: Upgrade\r\n" +\
-                 b"Host: " + str(self._host).encode('utf-8') + b":" + str(self._port).encode('utf-8') + b"\r\n" +\
-                 b"Origin: http://" + str(self._host).encode('utf-8') + b":" + str(self._port).encode('utf-8') + b"\r\n" +\
-                 b"Sec-WebSocket-Key: " + sec_websocket_key + b"\r\n" +\
-                 b"Sec-WebSocket-Version: 13\r\n\r\n"
+        self._handshake_out.extend(
+            b"GET /mqtt HTTP/1.1\r\n" +\
+            b"Upgrade: websocket\r\n" +\
+            b"Connection: Upgrade\r\n" +\
+            b"Host: " + str(self._host).encode('utf-8') + b":" + str(self._port).encode('utf-8') + b"\r\n" +\
+            b"Origin: http://" + str(self._host).encode('utf-8') + b":" + str(self._port).encode('utf-8') + b"\r\n" +\
+            b"Sec-WebSocket-Key: " + self._sec_websocket_key + b"\r\n" +\
+            b"Sec-WebSocket-Version: 13\r\n\r\n")
 
-        if self._ssl:
-            self._socket.write(header)
-        else:
-            self._socket.send(header)
+    def _handshake_response(self, response):
 
-        has_secret = False
-        has_upgrade = False
+        lines = response.decode('latin-1').split("\r\n")
 
-        while True:
-            # read HTTP response header as lines
+        status = lines[0].split(" ", 2)
+        if len(status) < 2 or status[1] != "101":
+            raise ValueError("WebSocket handshake error, status " + lines[0])
+
+        for line in lines[1:]:
+            name, separator, value = line.partition(":")
+            if not separator:
+                raise ValueError("WebSocket handshake error, malformed header " + line)
+            name = name.strip().lower()
+            value = value.strip()
+            # repeated headers are joined as a list
+            if name in self._handshake_headers:
+                value = self._handshake_headers[name] + ", " + value
+            self._handshake_headers[name] = value
+
+        # check upgrade
+        connection = [token.strip() for token in self._handshake_headers.get("connection", "").lower().split(",")]
+        if "upgrade" not in connection:
+            raise ValueError("WebSocket handshake error, connection not upgraded")
+
+        # check key hash
+        GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+        server_hash = self._handshake_headers.get("sec-websocket-accept", "").encode('utf-8')
+
+        client_hash = self._sec_websocket_key.decode('utf-8') + GUID
+        client_hash = hashlib.sha1(client_hash.encode('utf-8'))
+        client_hash = base64.b64encode(client_hash.digest())
+
+        if server_hash != client_hash:
+            raise ValueError("WebSocket handshake error, invalid secret key")
+
+    def handshake_want_write(self):
+        """True while a part of the upgrade request is still unsent."""
+        return len(self._handshake_out) > 0
+
+    def handshake_step(self):
+        """Advance the upgrade handshake as far as the socket allows.
+
+        Blocks until the handshake is complete on a blocking socket. On a
+        non-blocking one the socket.error EAGAIN or ssl.SSLError WANT_READ or
+        WANT_WRITE of the socket is raised when it has to be waited for, and
+        handshake_step() is called again once it is ready. Raises ValueError
+        if the broker refused the upgrade."""
+
+        while len(self._handshake_out) > 0:
             if self._ssl:
-                byte = self._socket.read(1)
+                length = self._socket.write(self._handshake_out)
             else:
-                byte = self._socket.recv(1)
-
-            self._readbuffer.extend(byte)
-            # line end
-            if byte == b"\n":
-                if len(self._readbuffer) > 2:
-                    # check upgrade
-                    if b"connection" in str(self._readbuffer).lower().encode('utf-8'):
-                        if b"upgrade" not in str(self._readbuffer).lower().encode('utf-8'):
-                            raise ValueError("WebSocket handshake error, connection not upgraded")
-                        else:
-                            has_upgrade = True
-
-                    # check key hash
-                    if b"sec-websocket-accept" in str(self._readbuffer).lower().encode('utf-8'):
-                        GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
-
-                        server_hash = self._readbuffer.decode('utf-8').split(": ", 1)[1]
-                        server_hash = server_hash.strip().encode('utf-8')
-
-                        client_hash = sec_websocket_key.decode('utf-8') + GUID
-                        client_hash = hashlib.sha1(client_hash.encode('utf-8'))
-                        client_hash = base64.b64encode(client_hash.digest())
-
-                        if server_hash != client_hash:
-                            raise ValueError("WebSocket handshake error, invalid secret key")
-                        else:
-                            has_secret = True
-                else:
-                    # ending linebreak
-                    break
+                length = self._socket.send(self._handshake_out)
+            del self._handshake_out[:length]
 
-                # reset linebuffer
-                self._readbuffer = bytearray()
+        while not self.connected:
+            # read the HTTP response in chunks until the blank line after the
+            # headers, only the new bytes and the 3 before them are searched
+            if self._ssl:
+                data = self._socket.read(self._HANDSHAKE_CHUNK)
+            else:
+                data = self._socket.recv(self._HANDSHAKE_CHUNK)
 
             # connection reset
-            elif not byte:
+            if not data:
                 raise ValueError("WebSocket handshake error")
 
-        if not has_upgrade or not has_secret:
-            raise ValueError("WebSocket handshake error")
+            searched = max(len(self._handshake_in) - 3, 0)
+            self._handshake_in.extend(data)
+            headers_end = self._handshake_in.find(b"\r\n\r\n", searched)
 
-        self._readbuffer = bytearray()
-        self.connected = True
+            if headers_end < 0:
+                if len(self._handshake_in) > self._HANDSHAKE_MAX:
+                    raise ValueError("WebSocket handshake error, response header too long")
+                continue
+
+            self._handshake_response(bytes(self._handshake_in[:headers_end]))
+
+            # bytes after the headers are the start of the frame stream
+            self._readbuffer = self._handshake_in[headers_end + 4:]
+            self._handshake_in = bytearray()
+            self.connected = True
+            self._decode_frames()
+
+        return True
 
     def _create_frame(self, opcode, data, do_masking=1):
 
@@ -2488,124 +3747,152 @@ class WebsocketWrapper:
             raise ValueError("Maximum payload size is 2^63")
 
         if mask_flag == 1:
-            for index in range(length):
-                data[index] ^= mask_key[index % 4]
-            data = mask_key + data
+            data = mask_key + _websocket_mask(data, mask_key)
 
         return header + data
 
-    def _buffered_read(self, length):
+    def _decode_frames(self):
 
-        # try to recv and strore needed bytes
-        if self._readbuffer_head + length > len(self._readbuffer):
+        # decode every complete frame in the read buffer, an incomplete one
+        # stays buffered until the rest of it arrives
+        readbuffer = self._readbuffer
+        position = 0
 
-            if self._ssl:
-                data = self._socket.read(self._readbuffer_head + length - len(self._readbuffer))
-            else:
-                data = self._socket.recv(self._readbuffer_head + length - len(self._readbuffer))
+        while not self._close_received and len(readbuffer) - position >= 2:
 
-            if not data:
-                raise socket.error(errno.ECONNABORTED, 0)
-            else:
-                self._readbuffer.extend(data)
+            header1 = readbuffer[position]
+            header2 = readbuffer[position + 1]
 
-        self._readbuffer_head += length
-        return self._readbuffer[self._readbuffer_head-length:self._readbuffer_head]
+            final = (header1 & 0x80) == 0x80
+            opcode = (header1 & 0x0f)
+            maskbit = (header2 & 0x80) == 0x80
+            payload_length = (header2 & 0x7f)
+            payload_start = position + 2
 
-    def _recv_impl(self, length):
+            # read length
+            if payload_length == 0x7e:
+                if len(readbuffer) < payload_start + 2:
+                    break
+                payload_length = struct.unpack_from("!H", readbuffer, payload_start)[0]
+                payload_start += 2
 
-        # try to decode websocket payload part from data
-        try:
+            elif payload_length == 0x7f:
+                if len(readbuffer) < payload_start + 8:
+                    break
+                payload_length = struct.unpack_from("!Q", readbuffer, payload_start)[0]
+                payload_start += 8
 
-            self._readbuffer_head = 0
+            # read mask
+            mask_key = None
+            if maskbit:
+                if len(readbuffer) < payload_start + 4:
+                    break
+                mask_key = readbuffer[payload_start:payload_start + 4]
+                payload_start += 4
 
-            result = None
+            if len(readbuffer) < payload_start + payload_length:
+                break
 
-            chunk_startindex = self._payload_head
-            chunk_endindex = self._payload_head + length
+            payload = readbuffer[payload_start:payload_start + payload_length]
+            if maskbit:
+                payload = _websocket_mask(payload, mask_key)
 
-            header1 = self._buffered_read(1)
-            header2 = self._buffered_read(1)
+            position = payload_start + payload_length
+            self._handle_frame(final, opcode, payload)
 
-            opcode = (header1[0] & 0x0f)
-            maskbit = (header2[0] & 0x80) == 0x80
-            lengthbits = (header2[0] & 0x7f)
-            payload_length = lengthbits
-            mask_key = None
+        del readbuffer[:position]
 
-            # read length
-            if lengthbits == 0x7e:
+    def _handle_frame(self, final, opcode, payload):
 
-                value = self._buffered_read(2)
-                payload_length = struct.unpack("!H", value)[0]
+        # control frames may arrive between the fragments of a message
+        if opcode == WebsocketWrapper.OPCODE_CONNCLOSE:
+            self._close_received = True
+            self._controlbuffer.extend(self._create_frame(WebsocketWrapper.OPCODE_CONNCLOSE, payload[:2]))
 
-            elif lengthbits == 0x7f:
+        elif opcode == WebsocketWrapper.OPCODE_PING:
+            self._controlbuffer.extend(self._create_frame(WebsocketWrapper.OPCODE_PONG, payload))
 
-                value = self._buffered_read(8)
-                payload_length = struct.unpack("!Q", value)[0]
+        elif opcode == WebsocketWrapper.OPCODE_PONG:
+            pass
 
-            # read mask
-            if maskbit:
+        else:
+            if opcode != WebsocketWrapper.OPCODE_CONTINUATION:
+                self._message_opcode = opcode
 
-                mask_key = self._buffered_read(4)
+            # only binary messages carry MQTT, text messages are dropped
+            if self._message_opcode == WebsocketWrapper.OPCODE_BINARY:
+                self._payloadbuffer.extend(payload)
 
-            # if frame payload is shorter than the requested data, read only the possible part
-            readindex = chunk_endindex
-            if payload_length < readindex:
-                readindex = payload_length
+            if final:
+                self._message_opcode = None
 
-            if readindex > 0:
+    def _flush_control(self):
 
-                # get payload chunk
-                payload = self._buffered_read(readindex)
+        # control frames go out between data frames only
+        if len(self._controlbuffer) == 0 or len(self._sendbuffer) > 0:
+            return
 
-                # unmask only the needed part
-                if maskbit:
-                    for index in range(chunk_startindex, readindex):
-                        payload[index] ^= mask_key[index % 4]
+        try:
+            if self._ssl:
+                length = self._socket.write(self._controlbuffer)
+            else:
+                length = self._socket.send(self._controlbuffer)
+        except socket.error as err:
+            # the rest goes out with the next data frame
+            if err.errno in (EAGAIN, errno.EWOULDBLOCK):
+                return
+            if self._ssl and err.errno in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                return
+            raise
 
-                result = payload[chunk_startindex:readindex]
-                self._payload_head = readindex
+        del self._controlbuffer[:length]
 
-            # check if full frame arrived and reset readbuffer and payloadhead if needed
-            if readindex == payload_length:
-                self._readbuffer = bytearray()
-                self._payload_head = 0
+    def _recv_impl(self, length):
 
-                # respond to non-binary opcodes, their arrival is not guaranteed beacause of non-blocking sockets
-                if opcode == WebsocketWrapper.OPCODE_CONNCLOSE:
-                    frame = self._create_frame(WebsocketWrapper.OPCODE_CONNCLOSE, payload, 0)
-                    if self._ssl:
-                        self._socket.write(frame)
-                    else:
-                        self._socket.send(frame)
+        # return payload bytes already decoded, read from the socket only if
+        # there are none, once per call like a socket does
+        while self._payload_head == len(self._payloadbuffer):
 
-                if opcode == WebsocketWrapper.OPCODE_PING:
-                    frame = self._create_frame(WebsocketWrapper.OPCODE_PONG, payload, 0)
-                    if self._ssl:
-                        self._socket.write(frame)
-                    else:
-                        self._socket.send(frame)
+            if self._close_received or not self.connected:
+                self._flush_control()
+                self.connected = False
+                return b''
 
-            if opcode == WebsocketWrapper.OPCODE_BINARY:
-                return result
+            if self._ssl:
+                data = self._socket.read(self._RECV_CHUNK)
             else:
-                raise socket.error(errno.EAGAIN, 0)
+                data = self._socket.recv(self._RECV_CHUNK)
 
-        except socket.error as err:
-
-            if err.errno == errno.ECONNABORTED:
+            if not data:
                 self.connected = False
                 return b''
-            else:
-                # no more data
-                raise
+
+            # compact the payload buffer before it grows
+            del self._payloadbuffer[:self._payload_head]
+            self._payload_head = 0
+
+            self._readbuffer.extend(data)
+            self._decode_frames()
+            self._flush_control()
+
+            # a read that completed no binary frame is reported as such
+            if self._payload_head == len(self._payloadbuffer) and not self._close_received:
+                raise socket.error(errno.EAGAIN, 0)
+
+        result = self._payloadbuffer[self._payload_head:self._payload_head + length]
+        self._payload_head += len(result)
+
+        return result
 
     def _send_impl(self, data):
 
         # if previous frame was sent successfully
         if len(self._sendbuffer) == 0:
 
+            # control frame replies still waiting go out first
+            self._sendbuffer.extend(self._controlbuffer)
+            del self._controlbuffer[:]
+
             # create websocket frame
             frame = self._create_frame(WebsocketWrapper.OPCODE_BINARY, bytearray(data))
             self._sendbuffer.extend(frame)
@@ -2644,5 +3931,13 @@ class WebsocketWrapper:
     def fileno(self):
         return self._socket.fileno()
 
+    def pending(self):
+        # decoded payload can be read without waiting for the socket, the read
+        # buffer only ever holds an incomplete frame
+        buffered = len(self._payloadbuffer) - self._payload_head
+        if self._ssl:
+            return buffered + self._socket.pending()
+        return buffered
+
     def setblocking(self,flag):
         self._socket.setblocking(flag)
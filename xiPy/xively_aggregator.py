@@ -0,0 +1,248 @@
+# Copyright (c) 2003-2016, Xively. All rights reserved.
+# This is part of Xively Python library, it is under the BSD 3-Clause license.
+
+import array
+import threading
+from .xively_timeseries import pack_samples
+
+class XivelyAggregator:
+
+    """XivelyAggregator turns the samples of timeseries topics into window statistics.
+
+    Windows are aligned to multiples of the slide on the time.time() clock. A tumbling window has slide equal to
+    window, a sliding window a shorter slide that divides the window. A window is made of window / slide panes, each
+    pane keeps the running count, sum, minimum, maximum and last value of its samples in preallocated arrays, so a
+    sample costs a few array updates and no allocation.
+
+    When a window closes, publish(topic, payload, qos) is called with the count, minimum, maximum, mean and last value
+    packed as five 4 byte floats in that order, see xively_timeseries.unpack_samples(). Windows without samples are
+    not published. The owner calls flush() from its timer, next_close() tells when."""
+
+    # order of the published statistics
+    STATISTICS = ("count", "min", "max", "mean", "last")
+
+    def __init__(self, publish):
+
+        """
+        publish -- function called with topic, payload and qos for every closed window"""
+
+        self._publish = publish
+        self._mutex = threading.Lock()
+        self._windows = {}
+
+
+    def add_topic(self, topic, window, slide=None, qos=0):
+
+        """start aggregating a topic, the statistics of a window already open on the topic are dropped
+
+        window -- length of the window in seconds
+        slide -- seconds between windows, None or window for tumbling windows, must divide window
+        qos -- quality of service level of the published statistics"""
+
+        if slide is None:
+            slide = window
+
+        if window <= 0 or slide <= 0 or slide > window:
+            raise ValueError("invalid window or slide")
+
+        panes = int(round(window / float(slide)))
+
+        if abs(panes * slide - window) > 1e-9 * window:
+            raise ValueError("slide must divide window")
+
+        with self._mutex:
+            self._windows[topic] = _Window(topic, float(slide), panes, qos)
+
+
+    def remove_topic(self, topic):
+
+        """stop aggregating a topic, the open window is dropped"""
+
+        with self._mutex:
+            self._windows.pop(topic, None)
+
+
+    def add(self, topic, value, now):
+
+        """add a sample to the open window of a topic
+
+        returns -- False if the topic is not aggregated"""
+
+        with self._mutex:
+
+            window = self._windows.get(topic)
+            if window is None:
+                return False
+
+            closed = window.add(value, now)
+
+        self._publish_closed(closed)
+        return True
+
+
+    def add_many(self, topic, values, now):
+
+        """add a batch of samples to the open window of a topic
+
+        returns -- False if the topic is not aggregated"""
+
+        with self._mutex:
+
+            window = self._windows.get(topic)
+            if window is None:
+                return False
+
+            closed = window.advance(now)
+            for value in values:
+                window.update(value)
+
+        self._publish_closed(closed)
+        return True
+
+
+    def flush(self, now):
+
+        """publish the windows closed by now"""
+
+        closed = []
+
+        with self._mutex:
+            for window in self._windows.values():
+                closed.extend(window.advance(now))
+
+        self._publish_closed(closed)
+
+
+    def next_close(self):
+
+        """returns -- time.time() value when the next window with samples closes, or None"""
+
+        with self._mutex:
+            closes = [window.closes() for window in self._windows.values() if window.pending()]
+
+        if not closes:
+            return None
+
+        return min(closes)
+
+
+    def _publish_closed(self, closed):
+
+        # outside of the lock, publish may block on a full outbox
+        for topic, qos, statistics in closed:
+            self._publish(topic, pack_samples(statistics), qos)
+
+
+class _Window(object):
+
+    # state of one topic, the pane of epoch e is at index e % panes
+
+    __slots__ = ("topic", "slide", "panes", "qos", "epoch", "counts", "sums", "mins", "maxs", "lasts")
+
+    def __init__(self, topic, slide, panes, qos):
+
+        self.topic = topic
+        self.slide = slide
+        self.panes = panes
+        self.qos = qos
+        self.epoch = None
+        self.counts = array.array('l', [0] * panes)
+        self.sums = array.array('d', [0.0] * panes)
+        self.mins = array.array('d', [0.0] * panes)
+        self.maxs = array.array('d', [0.0] * panes)
+        self.lasts = array.array('d', [0.0] * panes)
+
+
+    def add(self, value, now):
+
+        closed = self.advance(now)
+        self.update(value)
+        return closed
+
+
+    def update(self, value):
+
+        index = self.epoch % self.panes
+        count = self.counts[index]
+
+        if count == 0:
+            self.mins[index] = value
+            self.maxs[index] = value
+        elif value < self.mins[index]:
+            self.mins[index] = value
+        elif value > self.maxs[index]:
+            self.maxs[index] = value
+
+        self.counts[index] = count + 1
+        self.sums[index] += value
+        self.lasts[index] = value
+
+
+    def advance(self, now):
+
+        # close the windows that ended by now, returns their (topic, qos, statistics). Most samples close nothing, the
+        # empty tuple is shared
+        epoch = int(now // self.slide)
+
+        if self.epoch is None:
+            self.epoch = epoch
+            return ()
+
+        if self.epoch >= epoch:
+            return ()
+
+        closed = []
+
+        while self.epoch < epoch:
+
+            if not self.pending():
+                # nothing left to publish, skip the empty windows
+                self.epoch = epoch
+                break
+
+            closed.append((self.topic, self.qos, self.statistics()))
+
+            self.epoch += 1
+            index = self.epoch % self.panes
+            self.counts[index] = 0
+            self.sums[index] = 0.0
+
+        return closed
+
+
+    def pending(self):
+
+        return self.epoch is not None and any(self.counts)
+
+
+    def closes(self):
+
+        return (self.epoch + 1) * self.slide
+
+
+    def statistics(self):
+
+        count = 0
+        total = 0.0
+        minimum = None
+        maximum = None
+        last = 0.0
+
+        # oldest pane first, so last comes from the newest pane with samples
+        for epoch in range(self.epoch - self.panes + 1, self.epoch + 1):
+
+            index = epoch % self.panes
+            pane_count = self.counts[index]
+            if pane_count == 0:
+                continue
+
+            if minimum is None or self.mins[index] < minimum:
+                minimum = self.mins[index]
+            if maximum is None or self.maxs[index] > maximum:
+                maximum = self.maxs[index]
+
+            count += pane_count
+            total += self.sums[index]
+            last = self.lasts[index]
+
+        return (count, minimum, maximum, total / count, last)
@@ -0,0 +1,297 @@
+# Copyright (c) 2003-2016, Xively. All rights reserved.
+# This is part of Xively Python library, it is under the BSD 3-Clause license.
+
+import sys
+import time
+import struct
+import threading
+
+# length prefix of a record in a batch payload
+_RECORD_HEADER = struct.Struct("!I")
+
+class XivelyBatcher:
+
+    """XivelyBatcher collects small publishes to the same topic into one message.
+
+    A batch is a payload of records, each one a 4 byte big endian length followed by the original payload. The batch
+    of a topic is published when it has been open for linger seconds or reaches max_bytes, whichever comes first,
+    or when a publish with a different qos or retain flag arrives. Subscribers split it with decode_batch().
+
+    The owner calls flush() from its timer, next_flush() tells when. publish(topic, payload, qos, retain) is called
+    for every closed batch."""
+
+    def __init__(self, publish):
+
+        """
+        publish -- function called with topic, payload, qos and retain for every closed batch"""
+
+        self._publish = publish
+        self._mutex = threading.Lock()
+        # (linger, max_bytes) by topic
+        self._topics = {}
+        # open batches by topic
+        self._batches = {}
+
+        self._records = 0
+        self._batched = 0
+
+
+    def add_topic(self, topic, linger, max_bytes):
+
+        """batch the publishes to a topic, checked the way the mqtt client checks a publish topic
+
+        linger -- seconds a batch stays open at most
+        max_bytes -- size of the batch payload that closes it"""
+
+        if topic is None or len(topic) == 0:
+            raise ValueError('Invalid topic.')
+
+        if '+' in topic or '#' in topic:
+            raise ValueError('Publish topic cannot contain wildcards.')
+
+        with self._mutex:
+            self._topics[topic] = (linger, max_bytes)
+
+
+    def remove_topic(self, topic):
+
+        """stop batching a topic, its open batch is published"""
+
+        with self._mutex:
+            self._topics.pop(topic, None)
+            closed = self._close(topic)
+
+        self._publish_closed(closed)
+
+
+    def add(self, topic, payload, qos, retain, now):
+
+        """add a publish to the open batch of its topic, payload and qos are checked the way the mqtt client checks
+        them, the batch is published later
+
+        returns -- False if the topic is not batched"""
+
+        with self._mutex:
+
+            settings = self._topics.get(topic)
+            if settings is None:
+                return False
+
+            if qos < 0 or qos > 2:
+                raise ValueError('Invalid QoS level.')
+
+            linger, max_bytes = settings
+            record = _encode_payload(payload)
+            closed = []
+
+            batch = self._batches.get(topic)
+
+            if batch is not None and (batch.qos != qos or batch.retain != retain or
+                                      len(batch.buffer) + _RECORD_HEADER.size + len(record) > max_bytes):
+                closed = self._close(topic)
+                batch = None
+
+            if batch is None:
+                batch = _Batch(qos, retain, now + linger)
+                self._batches[topic] = batch
+
+            batch.buffer.extend(_RECORD_HEADER.pack(len(record)))
+            batch.buffer.extend(record)
+            self._records += 1
+
+            if len(batch.buffer) >= max_bytes:
+                closed.extend(self._close(topic))
+
+        self._publish_closed(closed)
+        return True
+
+
+    def flush(self, now=None):
+
+        """publish the batches that lingered long enough, or all of them if now is None"""
+
+        with self._mutex:
+
+            closed = []
+
+            for topic, batch in list(self._batches.items()):
+                if now is None or batch.deadline <= now:
+                    closed.extend(self._close(topic))
+
+        self._publish_closed(closed)
+
+
+    def flush_topic(self, topic):
+
+        """publish the open batch of a topic"""
+
+        with self._mutex:
+            closed = self._close(topic)
+
+        self._publish_closed(closed)
+
+
+    def next_flush(self):
+
+        """returns -- time.time() value when the oldest open batch is due, or None"""
+
+        with self._mutex:
+
+            if not self._batches:
+                return None
+
+            return min(batch.deadline for batch in self._batches.values())
+
+
+    def get_statistics(self):
+
+        """returns -- a dict with the number of open batches and counters of batched records and published batches"""
+
+        with self._mutex:
+
+            return {
+                "open": len(self._batches),
+                "records": self._records,
+                "batches": self._batched }
+
+
+    def _close(self, topic):
+
+        # called with the mutex held, returns the closed batch as a list of (topic, payload, qos, retain)
+        batch = self._batches.pop(topic, None)
+
+        if batch is None:
+            return []
+
+        self._batched += 1
+        return [(topic, batch.buffer, batch.qos, batch.retain)]
+
+
+    def _publish_closed(self, closed):
+
+        # outside of the lock, publish may block on a full outbox
+        for topic, payload, qos, retain in closed:
+            self._publish(topic, payload, qos, retain)
+
+
+class _Batch(object):
+
+    __slots__ = ("qos", "retain", "deadline", "buffer")
+
+    def __init__(self, qos, retain, deadline):
+
+        self.qos = qos
+        self.retain = retain
+        self.deadline = deadline
+        self.buffer = bytearray()
+
+
+def _encode_payload(payload):
+
+    # the conversions of the mqtt client publish
+    if payload is None:
+        return b""
+
+    if isinstance(payload, bytearray):
+        return payload
+
+    if isinstance(payload, int) or isinstance(payload, float):
+        payload = str(payload)
+
+    if sys.version_info[0] < 3 and isinstance(payload, str):
+        return payload
+
+    if isinstance(payload, str) or (sys.version_info[0] < 3 and isinstance(payload, unicode)):
+        return payload.encode("utf-8")
+
+    raise TypeError('payload must be a string, bytearray, int, float or None.')
+
+
+def decode_batch(payload):
+
+    """split the payload of a batch published by a XivelyBatcher into its records
+
+    payload -- bytes or bytearray
+
+    returns -- a list of bytearray records, or None if the payload is empty or not a valid batch. A batch has at
+               least one record, so an empty message is delivered as it is"""
+
+    if not payload:
+        return None
+
+    payload = bytearray(payload)
+    records = []
+    position = 0
+    size = len(payload)
+
+    while position < size:
+
+        if position + _RECORD_HEADER.size > size:
+            return None
+
+        length = _RECORD_HEADER.unpack_from(payload, position)[0]
+        position += _RECORD_HEADER.size
+
+        if position + length > size:
+            return None
+
+        records.append(payload[position:position + length])
+        position += length
+
+    return records
+
+
+# one publish per message against batches, over a local socket that discards everything
+def _benchmark(messages=100000, payload_size=32):
+
+    import socket
+    from .paho_mqtt_client import Client
+    from .xively_client import XivelyClient
+
+    listensock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listensock.bind(("127.0.0.1", 0))
+    listensock.listen(1)
+
+    def sink():
+        conn, address = listensock.accept()
+        while conn.recv(65536):
+            pass
+        conn.close()
+
+    sink_thread = threading.Thread(target = sink)
+    sink_thread.daemon = True
+    sink_thread.start()
+
+    client = XivelyClient()
+    client._mqtt = Client("batcher")
+    client._mqtt.connect("127.0.0.1", listensock.getsockname()[1])
+
+    payload = bytearray(payload_size)
+
+    def run(topic):
+        start = time.time()
+        for index in range(messages):
+            client.publish(topic, payload, 0, False)
+            if index % 1000 == 0:
+                client._mqtt.loop(0)
+        if client._batcher is not None:
+            client._batcher.flush()
+        while client._mqtt.want_write():
+            client._mqtt.loop(0.01)
+        return time.time() - start
+
+    single = run("batcher/single")
+
+    client.batch_topic("batcher/batched", 0.005, 16384)
+    batched = run("batcher/batched")
+
+    client._mqtt.disconnect()
+
+    print("%d messages of %d bytes, single %.0f/s, batched %.0f/s, %d batches" %
+          (messages, payload_size, messages / single, messages / batched,
+           client._batcher.get_statistics()["batches"]))
+
+
+# for standalone testing
+if __name__ == '__main__':
+    _benchmark()
@@ -61,6 +61,11 @@ class XivelyCallbackHandler:
         self.delegate.on_publish_finished(self.delegate, requestid)
 
 
+    def on_connect_timing(self, timing):
+
+        self.delegate.on_connect_timing(self.delegate, timing)
+
+
     def add_listener(self, topic, listener):
 
         if topic not in self.topicsToListeners:
@@ -4,20 +4,40 @@
 import os
 import sys
 import ssl
+import heapq
+import itertools
 import struct
 import time
 import threading
 from socket import error as socketerror
+from socket import timeout as sockettimeout
 from . import paho_mqtt_client
+from .xively_aggregator import XivelyAggregator
 from .xively_callback_handler import XivelyCallbackHandler
 from .paho_mqtt_client import Client
 from .paho_mqtt_client import MQTT_ERR_SUCCESS
+from .paho_mqtt_client import MQTT_ERR_QUEUE_SIZE
+from .paho_mqtt_client import topic_matches_sub
 from .xively_backoff import XivelyBackoff
+from .xively_batcher import XivelyBatcher, decode_batch
 from .xively_config import XivelyConfig
+from .xively_connect_timing import XivelyConnectTimings
+from .xively_connector import XivelyConnector
+from .xively_deadband import XivelyDeadband
+from .xively_dispatcher import XivelyDispatcher
 from .xively_message import XivelyMessage
+from .xively_message import XivelyMessagePool
+from .xively_publish_future import XivelyPublishFuture
+from .xively_resolver import XivelyResolver
 from .xively_error_codes import XivelyErrorCodes as xec
+from .xively_journal import XivelyJournal
+from .xively_store_forward import XivelyStoreForward
+from .xively_timeseries import encode_csv_rows, pack_samples, split_samples
 from .xively_version import XivelyClientVersion
 
+# monotonic clock if available (py3), wall clock on py2.7
+_monotonic = getattr(time, "monotonic", time.time)
+
 def return_if_inactive( *ret_args ):
     """
     This is a decorator that returns proper value if the main thread has been
@@ -34,6 +54,21 @@ def return_if_inactive( *ret_args ):
     return return_if_inactive_body
 
 
+def return_if_cannot_publish( *ret_args ):
+    """
+    This is a decorator for the publish functions. It works like return_if_inactive, but lets the call through while
+    the client is inactive if store and forward is enabled, the message is buffered until the next connection.
+    """
+    def return_if_cannot_publish_body( decorated_function ):
+        def return_if_cannot_publish_logic( self, *args, **kwargs ):
+            if not self._alive and self._store is None:
+                return ret_args
+            else:
+                return decorated_function( self, *args, **kwargs )
+        return return_if_cannot_publish_logic
+    return return_if_cannot_publish_body
+
+
 class XivelyClient:
 
     """XivelyClient class is for connecting to and using Xively Services"""
@@ -67,6 +102,24 @@ class XivelyClient:
             xec.XI_STATE_OK : Connection successful"""
         pass
 
+    @staticmethod
+    def on_connect_timing(client, timing):
+        """called once per connection attempt, when it finished or failed, with a dict describing its phases.
+
+        timing -- a dict with
+            host, port -- the broker address the attempt connected to, None if no attempt connected
+            host_index -- index of the host in XivelyConfig.XI_MQTT_HOSTS, None if no attempt connected
+            cert_index -- index of the certificate in XivelyConfig.XI_MQTT_CERTS, None if all of them are trusted
+            start -- monotonic clock value when the attempt started
+            dns, tcp, tls, websocket, connack -- monotonic clock value when the phase finished, None if it didn't run
+                                                 or wasn't reached
+            result -- the CONNACK return code, None without CONNACK
+            error -- the exception that ended the attempt, None if it got a CONNACK
+
+        xively_connect_timing.connect_phase_durations() turns it into the duration of each phase, the histograms of
+        all attempts are in get_statistics()"""
+        pass
+
     @staticmethod
     def on_publish_finished(client, request_id):
         """called when a message that was to be sent using the publish() call has completed transmission to the broker.
@@ -121,6 +174,36 @@ class XivelyClient:
             else :
                 self._routine = self._routine_reconnect
 
+        # start callback workers if requested
+        if self._options.callback_workers > 0:
+
+            if self._dispatcher is None:
+                self._dispatcher = XivelyDispatcher(self._deliver_message,
+                                                    self._options.callback_workers,
+                                                    self._options.callback_queue_limit,
+                                                    self._options.callback_topic_queue_limit,
+                                                    self._dispatch_failed)
+
+            self._dispatcher.start()
+
+        else:
+            self._dispatcher = None
+
+        if self._options.recycle_messages:
+            if self._message_pool is None:
+                self._message_pool = XivelyMessagePool()
+        else:
+            self._message_pool = None
+
+        if self._options.journal_path is not None and self._journal is None:
+            self._journal = XivelyJournal(self._options.journal_path, self._options.journal_fsync)
+
+        # the buffer outlives the connection, messages published after a disconnect go out on the next connect
+        if self._options.store_forward and self._store is None:
+            self._store = XivelyStoreForward(self._options.store_forward_memory_limit,
+                                             self._options.store_forward_spill_path,
+                                             self._options.store_forward_drain_rate)
+
         self._alive = True
 
         # start runloop if needed
@@ -146,9 +229,49 @@ class XivelyClient:
 
         returns -- nothing"""
 
+        if self._batcher is not None:
+            self._batcher.flush()
+
         self._mqtt.disconnect()
 
 
+    def get_statistics(self):
+        """returns -- a dict with runtime statistics of the client.
+
+        dispatcher -- queue statistics of the callback workers, present if callback_workers was set in the connection
+                      parameters
+        mqtt -- outbox counters of the mqtt client and the number of messages dropped past their deadline
+        store_forward -- buffer statistics, present if store_forward was set in the connection parameters
+        deadband -- filtered topics and passed and suppressed values, present if deadband_timeseries() was used
+        batcher -- open batches, batched messages and published batches, present if batch_topic() was used
+        connector -- connection races and attempts, and the average connect latency of every broker address
+        connect_timing -- histograms of the phase durations of the connection attempts, see on_connect_timing()
+        resolver -- cached broker hosts, cache hits and misses and failed resolutions"""
+
+        statistics = {}
+
+        if self._dispatcher is not None:
+            statistics["dispatcher"] = self._dispatcher.get_statistics()
+
+        if self._mqtt is not None:
+            statistics["mqtt"] = self._mqtt.statistics()
+
+        if self._store is not None:
+            statistics["store_forward"] = self._store.get_statistics()
+
+        if self._deadband is not None:
+            statistics["deadband"] = self._deadband.get_statistics()
+
+        if self._batcher is not None:
+            statistics["batcher"] = self._batcher.get_statistics()
+
+        statistics["connector"] = self._connector.get_statistics()
+        statistics["connect_timing"] = self._connect_timings.get_statistics()
+        statistics["resolver"] = self._resolver.get_statistics()
+
+        return statistics
+
+
     # returns a success, request_id tuple
     @return_if_inactive(False,None)
     def subscribe(self, topics):
@@ -177,10 +300,7 @@ class XivelyClient:
 
         result, request_id = self._mqtt.subscribe(topics)
 
-        if result != MQTT_ERR_SUCCESS:
-            return True, request_id
-        else:
-            return False, request_id
+        return result == MQTT_ERR_SUCCESS, request_id
 
 
     # returns a success, request_id tuple
@@ -211,15 +331,12 @@ class XivelyClient:
 
         result, request_id = self._mqtt.unsubscribe(topics)
 
-        if result != MQTT_ERR_SUCCESS:
-            return True, request_id
-        else:
-            return False, request_id
+        return result == MQTT_ERR_SUCCESS, request_id
 
 
     # returns a success, request_id tuple
-    @return_if_inactive(False,None)
-    def publish(self, topic, payload, qos, retain):
+    @return_if_cannot_publish(False,None)
+    def publish(self, topic, payload, qos, retain, want_future=False, deadline=None, ttl=None):
         """publish a message on a topic.
 
         This causes a message to be sent to the Xively Services and subsequently from the Services to any xively clients
@@ -231,23 +348,140 @@ class XivelyClient:
         you wish to send a true int/float, use struct.pack() to create the payload you require.
         qos -- The quality of service level to use.
         retain -- If set to true, the message will be set as the "last known good"/retained message for the topic.
+        want_future -- If set to true, a XivelyPublishFuture is returned instead of the request id.
+        deadline -- Optional. time.time() value after which the message is worthless. A message not sent (QoS 0) or
+                    not confirmed (QoS 1 and 2) by then is dropped, on_publish_finished is not called for it and
+                    its future fails with XI_MESSAGE_EXPIRED. A QoS 2 message already received by the broker is
+                    always completed.
+        ttl -- Optional. Seconds from now, the same as a deadline of time.time() + ttl. If both are given the earlier
+               one applies.
 
-        returns -- (success,request_id)
+        returns -- (success,request_id) or (success,future)
 
         Returns a tuple (success, request_id), where success is a boolean indicating success, request_id is the
         request id for the publish request. The request_id value can be used to track the publish request by checking
-        against the request_id argument in the on_publish_finished() callback if it is defined."""
+        against the request_id argument in the on_publish_finished() callback if it is defined.
+
+        With want_future the second member is a XivelyPublishFuture, or None if success is False. Publishing many
+        messages and waiting once with xively_publish_future.wait_all() keeps the connection busy, unlike waiting for
+        each message before sending the next. Such a publish fails while the request id it would get, the one of the
+        message 65535 requests earlier, still belongs to an unconfirmed future.
+
+        With store and forward enabled, a message published while the client is not connected, or while older
+        messages are still buffered, is buffered and request_id is None. Its future gets a request id once the
+        message is sent.
+
+        On a topic set with batch_topic() the message is added to the open batch and request_id is None, unless
+        want_future, deadline or ttl is given. Such a message is published on its own after the open batch."""
+
+        if self._batcher is not None:
+            if want_future or deadline is not None or ttl is not None:
+                self._batcher.flush_topic(topic)
+            elif self._batcher.add(topic, payload, qos, retain, time.time()):
+                return True, None
+
+        future = None
+
+        if ttl is not None:
+            expiry = time.time() + ttl
+            if deadline is None or expiry < deadline:
+                deadline = expiry
+
+        if want_future:
+            future = XivelyPublishFuture(self._futures_cond, None, deadline)
+
+            if deadline is not None:
+                with self._futures_cond:
+                    heapq.heappush(self._futures_deadlines, (deadline, next(self._futures_sequence), future))
+
+        return self._publish_message(topic, payload, qos, retain, future, deadline)
+
+
+    def _publish_message(self, topic, payload, qos, retain, future=None, deadline=None):
+
+        if self._store is not None and (self._routine != self._routine_connected or self._store.pending() > 0):
+
+            if not self._store.put(topic, payload, qos, retain, future, deadline):
+                return False, None
+
+            return True, future
 
-        result, request_id = self._mqtt.publish(topic, payload, qos, retain)
+        return self._publish_now(topic, payload, qos, retain, future, deadline)
+
+
+    def _publish_now(self, topic, payload, qos, retain, future, deadline=None):
+
+        journaled = self._journal is not None and qos > 0
+
+        if future is None and not journaled:
+            result, request_id = self._mqtt.publish(topic, payload, qos, retain, None, deadline)
+            return result == MQTT_ERR_SUCCESS, request_id
+
+        # register the future and the journal record before publishing, the confirmation may arrive before publish
+        # returns
+        reserved_id = self._mqtt.reserve_mid()
+
+        # request ids wrap at 65535, a message whose id still belongs to an unconfirmed one can't be told apart from it
+        if reserved_id in self._futures or reserved_id in self._journal_keys:
+            if future is not None:
+                future.request_id = None
+            return False, None
+
+        if future is not None:
+            future.request_id = reserved_id
+
+            with self._futures_cond:
+                self._futures[reserved_id] = future
+
+        if journaled:
+            # the network thread closes the journal on disconnect
+            with self._journal_mutex:
+                if self._journal is not None:
+                    self._journal_keys[reserved_id] = self._journal.append(topic, payload, qos, retain)
+                else:
+                    journaled = False
+
+            if not journaled:
+                if future is not None:
+                    with self._futures_cond:
+                        self._futures.pop(reserved_id, None)
+                return False, None
+
+        result, request_id = self._mqtt.publish(topic, payload, qos, retain, reserved_id, deadline)
+
+        # a message refused by the outbox was never queued, anything else is sent or replayed on the next connection
+        if result == MQTT_ERR_QUEUE_SIZE and journaled:
+            with self._journal_mutex:
+                key = self._journal_keys.pop(reserved_id, None)
+                if self._journal is not None and key is not None:
+                    self._journal.remove(key)
+
+        if future is None:
+            return result == MQTT_ERR_SUCCESS, request_id
 
         if result != MQTT_ERR_SUCCESS:
-            return True, request_id
-        else:
-            return False, request_id
+            with self._futures_cond:
+                self._futures.pop(reserved_id, None)
+            return False, None
 
+        return True, future
 
-    @return_if_inactive(False,None)
-    def publish_timeseries(self, topic, value, qos):
+
+    def wait_writable(self, timeout=None):
+        """wait until a message fits in the outbox, see the outbox_* connection parameters.
+
+        timeout -- seconds to wait, None waits until there is room
+
+        returns -- True if a message fits, False if the timeout expired first"""
+
+        if self._mqtt is None:
+            return True
+
+        return self._mqtt.wait_writable(timeout)
+
+
+    @return_if_cannot_publish(False,None)
+    def publish_timeseries(self, topic, value, qos, want_future=False, deadline=None, ttl=None):
 
         """publish a float value on a topic marked as timeseries
 
@@ -256,6 +490,7 @@ class XivelyClient:
         topic -- The topic that the message should be published on.
         value -- The actual value to send
         qos -- The quality of service level to use.
+        want_future, deadline, ttl -- see publish()
 
         returns -- (success,request_id)
 
@@ -263,19 +498,67 @@ class XivelyClient:
         request id for the publish request. The request_id value can be used to track the publish request by checking
         against the request_id argument in the on_publish_finished() callback if it is defined.
 
-        Returns false as success if value is not a float"""
+        Returns false as success if value is not a float
+
+        On a topic aggregated with aggregate_timeseries() the value is added to the open window, success is True and
+        request_id is None. The same is returned for a value suppressed by the deadband_timeseries() filter."""
 
         if not isinstance(value, float):
             return False,0
 
+        if self._aggregator is not None and self._aggregator.add(topic, value, time.time()):
+            return True, None
+
+        if self._deadband is not None and not self._deadband.check(topic, value):
+            return True, None
+
         # convert float value to its binary representation
         payload = struct.pack('f', value)
 
-        return self.publish(topic, bytearray( payload ), qos, False)
+        return self.publish(topic, bytearray( payload ), qos, False, want_future, deadline, ttl)
 
 
-    @return_if_inactive(False,None)
-    def publish_formatted_timeseries(self, topic, time, in_category, in_string_value, in_numeric_value, qos):
+    @return_if_cannot_publish(False,None)
+    def publish_timeseries_batch(self, topic, values, qos, packed=False):
+
+        """publish a batch of float values on a topic marked as timeseries
+
+        Each value is sent as its own message, the same as publish_timeseries() would send it. The values are
+        converted in one pass and the messages are encoded together, so high rate samples don't pay the per call cost
+        of publish_timeseries().
+
+        topic -- The topic that the messages should be published on.
+        values -- array.array, memoryview, NumPy array or any sequence of numbers
+        qos -- The quality of service level to use.
+        packed -- If set to true, all values are sent in a single message of consecutive 4 byte floats. Subscribers
+                  decode it with xively_timeseries.unpack_samples().
+
+        returns -- (success,request_ids), or (success,request_id) if packed is set
+
+        Returns false as success if a value is not a number. On a topic aggregated with aggregate_timeseries() the
+        values are added to the open window and request_ids is None. No values publish nothing, request_ids is empty,
+        or request_id is None if packed is set."""
+
+        try:
+            payload = pack_samples(values)
+        except (TypeError, ValueError):
+            return False,None
+
+        if self._aggregator is not None and self._aggregator.add_many(topic, values, time.time()):
+            return True, None
+
+        if packed:
+            # no values, no message, like the per value messages
+            if len(payload) == 0:
+                return True, None
+            return self.publish(topic, payload, qos, False)
+
+        return self._publish_batch(topic, split_samples(payload), qos)
+
+
+    @return_if_cannot_publish(False,None)
+    def publish_formatted_timeseries(self, topic, time, in_category, in_string_value, in_numeric_value, qos,
+                                     want_future=False, deadline=None, ttl=None):
 
         """publish a float value on a topic marked as timeseries
 
@@ -313,6 +596,8 @@ class XivelyClient:
 
         qos -- The quality of service level to use.
 
+        want_future, deadline, ttl -- see publish()
+
         returns -- (success,request_id)
 
         Returns a tuple (success, request_id), where success is a boolean indicating success, request_id is the
@@ -322,57 +607,177 @@ class XivelyClient:
         Returns false as success if in_numeric_value is not a float, time is not an int, in_category and
         in_string is longer than 1024 bytes"""
 
-        # one of the custom parameters has to be defined
-        if in_category == None and in_string_value == None and in_numeric_value == None :
+        try:
+            payload = encode_csv_rows([time], [in_category], [in_string_value], [in_numeric_value])[0]
+        except (TypeError, ValueError):
             return False, 0
 
-        payload = ""
+        # rows without a numeric value always pass
+        if self._deadband is not None and in_numeric_value is not None and \
+                not self._deadband.check(topic, in_numeric_value):
+            return True, None
 
-        # add time as string
-        if time != None :
+        return self.publish(topic, payload, qos, False, want_future, deadline, ttl)
 
-            if not isinstance(time, int):
-                return False, 0
 
-            payload += str(time)
+    @return_if_cannot_publish(False,None)
+    def publish_formatted_timeseries_batch(self, topic, times, categories, string_values, numeric_values, qos):
 
-        payload += ","
+        """publish many formatted timeseries rows on a topic, one message per row
 
-        # add category if doesn't contain invalid characters
-        if in_category != None:
+        The same as calling publish_formatted_timeseries() for each row, but the columns are checked in bulk, the rows
+        are encoded together and the messages are queued at once.
 
-            if len(bytearray(in_category, "utf8")) > 1024 or set( in_category ) & set( ",\r\n" ):
-                return False, 0
+        topic -- The topic that the messages should be published on.
+        times, categories, string_values, numeric_values -- The columns, each one is None or a sequence with a value
+                                                            or None for every row. See publish_formatted_timeseries()
+                                                            for the values.
+        qos -- The quality of service level to use.
 
-            else :
-                payload += in_category
+        returns -- (success,request_ids)
 
-        payload += ","
+        Returns false as success if the columns differ in length or any row is invalid, nothing is published then.
+        Columns without rows publish nothing either, request_ids is empty"""
 
-        # add numberic value
-        if in_numeric_value != None:
+        try:
+            payloads = encode_csv_rows(times, categories, string_values, numeric_values)
+        except (TypeError, ValueError):
+            return False, None
 
-            if not isinstance(in_numeric_value, float):
-                return False, 0
+        return self._publish_batch(topic, payloads, qos)
 
-            payload += str(in_numeric_value)
 
-        payload += ","
+    def aggregate_timeseries(self, topic, window, slide=None, qos=0):
 
-        # add string value if doesn't contain invalid characters
-        if in_string_value != None:
+        """aggregate the values published on a timeseries topic on the client
 
-            if len(bytearray(in_string_value, "utf8")) > 1024 or set( in_string_value ) & set( ",\r\n" ):
-                return False, 0
+        publish_timeseries() and publish_timeseries_batch() add the values of the topic to a window instead of
+        publishing them. When a window closes a single message is published on the topic with the count, minimum,
+        maximum, mean and last value of the window, as five 4 byte floats in that order. Subscribers decode it with
+        xively_timeseries.unpack_samples(). Windows are closed by the client thread, windows without values are not
+        published.
 
-            else :
-                payload += in_string_value
+        topic -- The timeseries topic.
+        window -- Length of the window in seconds, None stops aggregating the topic and drops its open window.
+        slide -- Optional. Seconds between two windows, it must divide window. None or window gives back to back
+                 windows, a shorter slide gives overlapping sliding windows.
+        qos -- The quality of service level of the aggregated messages.
+
+        returns -- nothing
+
+        raises ValueError if slide is longer than window or doesn't divide it"""
+
+        if window is None:
+            if self._aggregator is not None:
+                self._aggregator.remove_topic(topic)
+            return
+
+        if self._aggregator is None:
+            self._aggregator = XivelyAggregator(lambda topic, payload, qos: self.publish(topic, payload, qos, False))
+
+        self._aggregator.add_topic(topic, window, slide, qos)
+
+
+    def deadband_timeseries(self, topic, absolute=None, percent=None, max_silence=None):
+
+        """publish the values of a timeseries topic by exception only
+
+        publish_timeseries() and publish_formatted_timeseries() suppress a value of the topic unless it moved more
+        than the deadband away from the last published value, or max_silence seconds went by since that one. A
+        suppressed publish returns success and None as request_id. Formatted timeseries rows are filtered by their
+        numeric value, rows without one are always published.
+
+        topic -- The timeseries topic.
+        absolute -- Optional. Smallest change that is published.
+        percent -- Optional. Smallest change that is published, in percent of the last published value.
+        max_silence -- Optional. Seconds after which a value is published even if it didn't change.
+
+        Without absolute and percent every change is published. If all three are None, the topic is not filtered
+        any more.
+
+        returns -- nothing"""
+
+        if absolute is None and percent is None and max_silence is None:
+            if self._deadband is not None:
+                self._deadband.remove_topic(topic)
+            return
+
+        if self._deadband is None:
+            self._deadband = XivelyDeadband()
+
+        self._deadband.add_topic(topic, absolute, percent, max_silence)
+
+
+    def batch_topic(self, topic, linger=0.005, max_bytes=16384):
+
+        """collect small publishes to a topic into batches
+
+        publish() adds the messages of the topic to a batch, a single message of length prefixed records that is
+        published after linger seconds or once it reaches max_bytes. A batch is also published when a message with a
+        different qos or retain flag arrives. Subscribers get the original messages back with unbatch_topic(), or
+        split the payload with xively_batcher.decode_batch().
+
+        topic -- The topic, owned by both ends.
+        linger -- Seconds a batch waits for more messages, None stops batching the topic and publishes its batch.
+        max_bytes -- Size of the batch payload that is published without waiting.
+
+        returns -- nothing"""
+
+        if linger is None:
+            if self._batcher is not None:
+                self._batcher.remove_topic(topic)
+            return
+
+        if self._batcher is None:
+            self._batcher = XivelyBatcher(
+                lambda topic, payload, qos, retain: self._publish_message(topic, payload, qos, retain))
+
+        self._batcher.add_topic(topic, linger, max_bytes)
+
+
+    def unbatch_topic(self, topic_filter, enabled=True):
+
+        """deliver the records of batches published with batch_topic() as separate messages
+
+        on_message_received is called for each record of a message received on a matching topic, with the topic, qos
+        and request_id of the batch. A message that is not a valid batch is delivered as it is.
+
+        topic_filter -- A topic or a subscription filter with wildcards.
+        enabled -- False stops splitting messages of the filter.
+
+        returns -- nothing"""
+
+        if enabled:
+            if topic_filter not in self._unbatch_filters:
+                self._unbatch_filters = self._unbatch_filters + [topic_filter]
+        else:
+            self._unbatch_filters = [item for item in self._unbatch_filters if item != topic_filter]
+
+
+    def _publish_batch(self, topic, payloads, qos):
+
+        # buffered and journaled messages need a record each
+        if (qos > 0 and self._journal is not None) or \
+                (self._store is not None and (self._routine != self._routine_connected or self._store.pending() > 0)):
+
+            request_ids = []
+
+            for payload in payloads:
+                success, request_id = self.publish(topic, payload, qos, False)
+                if not success:
+                    return False, request_ids
+                request_ids.append(request_id)
+
+            return True, request_ids
+
+        result, request_ids = self._mqtt.publish_batch(topic, payloads, qos)
 
-        return self.publish(topic, payload, qos, False)
+        return result == MQTT_ERR_SUCCESS, request_ids
 
 
-    # timeout for paho main loop
+    # timeout for paho main loop, and the shortest one used while timers are due
     _XC_PAHO_LOOP_TIMEOUT = 1.0
+    _XC_PAHO_LOOP_TIMEOUT_MIN = 0.01
 
     def __init__(self):
 
@@ -386,8 +791,19 @@ class XivelyClient:
         self._last_cooldown_time = 0
         self._backoff_duration = 0
 
-        self._hostindex = 0
         self._certindex = 0
+        self._certs_sequential = False
+        self._race = None
+        self._endpoints = None
+        self._resolved = None
+
+        # timing record of the connection attempt in progress, and the histograms of the finished ones
+        self._timing = None
+        self._connect_timings = XivelyConnectTimings()
+
+        self._resolver = XivelyResolver(XivelyConfig.XI_MQTT_DNS_TTL, XivelyConfig.XI_MQTT_CONNECT_TIMEOUT)
+        self._connector = XivelyConnector(XivelyConfig.XI_MQTT_CONNECT_STAGGER, XivelyConfig.XI_MQTT_CONNECT_TIMEOUT,
+                                          resolve = self._resolver.resolve)
 
         self._alive = True
         self._options = None
@@ -395,6 +811,37 @@ class XivelyClient:
 
         self._thread = None
         self._routine = None
+        self._dispatcher = None
+        self._mqtt = None
+
+        # pending publish futures by request id, and a heap of the ones with a deadline
+        self._futures_cond = threading.Condition(threading.RLock())
+        self._futures = {}
+        self._futures_deadlines = []
+        self._futures_sequence = itertools.count()
+
+        # unacknowledged qos 1 and 2 messages on disk, and their journal keys by request id of the current connection
+        self._journal = None
+        self._journal_keys = {}
+        # guards the journal between publishing threads and the network thread closing it
+        self._journal_mutex = threading.Lock()
+
+        # store and forward buffer, kept across connections
+        self._store = None
+
+        # free list of incoming messages if recycle_messages is set
+        self._message_pool = None
+
+        # window statistics of the topics set with aggregate_timeseries(), kept across connections
+        self._aggregator = None
+
+        # report by exception filter of the topics set with deadband_timeseries()
+        self._deadband = None
+
+        # batches of the topics set with batch_topic(), and the filters of unbatch_topic(), the list is replaced
+        # instead of modified so the network thread can read it without a lock
+        self._batcher = None
+        self._unbatch_filters = []
 
     def __del__(self):
 
@@ -405,12 +852,13 @@ class XivelyClient:
 
         while self._alive:
             self._routine()
+            self._process_timers()
 
         self._thread = None
 
     def _mqtt_loop(self):
         try:
-            self._mqtt.loop(timeout=self._XC_PAHO_LOOP_TIMEOUT)
+            self._mqtt.loop(timeout=self._loop_timeout())
         except ValueError as valueError:
             """ Write on closed or unwrapped SSL socket. is raised from ssl write function """
             #print("*** exception = " + str(valueError))
@@ -420,14 +868,22 @@ class XivelyClient:
 
     def _routine_connecting(self):
         if time.time() - self._last_connection_time > float(self._options.connection_timeout):
+            self._finish_connect_timing( None, sockettimeout( "timed out" ) )
             self._disconnection_state = xec.XI_STATE_TIMEOUT
             self._routine = self._routine_rejected
         else:
-            self._mqtt_loop()
+            try:
+                self._mqtt_loop()
+            except ( ssl.SSLError, ssl.CertificateError, socketerror ) as error:
+                # a failed websocket upgrade of the connect
+                self._connect_failed( error )
+
+            if self._routine == self._routine_connecting and self._mqtt.socket() is None:
+                # the websocket upgrade failed, _mqtt_loop() ignores its ValueError
+                self._connect_failed( socketerror( "websocket handshake error" ) )
 
 
     def _routine_connected(self):
-        print("_routine_connected")
         self._mqtt_loop()
         self._try_cooldown()
 
@@ -435,12 +891,22 @@ class XivelyClient:
     def _routine_rejected(self):
         self._alive = False
         self._mqtt.reinitialise()
+        # a callback may wait for a future, the workers stop once it failed
+        self._fail_futures()
+        self._stop_dispatcher()
+        self._close_journal()
+        self._close_store()
         self._cbHandler.on_connect_finished( self._disconnection_state )
 
 
     def _routine_disconnected(self):
         self._alive = False
         self._mqtt.reinitialise()
+        # a callback may wait for a future, the workers stop once it failed
+        self._fail_futures()
+        self._stop_dispatcher()
+        self._close_journal()
+        self._close_store()
         self._cbHandler.on_disconnect_finished( self._disconnection_state )
 
 
@@ -455,9 +921,18 @@ class XivelyClient:
         self._mqtt.on_disconnect = lambda client, userdata, result : self._mqtt_on_disconnect_finished(result)
         self._mqtt.on_message = lambda client, userdata, message : self._mqtt_on_message_received(message)
         self._mqtt.on_publish = lambda client, userdata, mid: self._mqtt_on_publish_finished(mid)
+        self._mqtt.on_expire = lambda client, userdata, mid: self._mqtt_on_publish_expired(mid)
+        self._mqtt.on_drop = lambda client, userdata, mid: self._mqtt_on_publish_dropped(mid)
         self._mqtt.on_subscribe = lambda client, userdata, mid, granted_qos: self._mqtt_on_subscribe_finished(mid, granted_qos)
         self._mqtt.on_unsubscribe = lambda client, userdata, mid: self._mqtt_on_unsubscribe_finished(mid)
+        self._mqtt.on_connect_timing = lambda client, userdata, timing: self._mqtt_on_connect_timing(timing)
         self._mqtt.username_pw_set(self._options.username, self._options.password)
+        self._mqtt.duplex_set(self._options.use_duplex_transport)
+        self._mqtt.outbox_limits_set(self._options.outbox_max_messages,
+                                     self._options.outbox_max_bytes,
+                                     self._options.outbox_policy,
+                                     self._options.outbox_timeout)
+        self._journal_keys = {}
 
         hosts = XivelyConfig.XI_MQTT_HOSTS
         certs = XivelyConfig.XI_MQTT_CERTS
@@ -469,63 +944,162 @@ class XivelyClient:
             # py2.7 has only TLSv1.0
             use_tls_version = ssl.PROTOCOL_TLSv1
 
-        # setup TLS if host requires it
-        if hosts[self._hostindex][2] :
-            self._mqtt.tls_set(
-                os.path.dirname( sys.modules[__name__].__file__ ) + "/certs/" + certs[self._certindex],
-                tls_version=use_tls_version)
+        # all certs in one trust store, or one per attempt in compatibility mode and without ssl.SSLContext
+        self._certs_sequential = XivelyConfig.XI_MQTT_CERTS_SEQUENTIAL or not hasattr(ssl, 'SSLContext')
+
+        self._timing = {
+            "host": None,
+            "port": None,
+            "host_index": None,
+            "cert_index": self._certindex if self._certs_sequential else None,
+            "start": _monotonic(),
+            "dns": None,
+            "tcp": None,
+            "tls": None,
+            "websocket": None,
+            "connack": None,
+            "result": None,
+            "error": None }
+
+        certs_path = os.path.dirname( sys.modules[__name__].__file__ ) + "/certs/"
+
+        # setup TLS if a host requires it
+        if any( host[2] for host in hosts ) :
+            if self._certs_sequential :
+                ca_certs = certs_path + certs[self._certindex]
+            else :
+                ca_certs = [ certs_path + cert for cert in certs ]
+            self._mqtt.tls_set(ca_certs, tls_version=use_tls_version)
 
         # setup last will if present
         if self._options.will_message is not None:
             self._mqtt.will_set(self._options.will_topic, self._options.will_message, self._options.will_qos, self._options.will_retain)
 
+        # ( host, port, tls, index in XI_MQTT_HOSTS ), several entries may share a host name
+        if not self._options.use_websocket :
+            endpoints = [ ( host[0], host[1], host[2], index ) for index, host in enumerate( hosts ) ]
+        else :
+            endpoints = [ ( host[0], XivelyConfig.XI_MQTT_WEBSOCKET_PORT, host[2], index )
+                          for index, host in enumerate( hosts ) ]
+
+        # resolve the hosts in parallel, _routine_resolving polls them
+        for endpoint in endpoints :
+            self._resolver.prefetch( endpoint[0], endpoint[1] )
+
+        self._endpoints = endpoints
+        self._resolved = {}
+        self._routine = self._routine_resolving
+
+
+    # poll the resolution of the hosts without blocking the runloop, the race starts once all hosts answered, or
+    # once one of them resolved and the others are more than XI_MQTT_CONNECT_STAGGER late
+
+    def _routine_resolving(self):
+
+        elapsed = time.time() - self._last_connection_time
+
+        for endpoint in self._endpoints :
+            key = ( endpoint[0], endpoint[1] )
+            if key not in self._resolved :
+                try:
+                    addresses = self._resolver.lookup( endpoint[0], endpoint[1] )
+                    if addresses is not None :
+                        self._resolved[key] = addresses
+                except socketerror as error:
+                    self._resolved[key] = error
+
+        answered = len( self._resolved ) == len( set( ( endpoint[0], endpoint[1] ) for endpoint in self._endpoints ) )
+        usable = any( not isinstance( addresses, Exception ) for addresses in self._resolved.values() )
+
+        if not answered and not ( usable and elapsed >= XivelyConfig.XI_MQTT_CONNECT_STAGGER ) and \
+           elapsed < XivelyConfig.XI_MQTT_CONNECT_TIMEOUT :
+            timeout = min( self._loop_timeout(), XivelyConfig.XI_MQTT_CONNECT_TIMEOUT - elapsed )
+            if usable :
+                timeout = min( timeout, XivelyConfig.XI_MQTT_CONNECT_STAGGER - elapsed )
+            self._resolver.wait( timeout )
+            return
+
+        endpoints = self._endpoints
+        resolved = self._resolved
+        self._endpoints = None
+        self._resolved = None
+
+        # hosts still resolving are left out of this race, their answer is cached for the next one
+        def resolve( host, port ):
+            addresses = resolved.get( ( host, port ) )
+            if addresses is None :
+                raise sockettimeout( "resolving %s timed out" % host )
+            if isinstance( addresses, Exception ) :
+                raise addresses
+            return addresses
+
+        # the TLS handshake is part of the race, a host that stalls it loses
+        mqtt = self._mqtt
+        prepare = lambda sock, endpoint : mqtt.tls_wrap( sock, endpoint[0], endpoint[1] ) if endpoint[2] else sock
+
+        self._race = self._connector.start( endpoints, prepare, resolve )
+        self._routine = self._routine_racing
+
+
+    # wait for the connection race without blocking the runloop, the attempts run on their own threads
+
+    def _routine_racing(self):
+
         try:
 
-            if not self._options.use_websocket :
+            winner = self._race.wait( self._loop_timeout() )
 
-                self._mqtt.connect(hosts[self._hostindex ][0],\
-                                  hosts[self._hostindex ][1],\
-                                  self._options.keep_alive)
+            if winner is None :
+                return
 
-            else:
+            sock, endpoint = winner
 
-                self._mqtt.connect(hosts[self._hostindex ][0],\
-                                  XivelyConfig.XI_MQTT_WEBSOCKET_PORT,\
-                                  self._options.keep_alive)
+            self._timing["dns"] = self._race.resolved
+            self._timing["host"] = endpoint[0]
+            self._timing["port"] = endpoint[1]
+            self._timing["host_index"] = endpoint[3]
+            self._timing["tcp"] = self._race.connected
+            if endpoint[2] :
+                self._timing["tls"] = self._race.prepared
+            self._race = None
 
+            # the websocket upgrade runs in the mqtt loop of _routine_connecting
+            self._mqtt.connect_socket( sock, endpoint[0], endpoint[1], self._options.keep_alive, False )
             self._routine = self._routine_connecting
 
-        except ssl.SSLError as error:
+        except ( ssl.SSLError, ssl.CertificateError, socketerror ) as error:
 
-            self._routine = self._routine_reconnect
-            self._certindex += 1
+            self._timing["dns"] = self._race.resolved
+            self._race = None
+            self._connect_failed( error )
 
-            if self._certindex == len( certs) :
 
-                self._certindex = 0
-                self._disconnection_state = xec.XI_TLS_CONNECT_ERROR
-                self._routine = self._routine_rejected
+    # TLS or socket error of a connection attempt
+
+    def _connect_failed(self, error):
 
-        except ssl.CertificateError as error:
+        self._finish_connect_timing( None, error )
+
+        if isinstance( error, ssl.SSLError ) or isinstance( error, ssl.CertificateError ):
 
             self._routine = self._routine_reconnect
             self._certindex += 1
 
-            if self._certindex == len( certs) :
+            if self._certindex == len( XivelyConfig.XI_MQTT_CERTS ) or not self._certs_sequential :
 
                 self._certindex = 0
-                self._disconnection_state = xec.XI_TLS_CERTIFICATE_ERROR
                 self._routine = self._routine_rejected
 
-        except socketerror as error:
-
-            self._hostindex += 1
+                if isinstance( error, ssl.SSLError ):
+                    self._disconnection_state = xec.XI_TLS_CONNECT_ERROR
+                else:
+                    self._disconnection_state = xec.XI_TLS_CERTIFICATE_ERROR
 
-            if self._hostindex == len( hosts ):
+        else:
 
-                self._hostindex = 0
-                self._disconnection_state = xec.XI_SOCKET_ERROR
-                self._routine = self._routine_rejected
+            # every address of every host failed
+            self._disconnection_state = xec.XI_SOCKET_ERROR
+            self._routine = self._routine_rejected
 
 
     # check backoff duration
@@ -547,10 +1121,36 @@ class XivelyClient:
         time.sleep(1.0)
 
 
+    # the websocket and CONNACK phases of the connection attempt, from the mqtt client
+
+    def _mqtt_on_connect_timing(self, timing):
+
+        if self._timing is not None:
+            self._timing["websocket"] = timing["websocket"]
+            self._timing["connack"] = timing["connack"]
+            self._finish_connect_timing( timing["result"], timing["error"] )
+
+
+    def _finish_connect_timing(self, result, error):
+
+        timing = self._timing
+        if timing is None:
+            return
+
+        self._timing = None
+        timing["result"] = result
+        timing["error"] = error
+
+        self._connect_timings.add( timing )
+        self._cbHandler.on_connect_timing( timing )
+
+
     def _mqtt_on_connected(self, previous_connection_result):
 
         XivelyBackoff.reset_last_update()
 
+        self._replay_journal()
+
         self._routine = self._routine_connected
         self._cbHandler.on_connect_finished(xec.XI_STATE_OK)
 
@@ -605,6 +1205,7 @@ class XivelyClient:
             self._disconnection_state = xec.XI_CONNECTION_RESET_BY_PEER_ERROR
 
         if self._routine == self._routine_connecting :
+            self._finish_connect_timing( None, socketerror( "connection lost" ) )
             self._last_connection_time = 0
             self._routine = self._routine_rejected
 
@@ -615,20 +1216,109 @@ class XivelyClient:
 
     def _mqtt_on_message_received(self, message):
 
-        xi_message = XivelyMessage()
-        xi_message.qos = message.qos
-        xi_message.topic = message.topic
-        xi_message.payload = message.payload
-        xi_message.request_id = message.mid
+        if self._unbatch_filters:
+            for topic_filter in self._unbatch_filters:
+                if topic_matches_sub(topic_filter, message.topic):
+                    records = decode_batch(message.payload)
+                    if records is not None:
+                        for record in records:
+                            self._dispatch_message(message.qos, message.topic, record, message.mid)
+                        return
+                    break
+
+        self._dispatch_message(message.qos, message.topic, message.payload, message.mid)
 
-        self._cbHandler.on_message_received(xi_message)
+
+    def _dispatch_message(self, qos, topic, payload, request_id):
+
+        pool = self._message_pool
+
+        if pool is not None:
+            xi_message = pool.acquire()
+        else:
+            xi_message = XivelyMessage()
+
+        xi_message.qos = qos
+        xi_message.topic = topic
+        xi_message.payload = payload
+        xi_message.request_id = request_id
+
+        if self._dispatcher is not None:
+            if not self._dispatcher.dispatch(xi_message) and pool is not None:
+                pool.release(xi_message)
+        else:
+            self._deliver_message(xi_message)
+
+
+    # runs on the network thread or on a callback worker
+
+    def _deliver_message(self, xi_message):
+
+        try:
+            self._cbHandler.on_message_received(xi_message)
+        finally:
+            if self._message_pool is not None:
+                self._message_pool.release(xi_message)
+
+
+    # a message callback raised on a worker thread, reported through the log of the mqtt client
+
+    def _dispatch_failed(self, xi_message, error):
+
+        mqtt = self._mqtt
+
+        if mqtt is not None:
+            mqtt._easy_log(paho_mqtt_client.MQTT_LOG_ERR,
+                           "Error in message callback (topic '" + str(xi_message.topic) + "'): " + repr(error))
 
 
     def _mqtt_on_publish_finished(self, request_id):
         XivelyClient.publish_count_until_last_stat_message += 1
+
+        if self._journal_keys:
+            key = self._journal_keys.pop(request_id, None)
+            if key is not None:
+                self._journal.remove(key)
+
+        if self._futures:
+            with self._futures_cond:
+                future = self._futures.pop(request_id, None)
+                if future is not None:
+                    future._set_result(xec.XI_STATE_OK)
+                    self._futures_cond.notify_all()
+
         self._cbHandler.on_publish_finished(request_id)
 
 
+    # a message dropped by the mqtt client because its deadline passed
+
+    def _mqtt_on_publish_expired(self, request_id):
+
+        if self._journal_keys:
+            key = self._journal_keys.pop(request_id, None)
+            if key is not None:
+                self._journal.remove(key)
+
+        if self._futures:
+            with self._futures_cond:
+                future = self._futures.pop(request_id, None)
+                if future is not None:
+                    future._set_result(xec.XI_MESSAGE_EXPIRED)
+                    self._futures_cond.notify_all()
+
+
+    # a QoS 0 message dropped from a full outbox by the mqtt client, see outbox_policy
+
+    def _mqtt_on_publish_dropped(self, request_id):
+
+        if self._futures:
+            with self._futures_cond:
+                future = self._futures.pop(request_id, None)
+                if future is not None:
+                    future._set_result(xec.XI_MESSAGE_NOT_DELIVERED)
+                    self._futures_cond.notify_all()
+
+
     def _mqtt_on_subscribe_finished(self, request_id, granted_qos):
 
         self._cbHandler.on_subscribe_finished(request_id, granted_qos)
@@ -639,6 +1329,163 @@ class XivelyClient:
         self._cbHandler.on_unsubscribe_finished(request_id)
 
 
+    # deliver queued messages before reporting the end of the connection
+
+    def _stop_dispatcher(self):
+
+        if self._dispatcher is not None:
+            self._dispatcher.stop()
+
+
+    # resend journaled messages the broker has not acknowledged, on the network thread right after CONNACK
+
+    def _replay_journal(self):
+
+        if self._journal is None:
+            return
+
+        in_flight = set(self._journal_keys.values())
+
+        for key, topic, payload, qos, retain in self._journal.records():
+
+            if key in in_flight:
+                continue
+
+            request_id = self._mqtt.reserve_mid()
+            self._journal_keys[request_id] = key
+
+            result = self._mqtt.publish(topic, payload, qos, retain, request_id)[0]
+
+            # the outbox is full, the rest stays in the journal for the next connection
+            if result == MQTT_ERR_QUEUE_SIZE:
+                del self._journal_keys[request_id]
+                break
+
+
+    def _close_journal(self):
+
+        with self._journal_mutex:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            self._journal_keys = {}
+
+
+    # the buffer itself stays for the next connection, only the spill journal is closed until it is needed again
+
+    def _close_store(self):
+
+        if self._store is not None:
+            self._store.close()
+
+
+    # wake the paho loop in time for the next timer
+
+    def _loop_timeout(self):
+
+        timeout = self._XC_PAHO_LOOP_TIMEOUT
+
+        if self._store is not None and self._store.pending() > 0:
+            timeout = min(timeout, self._store.drain_delay())
+
+        if self._futures_deadlines:
+            timeout = min(timeout, self._futures_deadlines[0][0] - time.time())
+
+        if self._aggregator is not None:
+            closes = self._aggregator.next_close()
+            if closes is not None:
+                timeout = min(timeout, closes - time.time())
+
+        if self._batcher is not None:
+            flush = self._batcher.next_flush()
+            if flush is not None:
+                timeout = min(timeout, flush - time.time())
+
+        return max(timeout, self._XC_PAHO_LOOP_TIMEOUT_MIN)
+
+
+    # expire publish futures, drain the store and forward buffer, close aggregation windows and publish lingering
+    # batches, called on every runloop pass
+
+    def _process_timers(self):
+
+        self._drain_store()
+
+        if self._aggregator is not None:
+            self._aggregator.flush(time.time())
+
+        if self._batcher is not None:
+            self._batcher.flush(time.time())
+
+        if not self._futures_deadlines:
+            return
+
+        now = time.time()
+
+        with self._futures_cond:
+
+            expired = False
+
+            while self._futures_deadlines and self._futures_deadlines[0][0] <= now:
+                deadline, sequence, future = heapq.heappop(self._futures_deadlines)
+                if not future.done():
+                    future._set_result(xec.XI_MESSAGE_EXPIRED)
+                    if self._futures.get(future.request_id) is future:
+                        del self._futures[future.request_id]
+                    expired = True
+
+            if expired:
+                self._futures_cond.notify_all()
+
+
+    def _drain_store(self):
+
+        if self._store is None or self._routine != self._routine_connected or self._store.pending() == 0:
+            return
+
+        budget = self._store.drain_budget()
+        if budget == 0:
+            return
+
+        now = time.time()
+        sent = 0
+        expired = 0
+
+        # up to one loop pass worth of messages, stop early when the outbox is full
+        for topic, payload, qos, retain, future, deadline in self._store.peek(min(budget, 1000)):
+
+            # dropped on the way out, its future fails through the deadline heap
+            if deadline is not None and deadline <= now:
+                expired += 1
+                continue
+
+            if not self._mqtt.wait_writable(0):
+                break
+
+            success = self._publish_now(topic, payload, qos, retain, future, deadline)[0]
+            if not success:
+                break
+
+            sent += 1
+
+        self._store.pop(sent + expired, expired)
+
+
+    # messages of a closed connection are never confirmed, buffered ones keep waiting for the next connection
+
+    def _fail_futures(self):
+
+        with self._futures_cond:
+
+            for future in self._futures.values():
+                future._set_result(xec.XI_MESSAGE_NOT_DELIVERED)
+
+            self._futures = {}
+            self._futures_deadlines = [entry for entry in self._futures_deadlines if not entry[2].done()]
+            heapq.heapify(self._futures_deadlines)
+            self._futures_cond.notify_all()
+
+
     # cooldown backoff
 
     def _try_cooldown(self):
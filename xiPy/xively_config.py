@@ -4,8 +4,17 @@
 class XivelyConfig:
 
     XI_MQTT_CERTS = [ "GlobalSign Root CA.pem" , "GeoTrust Primary Certification Authority - G3.pem" , "thawte Primary Root CA - G3.pem" , "VeriSign Class 3 Public Primary Certification Authority - G5.pem" ]
+    # True tries one of XI_MQTT_CERTS per connection attempt like older versions, instead of trusting all of them
+    # in a single handshake
+    XI_MQTT_CERTS_SEQUENTIAL = False
     XI_MQTT_HOSTS = [ ("broker.xively.com", 8883, True) ]
     XI_MQTT_WEBSOCKET_PORT = 443
+    # all addresses of all hosts are raced, a new attempt starts every XI_MQTT_CONNECT_STAGGER seconds, see
+    # XivelyConnector
+    XI_MQTT_CONNECT_STAGGER = 0.25
+    XI_MQTT_CONNECT_TIMEOUT = 10.0
+    # seconds the addresses of a host are used before they are resolved again, in the background, see XivelyResolver
+    XI_MQTT_DNS_TTL = 300.0
 
     def on_connect_finished(self,result):
 
@@ -0,0 +1,93 @@
+# Copyright (c) 2003-2016, Xively. All rights reserved.
+# This is part of Xively Python library, it is under the BSD 3-Clause license.
+
+import bisect
+import threading
+
+# phases of a connect attempt in order, each one a monotonic timestamp of a timing record
+CONNECT_PHASES = ("dns", "tcp", "tls", "websocket", "connack")
+
+
+def connect_phase_durations(timing):
+
+    """returns -- a dict with the seconds each phase of a timing record took, from the end of the phase before it, and
+    the seconds from the start to the end of the last phase reached as "total". Phases that didn't run are left
+    out."""
+
+    durations = {}
+    previous = timing["start"]
+
+    for phase in CONNECT_PHASES:
+        stamp = timing.get(phase)
+        if stamp is not None:
+            durations[phase] = stamp - previous
+            previous = stamp
+
+    durations["total"] = previous - timing["start"]
+    return durations
+
+
+class XivelyConnectTimings:
+
+    """XivelyConnectTimings aggregates the timing records of connect attempts into a histogram per phase.
+
+    An attempt counts as failed if it ended with an error or a CONNACK refusal, the phases it got through are still
+    added."""
+
+    # upper bounds of the histogram buckets in seconds, the last bucket has no bound
+    BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0)
+
+    def __init__(self):
+
+        self._mutex = threading.Lock()
+        self._attempts = 0
+        self._failures = 0
+        # [counts, sum, max] by phase
+        self._histograms = {}
+
+
+    def add(self, timing):
+
+        """add the timing record of a connect attempt"""
+
+        durations = connect_phase_durations(timing)
+
+        with self._mutex:
+
+            self._attempts += 1
+            if timing.get("error") is not None or timing.get("result"):
+                self._failures += 1
+
+            for phase, duration in durations.items():
+
+                histogram = self._histograms.get(phase)
+                if histogram is None:
+                    histogram = [[0] * (len(self.BUCKETS) + 1), 0.0, 0.0]
+                    self._histograms[phase] = histogram
+
+                histogram[0][bisect.bisect_left(self.BUCKETS, duration)] += 1
+                histogram[1] += duration
+                histogram[2] = max(histogram[2], duration)
+
+
+    def get_statistics(self):
+
+        """returns -- a dict with the number of attempts and failed attempts, and for every phase and the total a dict
+        with the count, mean and max duration and the bucket counts, bucket i counts durations up to BUCKETS[i]"""
+
+        with self._mutex:
+
+            phases = {}
+
+            for phase, (counts, total, maximum) in self._histograms.items():
+                count = sum(counts)
+                phases[phase] = {
+                    "count": count,
+                    "mean": total / count,
+                    "max": maximum,
+                    "buckets": list(counts) }
+
+            return {
+                "attempts": self._attempts,
+                "failures": self._failures,
+                "phases": phases }
@@ -1,10 +1,17 @@
 # Copyright (c) 2003-2016, Xively. All rights reserved.
 # This is part of Xively Python library, it is under the BSD 3-Clause license.
 
+from .paho_mqtt_client import MQTT_OUTBOX_BLOCK, MQTT_OUTBOX_FAIL, MQTT_OUTBOX_DROP_OLDEST_QOS0
+
 class XivelyConnectionParameters:
 
     """XivelyClient Connection parameters"""
 
+    # outbox_policy values
+    OUTBOX_BLOCK = MQTT_OUTBOX_BLOCK
+    OUTBOX_FAIL = MQTT_OUTBOX_FAIL
+    OUTBOX_DROP_OLDEST_QOS0 = MQTT_OUTBOX_DROP_OLDEST_QOS0
+
     def __init__(self):
 
         self.username = None
@@ -21,3 +28,36 @@ class XivelyConnectionParameters:
         self.will_message = None
 
         self.use_websocket = False
+
+        # read and write on separate threads, see Client.duplex_set()
+        self.use_duplex_transport = False
+
+        # message callbacks run on the network thread if callback_workers is 0, otherwise on a worker pool. A message
+        # past one of the queue limits, 0 means unlimited, is dropped
+        self.callback_workers = 0
+        self.callback_queue_limit = 0
+        self.callback_topic_queue_limit = 0
+
+        # limits for messages waiting to be sent or acknowledged, 0 means unlimited. When a limit is reached publish
+        # waits up to outbox_timeout seconds (OUTBOX_BLOCK), fails (OUTBOX_FAIL) or discards the oldest unsent qos 0
+        # messages (OUTBOX_DROP_OLDEST_QOS0)
+        self.outbox_max_messages = 0
+        self.outbox_max_bytes = 0
+        self.outbox_policy = self.OUTBOX_BLOCK
+        self.outbox_timeout = 0.0
+
+        # directory of the journal keeping unacknowledged qos 1 and 2 messages across reconnects and restarts, None
+        # keeps them in memory only. journal_fsync is one of the XivelyJournal.FSYNC_* policies
+        self.journal_path = None
+        self.journal_fsync = "batch"
+
+        # buffer messages published while not connected and send them after the next connect, at most
+        # store_forward_drain_rate messages per second (0 is unlimited). Past store_forward_memory_limit messages
+        # they are written to store_forward_spill_path, or refused if it is None
+        self.store_forward = False
+        self.store_forward_memory_limit = 10000
+        self.store_forward_spill_path = None
+        self.store_forward_drain_rate = 100
+
+        # reuse XivelyMessage objects of incoming messages, on_message_received must not keep the message it gets
+        self.recycle_messages = False
@@ -0,0 +1,364 @@
+# Copyright (c) 2003-2016, Xively. All rights reserved.
+# This is part of Xively Python library, it is under the BSD 3-Clause license.
+
+import time
+import socket
+import threading
+
+# monotonic clock if available (py3), wall clock on py2.7
+_monotonic = getattr(time, "monotonic", time.time)
+
+class XivelyConnector:
+
+    """XivelyConnector races connection attempts to all addresses of several brokers, happy eyeballs style.
+
+    The hosts are resolved to all their IPv4 and IPv6 addresses on a thread of the race, so starting a race never
+    blocks. The first attempt starts on the most promising
+    address, the next one stagger seconds later or as soon as an attempt fails, and so on until one attempt connects.
+    An attempt includes the prepare step, e.g. the TLS handshake, so a server that accepts connections but stalls the
+    handshake loses the race as well. Every attempt runs on its own thread, the sockets of the losers are closed.
+
+    The connect latency of every address is kept as an exponentially weighted moving average, a failure counts as
+    the timeout. Addresses whose last attempt succeeded come first, fastest first, then addresses without history in
+    resolution order alternating between address families, then addresses whose last attempt failed."""
+
+    def __init__(self, stagger=0.25, timeout=10.0, weight=0.3, resolve=None):
+
+        """
+        stagger -- seconds between the starts of two attempts
+        timeout -- seconds an attempt and the whole race may take
+        weight -- weight of the newest latency in the moving average
+        resolve -- Optional. function returning the stream addresses of a host and port in the format of
+                   socket.getaddrinfo, e.g. XivelyResolver.resolve, getaddrinfo by default"""
+
+        self._resolve = resolve
+        self._stagger = stagger
+        self._timeout = timeout
+        self._weight = weight
+
+        self._mutex = threading.Lock()
+        # [average latency, last attempt failed] by address
+        self._history = {}
+
+        self._races = 0
+        self._attempts = 0
+        self._failures = 0
+
+
+    def connect(self, endpoints, prepare=None):
+
+        """connect to one of the endpoints, waiting for the outcome of the race
+
+        endpoints -- list of (host, port, ...) tuples, the items after the port are left to the caller
+        prepare -- Optional. function called with a connected socket and its endpoint on the thread of the attempt,
+                   returns the socket to use, e.g. the SSL socket, and raises an exception if the attempt failed
+
+        returns -- (socket, endpoint) of the first attempt that finished
+
+        raises the exception of the last failed attempt if all of them failed, socket.timeout if none finished in time,
+        or the resolution error if no host could be resolved"""
+
+        race = self.start(endpoints, prepare)
+        winner = None
+
+        while winner is None:
+            winner = race.wait(self._timeout)
+
+        return winner
+
+
+    def start(self, endpoints, prepare=None, resolve=None):
+
+        """start a race like connect() without waiting for it, name resolution included
+
+        resolve -- Optional. resolve function of this race instead of the one of the connector, e.g. answering
+                   addresses the caller already has
+
+        returns -- a race, its wait(timeout) method returns the (socket, endpoint) of connect(), or None if the race
+                   is still running after timeout seconds, and raises the exceptions of connect(). The resolved
+                   attribute of the race is the monotonic clock value when the endpoints were resolved. Once there
+                   is a winner, the connected and prepared attributes are the monotonic clock values when its TCP
+                   connect and its prepare step finished."""
+
+        race = _Race(self, prepare, time.time() + self._timeout)
+
+        with self._mutex:
+            self._races += 1
+
+        resolver = threading.Thread(target = race._resolve, args = (endpoints, resolve))
+        resolver.daemon = True
+        resolver.start()
+
+        return race
+
+
+    def get_statistics(self):
+
+        """returns -- a dict with counters of races, attempts and failed attempts, and the average connect latency of
+        every address tried"""
+
+        with self._mutex:
+
+            return {
+                "races": self._races,
+                "attempts": self._attempts,
+                "failures": self._failures,
+                "latency": dict((address, history[0]) for address, history in self._history.items()) }
+
+
+    def _candidates(self, endpoints, resolve=None):
+
+        # (endpoint, family, address) of all resolved addresses, in the order they are tried
+        resolved = []
+        error = None
+
+        if resolve is None:
+            resolve = self._resolve
+
+        for endpoint in endpoints:
+            try:
+                if resolve is not None:
+                    addresses = resolve(endpoint[0], endpoint[1])
+                else:
+                    addresses = socket.getaddrinfo(endpoint[0], endpoint[1], 0, socket.SOCK_STREAM)
+                for family, socktype, proto, canonname, address in addresses:
+                    resolved.append((endpoint, family, address))
+            except socket.error as resolve_error:
+                error = resolve_error
+
+        if not resolved:
+            raise error if error is not None else socket.error("no endpoints")
+
+        # alternate address families, starting with the family of the first address
+        families = []
+        for candidate in resolved:
+            if candidate[1] not in families:
+                families.append(candidate[1])
+
+        by_family = [[candidate for candidate in resolved if candidate[1] == family] for family in families]
+        interleaved = []
+
+        for index in range(max(len(group) for group in by_family)):
+            for group in by_family:
+                if index < len(group):
+                    interleaved.append(group[index])
+
+        with self._mutex:
+
+            succeeded = []
+            unknown = []
+            failed = []
+
+            for candidate in interleaved:
+                history = self._history.get(candidate[2])
+                if history is None:
+                    unknown.append(candidate)
+                elif history[1]:
+                    failed.append((history[0], len(failed), candidate))
+                else:
+                    succeeded.append((history[0], len(succeeded), candidate))
+
+        # stable sorts on the average latency, the index keeps candidates from being compared
+        succeeded.sort()
+        failed.sort()
+
+        return [candidate for latency, index, candidate in succeeded] + unknown + \
+               [candidate for latency, index, candidate in failed]
+
+
+    def _record(self, address, latency, failed):
+
+        with self._mutex:
+
+            self._attempts += 1
+
+            if failed:
+                self._failures += 1
+                latency = self._timeout
+
+            history = self._history.get(address)
+
+            if history is None:
+                self._history[address] = [latency, failed]
+            else:
+                history[0] += self._weight * (latency - history[0])
+                history[1] = failed
+
+
+class _Race:
+
+    # state of one race shared with its attempts, guarded by cond
+
+    def __init__(self, connector, prepare, deadline):
+
+        self.connector = connector
+        # None until the endpoints are resolved
+        self.candidates = None
+        self.resolved = None
+        self.prepare = prepare
+        self.deadline = deadline
+
+        self.cond = threading.Condition()
+        self.started = 0
+        self.next_start = 0
+        self.running = 0
+        self.winner = None
+        self.connected = None
+        self.prepared = None
+        self.error = None
+        self.closed = False
+
+
+    def wait(self, timeout):
+
+        # starts the attempts that are due while waiting, see XivelyConnector.start()
+        with self.cond:
+
+            until = min(time.time() + timeout, self.deadline)
+
+            while self.winner is None:
+
+                now = time.time()
+
+                if self.candidates is None:
+                    if now >= self.deadline:
+                        break
+                    if now >= until:
+                        return None
+                    self.cond.wait(min(until, self.deadline) - now)
+                    continue
+
+                if self.started < len(self.candidates) and (now >= self.next_start or self.running == 0):
+                    self.running += 1
+                    self.started += 1
+                    self.next_start = now + self.connector._stagger
+                    attempt = threading.Thread(target = self._attempt, args = (self.candidates[self.started - 1],))
+                    attempt.daemon = True
+                    attempt.start()
+                    continue
+
+                if self.running == 0 or now >= self.deadline:
+                    break
+
+                if now >= until:
+                    return None
+
+                if self.started < len(self.candidates):
+                    self.cond.wait(min(self.next_start, until) - now)
+                else:
+                    self.cond.wait(until - now)
+
+            # the attempts still running close their sockets when they finish
+            self.closed = True
+
+            if self.winner is not None:
+                return self.winner
+
+            if self.error is not None and self.running == 0:
+                raise self.error
+
+        raise socket.timeout("timed out")
+
+
+    def _resolve(self, endpoints, resolve):
+
+        try:
+            candidates = self.connector._candidates(endpoints, resolve)
+            error = None
+        except Exception as resolve_error:
+            candidates = []
+            error = resolve_error
+
+        with self.cond:
+
+            self.candidates = candidates
+            self.resolved = _monotonic()
+            if error is not None:
+                self.error = error
+
+            self.cond.notify()
+
+
+    def _attempt(self, candidate):
+
+        endpoint, family, address = candidate
+        start = time.time()
+        sock = None
+
+        try:
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.settimeout(max(self.deadline - start, 0.001))
+            sock.connect(address)
+            connected = _monotonic()
+            if self.prepare is not None:
+                sock = self.prepare(sock, endpoint)
+            prepared = _monotonic()
+            sock.settimeout(None)
+            error = None
+        except Exception as attempt_error:
+            error = attempt_error
+            if sock is not None:
+                sock.close()
+                sock = None
+
+        self.connector._record(address, time.time() - start, error is not None)
+
+        with self.cond:
+
+            self.running -= 1
+
+            if error is None and self.winner is None and not self.closed:
+                self.winner = (sock, endpoint)
+                self.connected = connected
+                self.prepared = prepared
+                sock = None
+            elif error is not None:
+                self.error = error
+
+            self.cond.notify()
+
+        if sock is not None:
+            sock.close()
+
+
+# a listener that never accepts, so the handshake of prepare stalls, raced against one that answers
+def _check_race(rounds=3):
+
+    stalled = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    stalled.bind(("127.0.0.1", 0))
+    stalled.listen(8)
+
+    answering = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    answering.bind(("127.0.0.1", 0))
+    answering.listen(8)
+
+    def answer():
+        while True:
+            conn, address = answering.accept()
+            conn.sendall(b"hello")
+            conn.close()
+
+    answer_thread = threading.Thread(target = answer)
+    answer_thread.daemon = True
+    answer_thread.start()
+
+    def prepare(sock, endpoint):
+        if sock.recv(5) != b"hello":
+            raise socket.error("no greeting")
+        return sock
+
+    connector = XivelyConnector(stagger=0.25, timeout=2.0)
+    endpoints = [("127.0.0.1", stalled.getsockname()[1], "stalled"), ("127.0.0.1", answering.getsockname()[1], "answering")]
+
+    for index in range(rounds):
+        start = time.time()
+        sock, endpoint = connector.connect(endpoints, prepare)
+        sock.close()
+        print("race %d won by %s in %.1f ms" % (index, endpoint[2], (time.time() - start) * 1000))
+
+    print(connector.get_statistics())
+
+
+# for standalone testing
+if __name__ == '__main__':
+    _check_race()
@@ -0,0 +1,127 @@
+# Copyright (c) 2003-2016, Xively. All rights reserved.
+# This is part of Xively Python library, it is under the BSD 3-Clause license.
+
+import time
+import array
+import threading
+
+_INFINITY = float("inf")
+
+class XivelyDeadband:
+
+    """XivelyDeadband decides which timeseries values are worth publishing, report by exception.
+
+    A value of a filtered topic passes if it is the first one, if it moved more than the absolute or the percentage
+    deadband away from the last value that passed, or if max_silence seconds went by since then. Other values are
+    suppressed.
+
+    The state of a topic is one slot in a few arrays of doubles, so filtering tens of thousands of topics costs a
+    dictionary entry and some 50 bytes per topic."""
+
+    def __init__(self):
+
+        self._mutex = threading.Lock()
+        self._slots = {}
+        self._free = []
+
+        self._absolute = array.array('d')
+        self._percent = array.array('d')
+        self._max_silence = array.array('d')
+        self._last_value = array.array('d')
+        # time of the last value that passed, 0 before the first one
+        self._last_time = array.array('d')
+
+        self._passed = 0
+        self._suppressed = 0
+
+
+    def add_topic(self, topic, absolute=None, percent=None, max_silence=None):
+
+        """filter the values of a topic, the last value of a topic already filtered is forgotten
+
+        absolute -- Optional. smallest change that passes
+        percent -- Optional. smallest change that passes, in percent of the last value
+        max_silence -- Optional. seconds after which a value passes even if it didn't change
+
+        Without absolute and percent every change passes."""
+
+        if absolute is None and percent is None:
+            absolute = 0.0
+
+        with self._mutex:
+
+            slot = self._slots.get(topic)
+
+            if slot is None:
+                if self._free:
+                    slot = self._free.pop()
+                else:
+                    slot = len(self._last_time)
+                    for column in (self._absolute, self._percent, self._max_silence, self._last_value,
+                                   self._last_time):
+                        column.append(0.0)
+                self._slots[topic] = slot
+
+            self._absolute[slot] = _INFINITY if absolute is None else absolute
+            self._percent[slot] = _INFINITY if percent is None else percent / 100.0
+            self._max_silence[slot] = _INFINITY if max_silence is None else max_silence
+            self._last_time[slot] = 0.0
+
+
+    def remove_topic(self, topic):
+
+        """stop filtering a topic"""
+
+        with self._mutex:
+
+            slot = self._slots.pop(topic, None)
+            if slot is not None:
+                self._free.append(slot)
+
+
+    def check(self, topic, value, now=None):
+
+        """check a value of a topic, a value that passes becomes the new reference of the topic
+
+        now -- Optional. time.time() value of the check
+
+        returns -- True if the value should be published, also for topics that are not filtered"""
+
+        with self._mutex:
+
+            slot = self._slots.get(topic)
+            if slot is None:
+                return True
+
+            if now is None:
+                now = time.time()
+
+            last_time = self._last_time[slot]
+
+            if last_time != 0.0:
+                last_value = self._last_value[slot]
+                change = abs(value - last_value)
+
+                # a disabled band is infinite, the product is nan for a zero last value and never exceeded either
+                moved = change > self._absolute[slot] or change > self._percent[slot] * abs(last_value)
+
+                if not moved and now - last_time < self._max_silence[slot]:
+                    self._suppressed += 1
+                    return False
+
+            self._last_value[slot] = value
+            self._last_time[slot] = now
+            self._passed += 1
+            return True
+
+
+    def get_statistics(self):
+
+        """returns -- a dict with the number of filtered topics and counters of passed and suppressed values"""
+
+        with self._mutex:
+
+            return {
+                "topics": len(self._slots),
+                "passed": self._passed,
+                "suppressed": self._suppressed }
@@ -0,0 +1,198 @@
+# Copyright (c) 2003-2016, Xively. All rights reserved.
+# This is part of Xively Python library, it is under the BSD 3-Clause license.
+
+import time
+import threading
+from collections import deque
+
+# monotonic clock if available (py3), wall clock on py2.7
+_monotonic = getattr(time, "monotonic", time.time)
+
+class XivelyDispatcher:
+
+    """XivelyDispatcher runs message callbacks on a pool of worker threads instead of the network thread.
+
+    Messages are queued by topic. A topic is served by at most one worker at a time, so messages on the same topic
+    are delivered in the order they arrived, while different topics are processed in parallel.
+
+    dispatch() is called from the network thread and never waits, a message past the queue limits is dropped and
+    counted."""
+
+    def __init__(self, handler, worker_count, max_queued=0, max_queued_per_topic=0, on_error=None):
+
+        """
+        handler -- callable taking a XivelyMessage, called from the worker threads
+        worker_count -- number of worker threads
+        max_queued -- maximum number of messages waiting in all queues, 0 means unlimited
+        max_queued_per_topic -- maximum number of messages waiting on a single topic, 0 means unlimited
+        on_error -- Optional. callable taking the message and the exception raised by the handler, called from the
+                    worker thread. The error is counted in either case"""
+
+        self._handler = handler
+        self._worker_count = max(1, worker_count)
+        self._max_queued = max_queued
+        self._max_queued_per_topic = max_queued_per_topic
+        self._on_error = on_error
+
+        self._mutex = threading.Lock()
+        self._not_empty = threading.Condition(self._mutex)
+
+        self._queues = {}
+        self._ready = deque()
+        self._queued = 0
+        self._running = False
+        self._threads = []
+
+        self._queued_high_water = 0
+        self._dispatched = 0
+        self._dropped = 0
+        self._errors = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+
+    def start(self):
+
+        """start the worker threads, does nothing if they are already running"""
+
+        with self._mutex:
+
+            if self._running:
+                return
+
+            self._running = True
+
+            for index in range(self._worker_count):
+                thread = threading.Thread(target = self._worker, name = "xively-dispatcher-" + str(index))
+                thread.daemon = True
+                self._threads.append(thread)
+                thread.start()
+
+
+    def stop(self):
+
+        """stop the worker threads after delivering every queued message. Blocks until the workers exit, unless it
+        is called from one of the workers."""
+
+        with self._mutex:
+            self._running = False
+            self._not_empty.notify_all()
+            threads = self._threads
+            self._threads = []
+
+        current = threading.current_thread()
+
+        for thread in threads:
+            if thread is not current:
+                thread.join()
+
+
+    def dispatch(self, message):
+
+        """queue a message for delivery to the handler
+
+        returns -- True if the message was queued, False if it was dropped because the queue limits were reached"""
+
+        now = _monotonic()
+        topic = message.topic
+
+        with self._mutex:
+
+            if not self._running or self._is_full(topic):
+                self._dropped += 1
+                return False
+
+            queue = self._queues.get(topic)
+
+            if queue is None:
+                queue = deque()
+                self._queues[topic] = queue
+                self._ready.append(topic)
+                self._not_empty.notify()
+
+            queue.append((now, message))
+
+            self._queued += 1
+            if self._queued > self._queued_high_water:
+                self._queued_high_water = self._queued
+
+        return True
+
+
+    def get_statistics(self):
+
+        """returns -- a dict with the queue depth, message counters and queue latency in seconds.
+
+        queue_latency_mean and queue_latency_max tell how long messages waited for a free worker. If they grow
+        while the handler itself is fast, more workers are needed."""
+
+        with self._mutex:
+
+            if self._dispatched > 0:
+                latency_mean = self._latency_total / self._dispatched
+            else:
+                latency_mean = 0.0
+
+            return {
+                "workers": self._worker_count,
+                "queued": self._queued,
+                "queued_high_water": self._queued_high_water,
+                "dispatched": self._dispatched,
+                "dropped": self._dropped,
+                "errors": self._errors,
+                "queue_latency_mean": latency_mean,
+                "queue_latency_max": self._latency_max }
+
+
+    def _is_full(self, topic):
+
+        if self._max_queued > 0 and self._queued >= self._max_queued:
+            return True
+
+        if self._max_queued_per_topic > 0:
+            queue = self._queues.get(topic)
+            if queue is not None and len(queue) >= self._max_queued_per_topic:
+                return True
+
+        return False
+
+
+    def _worker(self):
+
+        while True:
+
+            with self._mutex:
+
+                while self._running and not self._ready:
+                    self._not_empty.wait()
+
+                if not self._ready:
+                    return
+
+                # the topic stays out of _ready while it is processed, this keeps per topic ordering
+                topic = self._ready.popleft()
+                queue = self._queues[topic]
+                enqueued, message = queue.popleft()
+                self._queued -= 1
+
+                latency = _monotonic() - enqueued
+                self._latency_total += latency
+                if latency > self._latency_max:
+                    self._latency_max = latency
+                self._dispatched += 1
+
+            try:
+                self._handler(message)
+            except Exception as error:
+                with self._mutex:
+                    self._errors += 1
+                if self._on_error is not None:
+                    self._on_error(message, error)
+
+            with self._mutex:
+
+                if queue:
+                    self._ready.append(topic)
+                    self._not_empty.notify()
+                else:
+                    del self._queues[topic]
@@ -18,3 +18,5 @@ class XivelyErrorCodes:
     XI_MQTT_IDENTIFIER_REJECTED = 11
     XI_SOCKET_ERROR = 12
     XI_SOCKET_CONNECTION_ERROR = 13
+    XI_MESSAGE_EXPIRED = 14
+    XI_MESSAGE_NOT_DELIVERED = 15
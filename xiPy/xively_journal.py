@@ -0,0 +1,535 @@
+# Copyright (c) 2003-2016, Xively. All rights reserved.
+# This is part of Xively Python library, it is under the BSD 3-Clause license.
+
+import os
+import sys
+import mmap
+import time
+import zlib
+import struct
+import threading
+from collections import deque
+
+# record header: crc32 of the rest of the record, body length, type
+_HEADER = struct.Struct("!IIB")
+# put body: key, qos, retain, topic length, payload length, then topic and payload
+_PUT = struct.Struct("!QBBHI")
+# tombstone body: key
+_TOMBSTONE = struct.Struct("!Q")
+
+_RECORD_PUT = 1
+_RECORD_TOMBSTONE = 2
+
+_SEGMENT_PREFIX = "segment-"
+_SEGMENT_SUFFIX = ".log"
+
+class XivelyJournal:
+
+    """XivelyJournal is a crash safe store for unacknowledged messages.
+
+    Messages are appended to segment files on publish and marked removed with a tombstone record when the broker
+    acknowledges them. Every record carries a crc, so a record torn by a crash is detected and cut off when the
+    journal is opened. The live records are kept in an index and read back through mmap.
+
+    When the active segment reaches segment_size a new one is started. A background thread deletes the oldest
+    segment once nothing in it is live, or copies its few live records forward first. Segments are only ever
+    compacted oldest first, so a tombstone can never outlive the record it removes."""
+
+    FSYNC_ALWAYS = "always"
+    FSYNC_BATCH = "batch"
+    FSYNC_NONE = "none"
+
+    def __init__(self, path, fsync_policy=FSYNC_BATCH, segment_size=4*1024*1024, batch_interval=0.05,
+                 compact_ratio=0.5):
+
+        """
+        path -- directory of the segment files, created if missing
+        fsync_policy -- FSYNC_ALWAYS syncs every record before append returns, FSYNC_BATCH syncs from the background
+                        thread every batch_interval seconds, FSYNC_NONE leaves it to the operating system. A process
+                        crash loses nothing in any mode, a power failure loses up to batch_interval seconds of records
+                        with FSYNC_BATCH and an unknown amount with FSYNC_NONE
+        segment_size -- size in bytes after which a new segment file is started
+        batch_interval -- seconds between syncs with FSYNC_BATCH
+        compact_ratio -- the oldest segment is compacted once its live bytes drop below this share of its size"""
+
+        if fsync_policy not in (self.FSYNC_ALWAYS, self.FSYNC_BATCH, self.FSYNC_NONE):
+            raise ValueError("invalid fsync policy: " + str(fsync_policy))
+
+        self._path = path
+        self._fsync_policy = fsync_policy
+        self._segment_size = segment_size
+        self._batch_interval = batch_interval
+        self._compact_ratio = compact_ratio
+
+        self._mutex = threading.Lock()
+        self._wakeup = threading.Condition(self._mutex)
+
+        # key -> (segment id, offset, record length) of live put records, and the keys in append order. Removed
+        # keys leave _order lazily when they reach its head
+        self._index = {}
+        self._order = deque()
+        # segment id -> size, live bytes, mmap
+        self._segments = []
+        self._sizes = {}
+        self._live_bytes = {}
+        self._maps = {}
+
+        self._next_key = 1
+        self._active = None
+        self._fd = None
+        self._dirty = False
+        self._closed = False
+
+        self._appended = 0
+        self._removed = 0
+        self._compacted = 0
+        self._fsyncs = 0
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self._load()
+
+        self._thread = threading.Thread(target = self._background, name = "xively-journal")
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def append(self, topic, payload, qos, retain):
+
+        """store a message
+
+        topic -- the topic string
+        payload -- bytes, bytearray, a string, an int, a float or None, converted the way the mqtt client does
+        qos -- the quality of service level
+        retain -- the retain flag
+
+        returns -- the key of the record, pass it to remove() once the message is acknowledged"""
+
+        utopic = topic.encode("utf-8")
+
+        if payload is None:
+            payload = b""
+        elif isinstance(payload, int) or isinstance(payload, float):
+            payload = str(payload).encode("utf-8")
+        elif not isinstance(payload, bytes) and not isinstance(payload, bytearray):
+            payload = payload.encode("utf-8")
+
+        with self._mutex:
+
+            key = self._next_key
+            self._next_key += 1
+
+            body = _PUT.pack(key, qos, int(retain), len(utopic), len(payload)) + utopic + bytes(payload)
+            offset, length = self._write(_RECORD_PUT, body)
+
+            self._index[key] = (self._active, offset, length)
+            self._order.append(key)
+            self._live_bytes[self._active] += length
+            self._appended += 1
+
+            self._rollover_check()
+
+        return key
+
+
+    def remove(self, key):
+
+        """mark the message with the given key as delivered, unknown keys are ignored"""
+
+        with self._mutex:
+
+            entry = self._index.pop(key, None)
+
+            if entry is None:
+                return
+
+            self._live_bytes[entry[0]] -= entry[2]
+            self._write(_RECORD_TOMBSTONE, _TOMBSTONE.pack(key))
+            self._removed += 1
+
+            self._rollover_check()
+
+
+    def records(self):
+
+        """returns -- a list of (key, topic, payload, qos, retain) tuples of the live messages in publish order. The
+        payload is a bytearray."""
+
+        return self.head(None)
+
+
+    def head(self, count):
+
+        """returns -- the oldest count live messages like records(), all of them if count is None"""
+
+        with self._mutex:
+
+            order = self._order
+            while order and order[0] not in self._index:
+                order.popleft()
+
+            result = []
+
+            for key in order:
+
+                if count is not None and len(result) >= count:
+                    break
+
+                entry = self._index.get(key)
+                if entry is None:
+                    continue
+
+                segment, offset, length = entry
+                data = self._read(segment, offset, length)
+                qos, retain, topic_length, payload_length = _PUT.unpack_from(data, _HEADER.size)[1:]
+                start = _HEADER.size + _PUT.size
+                topic = data[start:start + topic_length].decode("utf-8")
+                payload = bytearray(data[start + topic_length:start + topic_length + payload_length])
+                result.append((key, topic, payload, qos, bool(retain)))
+
+            return result
+
+
+    def __len__(self):
+
+        return len(self._index)
+
+
+    def sync(self):
+
+        """write every record to disk now, regardless of the fsync policy"""
+
+        with self._mutex:
+            self._sync()
+
+
+    def close(self):
+
+        """sync and close the journal, the background thread stops"""
+
+        with self._mutex:
+
+            if self._closed:
+                return
+
+            self._closed = True
+            self._wakeup.notify()
+
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+        with self._mutex:
+
+            self._sync()
+            os.close(self._fd)
+            self._fd = None
+
+            for segment in list(self._maps):
+                self._unmap(segment)
+
+
+    def get_statistics(self):
+
+        """returns -- a dict with the number of segments, live records and bytes on disk, and counters of appended,
+        removed and compacted records and of fsync calls"""
+
+        with self._mutex:
+
+            return {
+                "segments": len(self._segments),
+                "live_records": len(self._index),
+                "bytes": sum(self._sizes.values()),
+                "appended": self._appended,
+                "removed": self._removed,
+                "compacted": self._compacted,
+                "fsyncs": self._fsyncs }
+
+
+    def _segment_file(self, segment):
+
+        return os.path.join(self._path, _SEGMENT_PREFIX + "%016d" % segment + _SEGMENT_SUFFIX)
+
+
+    def _load(self):
+
+        segments = []
+
+        for name in os.listdir(self._path):
+            if name.startswith(_SEGMENT_PREFIX) and name.endswith(_SEGMENT_SUFFIX):
+                try:
+                    segments.append(int(name[len(_SEGMENT_PREFIX):-len(_SEGMENT_SUFFIX)]))
+                except ValueError:
+                    pass
+
+        segments.sort()
+
+        for segment in segments:
+            self._segments.append(segment)
+            self._live_bytes[segment] = 0
+            self._sizes[segment] = self._scan(segment, segment == segments[-1])
+
+        self._order.extend(sorted(self._index))
+
+        if segments:
+            self._open_segment(segments[-1])
+        else:
+            self._open_segment(1)
+
+
+    def _scan(self, segment, last):
+
+        # rebuild the index from one segment, returns the size of its valid part
+        file_name = self._segment_file(segment)
+        size = os.path.getsize(file_name)
+        offset = 0
+
+        if size > 0:
+
+            data = self._map(segment, size)
+
+            while offset + _HEADER.size <= size:
+
+                crc, length, record_type = _HEADER.unpack_from(data, offset)
+                end = offset + _HEADER.size + length
+
+                if end > size or zlib.crc32(data[offset + 4:end]) & 0xffffffff != crc:
+                    break
+
+                if record_type == _RECORD_PUT:
+                    key = _PUT.unpack_from(data, offset + _HEADER.size)[0]
+                    # a record copied forward by an interrupted compaction appears twice, the later copy wins
+                    self._index_drop(key)
+                    self._index[key] = (segment, offset, end - offset)
+                    self._live_bytes[segment] += end - offset
+                    self._next_key = max(self._next_key, key + 1)
+
+                elif record_type == _RECORD_TOMBSTONE:
+                    key = _TOMBSTONE.unpack_from(data, offset + _HEADER.size)[0]
+                    self._index_drop(key)
+
+                offset = end
+
+        if offset < size:
+            # torn or corrupt tail, only expected in the last segment after a crash
+            self._unmap(segment)
+            with open(file_name, "r+b") as segment_file:
+                segment_file.truncate(offset)
+
+        return offset
+
+
+    def _index_drop(self, key):
+
+        entry = self._index.pop(key, None)
+        if entry is not None:
+            self._live_bytes[entry[0]] -= entry[2]
+
+
+    def _open_segment(self, segment):
+
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, "O_BINARY", 0)
+        self._fd = os.open(self._segment_file(segment), flags, 0o644)
+        self._active = segment
+
+        if segment not in self._sizes:
+            self._segments.append(segment)
+            self._sizes[segment] = 0
+            self._live_bytes[segment] = 0
+            self._sync_directory()
+
+
+    def _rollover_check(self):
+
+        if self._sizes[self._active] < self._segment_size:
+            return
+
+        if self._fsync_policy != self.FSYNC_NONE:
+            self._sync()
+
+        os.close(self._fd)
+        self._open_segment(self._active + 1)
+        self._wakeup.notify()
+
+
+    def _write(self, record_type, body):
+
+        # called with the mutex held, returns the offset and length of the record
+        record = _HEADER.pack(0, len(body), record_type) + body
+        record = struct.pack("!I", zlib.crc32(record[4:]) & 0xffffffff) + record[4:]
+
+        offset = self._sizes[self._active]
+        written = 0
+
+        while written < len(record):
+            written += os.write(self._fd, record[written:])
+
+        self._sizes[self._active] = offset + len(record)
+
+        if self._fsync_policy == self.FSYNC_ALWAYS:
+            os.fsync(self._fd)
+            self._fsyncs += 1
+        else:
+            self._dirty = True
+
+        return offset, len(record)
+
+
+    def _sync(self):
+
+        if self._dirty and self._fd is not None:
+            os.fsync(self._fd)
+            self._fsyncs += 1
+            self._dirty = False
+
+
+    def _sync_directory(self):
+
+        # make a new segment file survive a power failure, not possible on every platform
+        if sys.platform.startswith("win"):
+            return
+
+        try:
+            fd = os.open(self._path, os.O_RDONLY)
+        except OSError:
+            return
+
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+
+    def _map(self, segment, size):
+
+        data = self._maps.get(segment)
+
+        if data is None or len(data) < size:
+            self._unmap(segment)
+            with open(self._segment_file(segment), "rb") as segment_file:
+                data = mmap.mmap(segment_file.fileno(), 0, access = mmap.ACCESS_READ)
+            self._maps[segment] = data
+
+        return data
+
+
+    def _unmap(self, segment):
+
+        data = self._maps.pop(segment, None)
+        if data is not None:
+            data.close()
+
+
+    def _read(self, segment, offset, length):
+
+        # records are written with os.write, so the file contents are visible to the map at once
+        return self._map(segment, offset + length)[offset:offset + length]
+
+
+    def _compact(self):
+
+        # called with the mutex held, handles the oldest segment only, returns True if it was removed
+        if len(self._segments) < 2:
+            return False
+
+        segment = self._segments[0]
+        size = self._sizes[segment]
+        live_bytes = self._live_bytes[segment]
+
+        if live_bytes > 0 and live_bytes >= size * self._compact_ratio:
+            return False
+
+        if live_bytes > 0:
+
+            live = sorted((entry[1], key, entry[2]) for key, entry in self._index.items() if entry[0] == segment)
+
+            for offset, key, length in live:
+
+                record = self._read(segment, offset, length)
+                new_offset = self._sizes[self._active]
+                written = 0
+
+                while written < length:
+                    written += os.write(self._fd, record[written:])
+
+                self._sizes[self._active] = new_offset + length
+                self._index[key] = (self._active, new_offset, length)
+                self._live_bytes[self._active] += length
+                self._compacted += 1
+
+            # the copies must be on disk before the originals go away
+            self._dirty = True
+            self._sync()
+
+        self._unmap(segment)
+        os.remove(self._segment_file(segment))
+
+        self._segments.pop(0)
+        del self._sizes[segment]
+        del self._live_bytes[segment]
+
+        self._rollover_check()
+
+        return True
+
+
+    def _background(self):
+
+        with self._mutex:
+
+            while not self._closed:
+
+                if self._fsync_policy == self.FSYNC_BATCH:
+                    self._wakeup.wait(self._batch_interval)
+                    self._sync()
+                else:
+                    self._wakeup.wait(1.0)
+
+                while not self._closed and self._compact():
+                    pass
+
+
+# throughput of append and remove for each fsync policy
+def _benchmark(message_count=20000, payload_size=100):
+
+    import shutil
+    import tempfile
+
+    payload = bytearray(b"x" * payload_size)
+
+    for policy in (XivelyJournal.FSYNC_NONE, XivelyJournal.FSYNC_BATCH, XivelyJournal.FSYNC_ALWAYS):
+
+        count = message_count if policy != XivelyJournal.FSYNC_ALWAYS else message_count // 20
+        path = tempfile.mkdtemp()
+
+        try:
+            journal = XivelyJournal(path, policy, segment_size = 1024 * 1024)
+
+            start = time.time()
+            keys = [journal.append("bench/topic", payload, 1, False) for index in range(count)]
+            append_time = time.time() - start
+
+            start = time.time()
+            for key in keys:
+                journal.remove(key)
+            remove_time = time.time() - start
+
+            journal.close()
+
+            # reopening has to find nothing live
+            journal = XivelyJournal(path, policy)
+            assert journal.records() == []
+            journal.close()
+
+            print("%-6s %7d messages  append %9.0f msg/s  remove %9.0f msg/s" %
+                  (policy, count, count / append_time, count / remove_time))
+
+        finally:
+            shutil.rmtree(path)
+
+
+# for standalone testing
+if __name__ == '__main__':
+    _benchmark()
@@ -1,10 +1,12 @@
 # Copyright (c) 2003-2016, Xively. All rights reserved.
 # This is part of Xively Python library, it is under the BSD 3-Clause license.
 
-class XivelyMessage:
+class XivelyMessage(object):
 
     """XivelyMessage class is for encapsulating message parameters"""
 
+    __slots__ = ("qos", "topic", "payload", "request_id")
+
     def __init__(self):
 
         """
@@ -22,3 +24,121 @@ class XivelyMessage:
     def __str__(self):
 
         return "topic: " + str( self.topic) + " payload: " + str( self.payload ) + " qos: " + str( self.qos ) + " request_id: " + str( self.request_id )
+
+
+class XivelyMessagePool:
+
+    """XivelyMessagePool is a free list of XivelyMessage objects.
+
+    The client takes incoming messages from the pool and puts them back once on_message_received returns, so a
+    steady message flow allocates no message objects. Enabled with the recycle_messages connection parameter. The
+    callback must not keep a reference to the message, copy the fields it needs instead."""
+
+    def __init__(self, max_size=1024):
+
+        """
+        max_size -- the most messages kept in the free list, more are left to the garbage collector"""
+
+        self._free = []
+        self._max_size = max_size
+
+
+    def acquire(self):
+
+        """returns -- a XivelyMessage from the free list, or a new one if the list is empty"""
+
+        # list.pop and list.append are atomic, the pool needs no lock for the callback workers
+        try:
+            return self._free.pop()
+        except IndexError:
+            return XivelyMessage()
+
+
+    def release(self, message):
+
+        """put a message back into the free list"""
+
+        if len(self._free) < self._max_size:
+            message.topic = ""
+            message.payload = None
+            self._free.append(message)
+
+
+# allocation growth of the message paths once they are warmed up
+def _check_steady_state_allocations(rounds=5, messages_per_round=20000):
+
+    import gc
+    import sys
+    import socket
+    import threading
+
+    try:
+        import tracemalloc
+    except ImportError:
+        print("tracemalloc needs Python 3.4 or later")
+        return
+
+    from .paho_mqtt_client import Client, MQTTMessage
+    from .xively_client import XivelyClient
+
+    listensock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listensock.bind(("127.0.0.1", 0))
+    listensock.listen(1)
+
+    def sink():
+        conn, address = listensock.accept()
+        while conn.recv(65536):
+            pass
+        conn.close()
+
+    sink_thread = threading.Thread(target = sink)
+    sink_thread.daemon = True
+    sink_thread.start()
+
+    client = XivelyClient()
+    client._message_pool = XivelyMessagePool()
+    client.on_message_received = lambda client, message: None
+    client._mqtt = Client("allocations")
+    client._mqtt.connect("127.0.0.1", listensock.getsockname()[1])
+
+    inbound = MQTTMessage()
+    inbound.topic = "allocations/in"
+    inbound.payload = bytearray(32)
+    outbound = bytearray(32)
+
+    def run_round():
+        for index in range(messages_per_round):
+            client._mqtt_on_message_received(inbound)
+            client._publish_now("allocations/out", outbound, 0, False, None)
+        while client._mqtt.want_write():
+            client._mqtt.loop(0.01)
+
+    # the first round fills the free list and the interpreter caches
+    run_round()
+
+    tracemalloc.start()
+    package = tracemalloc.Filter(True, "*" + __name__.split(".")[0] + "*")
+    gc.collect()
+    baseline = tracemalloc.take_snapshot().filter_traces((package,))
+
+    for index in range(rounds):
+        run_round()
+
+    gc.collect()
+    growth = tracemalloc.take_snapshot().filter_traces((package,)).compare_to(baseline, "lineno")
+    tracemalloc.stop()
+    client._mqtt.disconnect()
+
+    total = sum(stat.size_diff for stat in growth)
+    print("%d messages in and out, allocation growth %d bytes" % (rounds * messages_per_round, total))
+
+    for stat in growth:
+        if stat.size_diff > 0:
+            print(stat)
+
+    assert total <= 0, "message paths keep memory across rounds"
+
+
+# for standalone testing
+if __name__ == '__main__':
+    _check_steady_state_allocations()
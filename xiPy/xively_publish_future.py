@@ -0,0 +1,116 @@
+# Copyright (c) 2003-2016, Xively. All rights reserved.
+# This is part of Xively Python library, it is under the BSD 3-Clause license.
+
+import time
+from .xively_error_codes import XivelyErrorCodes as xec
+
+class XivelyPublishFuture(object):
+
+    """XivelyPublishFuture tracks the completion of a single publish request.
+
+    It is returned by XivelyClient.publish() when want_future is set. It resolves when the broker confirms the
+    message (PUBACK for QoS 1, PUBCOMP for QoS 2, the socket write for QoS 0) and fails when the connection closes or
+    the deadline passes first.
+
+    Futures of one client share a single condition variable, so a future costs no lock of its own and wait_all()
+    can wait for thousands of them at once.
+
+    request_id is None while the message waits in the store and forward buffer."""
+
+    __slots__ = ("request_id", "deadline", "_cond", "_done", "_error")
+
+    def __init__(self, cond, request_id, deadline=None):
+
+        self.request_id = request_id
+        self.deadline = deadline
+        self._cond = cond
+        self._done = False
+        self._error = xec.XI_STATE_OK
+
+
+    def done(self):
+
+        """returns -- True if the future resolved or failed"""
+
+        return self._done
+
+
+    def succeeded(self):
+
+        """returns -- True if the broker confirmed the message"""
+
+        return self._done and self._error == xec.XI_STATE_OK
+
+
+    def error(self):
+
+        """returns -- XI_STATE_OK if the message was confirmed or the future is still pending, otherwise the reason
+        of the failure: XI_MESSAGE_NOT_DELIVERED or XI_MESSAGE_EXPIRED"""
+
+        return self._error
+
+
+    def wait(self, timeout=None):
+
+        """wait until the future resolves or fails
+
+        timeout -- seconds to wait, None waits forever
+
+        returns -- True if the future is done, False if the timeout expired first"""
+
+        return wait_all((self,), timeout)
+
+
+    def _set_result(self, error):
+
+        # called by the client with the condition held
+        if not self._done:
+            self._done = True
+            self._error = error
+
+
+def wait_all(futures, timeout=None):
+
+    """wait until every future in the sequence resolves or fails. All futures must come from the same client.
+
+    futures -- sequence of XivelyPublishFuture instances
+    timeout -- seconds to wait, None waits forever
+
+    returns -- True if every future is done, False if the timeout expired first
+
+    raises ValueError if the futures come from different clients, the wait would miss the completions of some"""
+
+    futures = list(futures)
+
+    if not futures:
+        return True
+
+    cond = futures[0]._cond
+
+    for future in futures:
+        if future._cond is not cond:
+            raise ValueError('Futures of different clients.')
+    index = 0
+    deadline = None
+
+    if timeout is not None:
+        deadline = time.time() + timeout
+
+    with cond:
+
+        # futures complete roughly in order, so each wakeup resumes the scan where the previous one stopped
+        while index < len(futures):
+
+            if futures[index]._done:
+                index += 1
+                continue
+
+            if deadline is None:
+                cond.wait()
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                cond.wait(remaining)
+
+    return True
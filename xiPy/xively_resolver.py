@@ -0,0 +1,291 @@
+# Copyright (c) 2003-2016, Xively. All rights reserved.
+# This is part of Xively Python library, it is under the BSD 3-Clause license.
+
+import time
+import socket
+import threading
+
+class XivelyResolver:
+
+    """XivelyResolver caches the addresses of the broker hosts, so a slow or unreachable DNS server doesn't stall
+    every reconnect.
+
+    Resolution runs on a thread of its own. A host resolved less than ttl seconds ago is answered from the cache. An
+    older entry is still answered from the cache while a refresh runs in the background, stale while revalidate. If the
+    refresh fails the last good addresses stay in use and the next lookup tries again. Only a host that was never
+    resolved has to wait, at most timeout seconds."""
+
+    def __init__(self, ttl=300.0, timeout=10.0, getaddrinfo=None):
+
+        """
+        ttl -- seconds a resolution is fresh
+        timeout -- seconds resolve() waits for a host that is not cached
+        getaddrinfo -- Optional. function with the signature of socket.getaddrinfo, for tests"""
+
+        self._ttl = ttl
+        self._timeout = timeout
+        self._getaddrinfo = socket.getaddrinfo if getaddrinfo is None else getaddrinfo
+
+        self._cond = threading.Condition()
+        # _Entry by (host, port)
+        self._entries = {}
+
+        # resolutions finished, and the count seen by the last lookup(), see wait()
+        self._finished = 0
+        self._looked_up = 0
+
+        self._hits = 0
+        self._stale_hits = 0
+        self._misses = 0
+        self._failures = 0
+
+
+    def resolve(self, host, port):
+
+        """returns -- a list of (family, socktype, proto, canonname, sockaddr) stream addresses like
+        socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+
+        raises the resolution error, or socket.timeout if a host that is not cached takes too long"""
+
+        with self._cond:
+
+            entry = self._entry(host, port)
+
+            if entry.addresses is not None:
+                if time.time() - entry.time < self._ttl:
+                    self._hits += 1
+                else:
+                    self._stale_hits += 1
+                    self._refresh(host, port, entry)
+                return list(entry.addresses)
+
+            self._refresh(host, port, entry)
+
+            deadline = time.time() + self._timeout
+
+            while entry.resolving:
+                now = time.time()
+                if now >= deadline:
+                    raise socket.timeout("resolving %s timed out" % host)
+                self._cond.wait(deadline - now)
+
+            if entry.addresses is None:
+                raise entry.error
+
+            return list(entry.addresses)
+
+
+    def lookup(self, host, port):
+
+        """resolve() without waiting, for a caller that polls from a loop
+
+        returns -- the addresses of resolve(), or None while a host that is not cached is being resolved
+
+        raises the resolution error if the last resolution of a host that is not cached failed"""
+
+        with self._cond:
+
+            self._looked_up = self._finished
+            entry = self._entry(host, port)
+
+            if entry.addresses is not None:
+                if time.time() - entry.time < self._ttl:
+                    self._hits += 1
+                else:
+                    self._stale_hits += 1
+                    self._refresh(host, port, entry)
+                return list(entry.addresses)
+
+            if entry.resolving:
+                return None
+
+            if entry.error is not None:
+                raise entry.error
+
+            self._refresh(host, port, entry)
+            return None
+
+
+    def wait(self, timeout):
+
+        """wait at most timeout seconds for a resolution to finish, returns at once if one finished since the last
+        lookup()"""
+
+        with self._cond:
+
+            deadline = time.time() + timeout
+
+            while self._finished == self._looked_up:
+                now = time.time()
+                if now >= deadline:
+                    return
+                self._cond.wait(deadline - now)
+
+
+    def prefetch(self, host, port):
+
+        """start resolving a host in the background if it is not cached or stale"""
+
+        with self._cond:
+
+            entry = self._entry(host, port)
+
+            if entry.addresses is None or time.time() - entry.time >= self._ttl:
+                self._refresh(host, port, entry)
+
+
+    def get_statistics(self):
+
+        """returns -- a dict with the number of cached hosts and counters of fresh and stale cache hits, misses and
+        failed resolutions"""
+
+        with self._cond:
+
+            return {
+                "hosts": len(self._entries),
+                "hits": self._hits,
+                "stale_hits": self._stale_hits,
+                "misses": self._misses,
+                "failures": self._failures }
+
+
+    def _entry(self, host, port):
+
+        # called with the lock held
+        entry = self._entries.get((host, port))
+
+        if entry is None:
+            entry = _Entry()
+            self._entries[(host, port)] = entry
+
+        return entry
+
+
+    def _refresh(self, host, port, entry):
+
+        # called with the lock held, a single resolution per host at a time
+        if entry.resolving:
+            return
+
+        entry.resolving = True
+        entry.error = None
+
+        if entry.addresses is None:
+            self._misses += 1
+
+        resolver = threading.Thread(target = self._resolve, args = (host, port, entry))
+        resolver.daemon = True
+        resolver.start()
+
+
+    def _resolve(self, host, port, entry):
+
+        try:
+            addresses = self._getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+            error = None
+        except Exception as resolve_error:
+            addresses = None
+            error = resolve_error
+
+        with self._cond:
+
+            entry.resolving = False
+            self._finished += 1
+
+            if error is None and addresses:
+                entry.addresses = addresses
+                entry.time = time.time()
+            else:
+                # the last good addresses stay in use
+                self._failures += 1
+                entry.error = error if error is not None else socket.gaierror("no addresses for %s" % host)
+
+            self._cond.notify_all()
+
+
+class _Entry(object):
+
+    __slots__ = ("addresses", "time", "error", "resolving")
+
+    def __init__(self):
+
+        self.addresses = None
+        self.time = 0.0
+        self.error = None
+        self.resolving = False
+
+
+# cold, fresh, stale and failed lookups against a fake resolver whose answer, delay and failure are set by the check
+def _check_fake_resolver():
+
+    state = { "address": "10.0.0.1", "delay": 0.0, "fail": False, "calls": 0 }
+
+    def getaddrinfo(host, port, family, socktype):
+        state["calls"] += 1
+        time.sleep(state["delay"])
+        if state["fail"]:
+            raise socket.gaierror(-3, "Temporary failure in name resolution")
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", (state["address"], port))]
+
+    def lookup():
+        start = time.time()
+        address = resolver.resolve("broker", 8883)[0][4][0]
+        return address, (time.time() - start) * 1000
+
+    resolver = XivelyResolver(ttl=0.2, timeout=0.5, getaddrinfo=getaddrinfo)
+
+    address, elapsed = lookup()
+    print("cold lookup %s in %.1f ms" % (address, elapsed))
+    assert address == "10.0.0.1"
+
+    address, elapsed = lookup()
+    print("fresh lookup %s in %.1f ms" % (address, elapsed))
+    assert state["calls"] == 1
+
+    # past the ttl with a slow DNS server, the stale address is answered at once and refreshed in the background
+    time.sleep(0.25)
+    state["address"] = "10.0.0.2"
+    state["delay"] = 0.1
+    address, elapsed = lookup()
+    print("stale lookup %s in %.1f ms while refreshing" % (address, elapsed))
+    assert address == "10.0.0.1" and elapsed < 50
+
+    time.sleep(0.15)
+    address, elapsed = lookup()
+    print("refreshed lookup %s in %.1f ms" % (address, elapsed))
+    assert address == "10.0.0.2"
+
+    # a failing DNS server keeps the last good address
+    time.sleep(0.25)
+    state["fail"] = True
+    state["delay"] = 0.0
+    lookup()
+    time.sleep(0.05)
+    address, elapsed = lookup()
+    print("lookup with failing DNS %s in %.1f ms" % (address, elapsed))
+    assert address == "10.0.0.2"
+
+    # a host never resolved waits at most the timeout
+    state["delay"] = 2.0
+    start = time.time()
+    try:
+        resolver.resolve("other", 8883)
+        assert False, "no timeout"
+    except socket.timeout:
+        print("cold lookup with stalled DNS timed out after %.1f ms" % ((time.time() - start) * 1000))
+
+    # polling a host that is not cached answers None until it is resolved
+    state["delay"] = 0.1
+    state["fail"] = False
+    start = time.time()
+    assert resolver.lookup("polled", 8883) is None
+    while resolver.lookup("polled", 8883) is None:
+        resolver.wait(1.0)
+    print("polled cold lookup in %.1f ms" % ((time.time() - start) * 1000))
+
+    print(resolver.get_statistics())
+
+
+# for standalone testing
+if __name__ == '__main__':
+    _check_fake_resolver()
@@ -0,0 +1,229 @@
+# Copyright (c) 2003-2016, Xively. All rights reserved.
+# This is part of Xively Python library, it is under the BSD 3-Clause license.
+
+import sys
+import time
+import threading
+import itertools
+from collections import deque
+from .xively_journal import XivelyJournal
+
+class XivelyStoreForward:
+
+    """XivelyStoreForward buffers messages published while the client can't send them.
+
+    Messages are kept in memory up to memory_limit. Past that they are spilled to a XivelyJournal if spill_path is
+    set, otherwise they are refused. Once something is spilled, new messages go to disk as well until the disk part
+    is drained, so the buffer stays first in first out.
+
+    The client drains the buffer after CONNACK. A token bucket limits the drain to drain_rate messages per second,
+    so a long backlog doesn't starve new traffic or flood the broker."""
+
+    def __init__(self, memory_limit, spill_path=None, drain_rate=0, spill_fsync=XivelyJournal.FSYNC_BATCH):
+
+        """
+        memory_limit -- maximum number of messages held in memory
+        spill_path -- directory for messages past memory_limit, None refuses them instead
+        drain_rate -- messages per second sent after a connect, 0 means unlimited
+        spill_fsync -- fsync policy of the spill journal"""
+
+        self._memory_limit = memory_limit
+        self._drain_rate = drain_rate
+
+        self._mutex = threading.Lock()
+        self._memory = deque()
+
+        self._spill_path = spill_path
+        self._spill_fsync = spill_fsync
+        self._spill = None
+        # messages on disk while the spill journal is closed, see close()
+        self._spill_closed = 0
+        # futures and deadlines of spilled messages by journal key, they don't survive a restart
+        self._spill_futures = {}
+        self._spill_deadlines = {}
+
+        if spill_path is not None:
+            self._spill = XivelyJournal(spill_path, spill_fsync)
+
+        self._tokens = 0.0
+        self._refilled = time.time()
+
+        self._stored = 0
+        self._spilled = 0
+        self._forwarded = 0
+        self._refused = 0
+        self._expired = 0
+
+
+    def put(self, topic, payload, qos, retain, future=None, deadline=None):
+
+        """buffer a message, topic, payload and qos are checked the way the mqtt client checks them
+
+        future -- optional XivelyPublishFuture of the message
+        deadline -- optional time.time() value after which the message is dropped instead of sent
+
+        returns -- True if the message was buffered, False if the buffer is full"""
+
+        _validate(topic, payload, qos)
+
+        with self._mutex:
+
+            if len(self._memory) < self._memory_limit and self._spill_pending() == 0:
+                self._memory.append((topic, payload, qos, retain, future, deadline))
+
+            elif self._spill_path is not None:
+                key = self._spill_journal().append(topic, payload, qos, retain)
+                if future is not None:
+                    self._spill_futures[key] = future
+                if deadline is not None:
+                    self._spill_deadlines[key] = deadline
+                self._spilled += 1
+
+            else:
+                self._refused += 1
+                return False
+
+            self._stored += 1
+
+        return True
+
+
+    def pending(self):
+
+        """returns -- the number of buffered messages"""
+
+        return len(self._memory) + self._spill_pending()
+
+
+    def peek(self, count):
+
+        """returns -- a list of up to count of the oldest (topic, payload, qos, retain, future, deadline) tuples, they
+        stay in the buffer until pop() is called"""
+
+        with self._mutex:
+
+            result = list(itertools.islice(self._memory, count))
+
+            if len(result) < count and self._spill_pending() > 0:
+                for key, topic, payload, qos, retain in self._spill_journal().head(count - len(result)):
+                    result.append((topic, payload, qos, retain, self._spill_futures.get(key),
+                                   self._spill_deadlines.get(key)))
+
+            return result
+
+
+    def pop(self, count, expired=0):
+
+        """remove the count oldest messages after they were sent
+
+        expired -- how many of them were dropped because their deadline passed, they don't use the drain rate"""
+
+        with self._mutex:
+
+            self._forwarded += count - expired
+            self._expired += expired
+            self._tokens = max(0.0, self._tokens - (count - expired))
+
+            while count > 0 and self._memory:
+                self._memory.popleft()
+                count -= 1
+
+            if count > 0 and self._spill_pending() > 0:
+                spill = self._spill_journal()
+                for record in spill.head(count):
+                    spill.remove(record[0])
+                    self._spill_futures.pop(record[0], None)
+                    self._spill_deadlines.pop(record[0], None)
+
+
+    def drain_budget(self):
+
+        """returns -- the number of messages that may be sent now according to drain_rate"""
+
+        if self._drain_rate <= 0:
+            return sys.maxsize
+
+        with self._mutex:
+
+            now = time.time()
+            # one second worth of burst at most
+            self._tokens = min(float(self._drain_rate), self._tokens + (now - self._refilled) * self._drain_rate)
+            self._refilled = now
+
+            return int(self._tokens)
+
+
+    def drain_delay(self):
+
+        """returns -- seconds until drain_budget() allows another message"""
+
+        if self._drain_rate <= 0:
+            return 0.0
+
+        with self._mutex:
+            return max(0.0, (1.0 - self._tokens) / self._drain_rate)
+
+
+    def close(self):
+
+        """close the spill journal and stop its thread, spilled messages stay on disk. Memory messages are kept, the
+        journal is opened again once the buffer has to go to disk"""
+
+        with self._mutex:
+
+            if self._spill is not None:
+                self._spill_closed = len(self._spill)
+                self._spill.close()
+                self._spill = None
+
+
+    def get_statistics(self):
+
+        """returns -- a dict with the number of messages in memory and on disk, and counters of stored, spilled,
+        forwarded, refused and expired messages"""
+
+        with self._mutex:
+
+            return {
+                "memory": len(self._memory),
+                "disk": self._spill_pending(),
+                "stored": self._stored,
+                "spilled": self._spilled,
+                "forwarded": self._forwarded,
+                "refused": self._refused,
+                "expired": self._expired }
+
+
+    def _spill_pending(self):
+
+        if self._spill is None:
+            return self._spill_closed
+
+        return len(self._spill)
+
+
+    def _spill_journal(self):
+
+        # called with the lock held, opens the journal again after close()
+        if self._spill is None:
+            self._spill = XivelyJournal(self._spill_path, self._spill_fsync)
+
+        return self._spill
+
+
+def _validate(topic, payload, qos):
+
+    # the checks of Client.publish, a message refused later by the mqtt client would be lost silently
+    if topic is None or len(topic) == 0:
+        raise ValueError('Invalid topic.')
+
+    if '+' in topic or '#' in topic:
+        raise ValueError('Publish topic cannot contain wildcards.')
+
+    if qos < 0 or qos > 2:
+        raise ValueError('Invalid QoS level.')
+
+    if not (payload is None or isinstance(payload, str) or isinstance(payload, bytearray) or
+            isinstance(payload, int) or isinstance(payload, float) or
+            (sys.version_info[0] < 3 and isinstance(payload, unicode))):
+        raise TypeError('payload must be a string, bytearray, int, float or None.')
@@ -0,0 +1,221 @@
+# Copyright (c) 2003-2016, Xively. All rights reserved.
+# This is part of Xively Python library, it is under the BSD 3-Clause license.
+
+import re
+import sys
+import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# size of a sample on the wire, a float in native byte order like the payload of XivelyClient.publish_timeseries()
+SAMPLE_SIZE = array.array('f').itemsize
+
+# longest category or string value of a formatted timeseries row in bytes, and the characters they can't contain
+CSV_FIELD_MAX = 1024
+_CSV_INVALID = re.compile(u"[,\r\n]")
+
+
+def pack_samples(values):
+
+    """convert a batch of values to consecutive 4 byte floats in a single pass
+
+    values -- array.array, memoryview, NumPy array (if NumPy is installed) or any sequence of numbers
+
+    returns -- a bytearray of the samples
+
+    raises TypeError or ValueError if a value is not a number"""
+
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        return bytearray(numpy.ascontiguousarray(values, dtype=numpy.float32).tobytes())
+
+    if isinstance(values, memoryview):
+        if values.format == 'f':
+            return bytearray(values.tobytes())
+        values = values.tolist()
+
+    if not (isinstance(values, array.array) and values.typecode == 'f'):
+        values = array.array('f', values)
+
+    if sys.version_info[0] < 3:
+        return bytearray(values.tostring())
+
+    return bytearray(values.tobytes())
+
+
+def split_samples(buffer):
+
+    """returns -- a list with a bytearray payload for each sample of a buffer made by pack_samples()"""
+
+    return [buffer[index:index + SAMPLE_SIZE] for index in range(0, len(buffer), SAMPLE_SIZE)]
+
+
+def unpack_samples(payload):
+
+    """decode the payload of a packed publish_timeseries_batch() message on the subscriber side
+
+    payload -- bytes or bytearray of consecutive 4 byte floats
+
+    returns -- an array.array('f') of the samples"""
+
+    samples = array.array('f')
+
+    if sys.version_info[0] < 3:
+        samples.fromstring(bytes(payload))
+    else:
+        samples.frombytes(bytes(payload))
+
+    return samples
+
+
+def encode_csv_rows(times, categories, string_values, numeric_values):
+
+    """encode formatted timeseries rows, the payloads of XivelyClient.publish_formatted_timeseries()
+
+    Each argument is a column, None or a sequence with a value or None for every row. The columns are checked once
+    each: times must be ints, numeric values floats, categories and string values at most CSV_FIELD_MAX bytes long
+    without commas and line breaks. Every row needs a category, string value or numeric value.
+
+    returns -- a list with a bytearray payload for each row, empty if there are no rows
+
+    raises TypeError or ValueError if a column is invalid"""
+
+    columns = [times, categories, numeric_values, string_values]
+    count = max([len(column) for column in columns if column is not None] or [0])
+
+    for index, column in enumerate(columns):
+        if column is None:
+            columns[index] = [None] * count
+        elif numpy is not None and isinstance(column, numpy.ndarray):
+            columns[index] = column.tolist()
+        if len(columns[index]) != count:
+            raise ValueError("columns differ in length")
+
+    # splitting no text gives one empty row
+    if count == 0:
+        return []
+
+    times, categories, numeric_values, string_values = columns
+
+    if not all(isinstance(value, int) for value in times if value is not None):
+        raise TypeError("time must be an int")
+
+    if not all(isinstance(value, float) for value in numeric_values if value is not None):
+        raise TypeError("numeric value must be a float")
+
+    for column in (categories, string_values):
+        _check_csv_strings([value for value in column if value is not None])
+
+    for category, numeric_value, string_value in zip(categories, numeric_values, string_values):
+        if category is None and numeric_value is None and string_value is None:
+            raise ValueError("a row needs a category, string value or numeric value")
+
+    rows = u"\n".join(u"%s,%s,%s,%s" % (u"" if time is None else time,
+                                        u"" if category is None else category,
+                                        u"" if numeric_value is None else str(numeric_value),
+                                        u"" if string_value is None else string_value)
+                      for time, category, numeric_value, string_value
+                      in zip(times, categories, numeric_values, string_values))
+
+    # a single encode for all rows, they can't contain line breaks
+    return bytearray(rows, "utf-8").split(b"\n")
+
+
+def _check_csv_strings(values):
+
+    # one scan of the whole column
+    if _CSV_INVALID.search(u"".join(values)) is not None:
+        raise ValueError("commas and line breaks are not allowed")
+
+    # a character takes at most 4 bytes, only long values need to be measured
+    for value in values:
+        if len(value) > CSV_FIELD_MAX // 4:
+            if not isinstance(value, bytes):
+                value = value.encode("utf-8")
+            if len(value) > CSV_FIELD_MAX:
+                raise ValueError("value longer than %d bytes" % CSV_FIELD_MAX)
+
+
+# publish_timeseries() in a loop against publish_timeseries_batch(), over a local socket that discards everything
+def _benchmark(samples=100000, batch_size=1000):
+
+    import socket
+    import threading
+    import time
+    from .paho_mqtt_client import Client
+    from .xively_client import XivelyClient
+
+    listensock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listensock.bind(("127.0.0.1", 0))
+    listensock.listen(1)
+
+    def sink():
+        conn, address = listensock.accept()
+        while conn.recv(65536):
+            pass
+        conn.close()
+
+    sink_thread = threading.Thread(target = sink)
+    sink_thread.daemon = True
+    sink_thread.start()
+
+    client = XivelyClient()
+    client._mqtt = Client("timeseries")
+    client._mqtt.connect("127.0.0.1", listensock.getsockname()[1])
+
+    values = array.array('f', [index * 0.5 for index in range(batch_size)])
+
+    def flush():
+        while client._mqtt.want_write():
+            client._mqtt.loop(0.01)
+
+    start = time.time()
+    for index in range(samples // batch_size):
+        for value in values:
+            client.publish_timeseries("timeseries/single", value, 0)
+        flush()
+    single = time.time() - start
+
+    start = time.time()
+    for index in range(samples // batch_size):
+        client.publish_timeseries_batch("timeseries/batch", values, 0)
+        flush()
+    batch = time.time() - start
+
+    start = time.time()
+    for index in range(samples // batch_size):
+        client.publish_timeseries_batch("timeseries/packed", values, 0, packed=True)
+        flush()
+    packed = time.time() - start
+
+    times = list(range(batch_size))
+    categories = ["category"] * batch_size
+    strings = ["value"] * batch_size
+    numbers = values.tolist()
+
+    start = time.time()
+    for index in range(samples // batch_size):
+        for row in zip(times, categories, strings, numbers):
+            client.publish_formatted_timeseries("timeseries/row", row[0], row[1], row[2], row[3], 0)
+        flush()
+    rows = time.time() - start
+
+    start = time.time()
+    for index in range(samples // batch_size):
+        client.publish_formatted_timeseries_batch("timeseries/rows", times, categories, strings, numbers, 0)
+        flush()
+    rows_batch = time.time() - start
+
+    client._mqtt.disconnect()
+
+    print("%d samples, publish_timeseries %.0f/s, batch %.0f/s, packed %.0f/s" %
+          (samples, samples / single, samples / batch, samples / packed))
+    print("%d rows, publish_formatted_timeseries %.0f/s, batch %.0f/s" %
+          (samples, samples / rows, samples / rows_batch))
+
+
+# for standalone testing
+if __name__ == '__main__':
+    _benchmark()